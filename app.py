@@ -1,4 +1,5 @@
 import model
+import interboard
 import staff_interface
 
 from template import Template
@@ -16,6 +17,15 @@ def no_task(environ, start_response):
 def init_database():
     model.metadata.create_all(model.engine)
 
+    # Tables created by older versions. Their addresses are converted
+    # right away, as equality lookups (flood checks, sage counts) do not
+    # match the old format.
+    if model.ensure_columns(model.admin):
+        interboard.fill_ban_ranges()
+        interboard.migrate_ips()
+    for table in (model.admin, model.report, model.activity, model.backup):
+        model.ensure_indexes(table)
+
 # Cache building
 def task_rebuild(environ, start_response):
     request = environ['werkzeug.request']
@@ -347,19 +357,21 @@ def si_task_factory(dest, *form):
         return StaffInterface(**kwargs)
     return task
 
-task_mpanel = si_task_factory('HOME_PANEL', 'page')
+task_mpanel = si_task_factory('HOME_PANEL', 'page', 'cursor')
 task_bans = si_task_factory('BAN_PANEL', 'ip')
 task_baneditwindow = si_task_factory('BAN_EDIT_POPUP', 'num')
 task_banpopup = si_task_factory('BAN_POPUP', 'ip', 'delete')
 task_staff = si_task_factory('STAFF_PANEL')
 task_spam = si_task_factory('SPAM_PANEL')
 task_reports = si_task_factory('REPORTS_PANEL',
-    'page', 'perpage', 'sortby','order')
+    'page', 'perpage', 'cursor', 'sortby','order')
 task_postbackups = si_task_factory('TRASH_PANEL', 'page')
 
 task_sql = si_task_factory('SQL_PANEL', 'sql', 'nuke')
+task_queries = si_task_factory('QUERY_PANEL', 'clear')
 task_proxy = si_task_factory('PROXY_PANEL')
 task_security = si_task_factory('SECURITY_PANEL')
+task_performance = si_task_factory('PERFORMANCE_PANEL')
 
 task_deleteuserwindow = si_task_factory('DEL_STAFF_CONFIRM', 'username')
 task_disableuserwindow = si_task_factory('DISABLE_STAFF_CONFIRM', 'username')
@@ -367,7 +379,8 @@ task_enableuserwindow = si_task_factory('ENABLE_STAFF_CONFIRM', 'username')
 task_edituserwindow = si_task_factory('EDIT_STAFF_CONFIRM', 'username')
 
 task_searchposts = si_task_factory('POST_SEARCH_PANEL',
-    'search', 'caller', 'text')
+    'search', 'caller', 'text', 'page', 'perpage', 'cursor')
+task_globalsearch = si_task_factory('GLOBAL_SEARCH_PANEL', 'search', 'text')
 
 def task_addip(environ, start_response):
     request = environ['werkzeug.request']
@@ -539,7 +552,8 @@ def task_stafflog(environ, start_response):
     request = environ['werkzeug.request']
 
     params = {'form':    ['sortby', 'order', 'iptoview', 'view', 'perpage',
-                          'page', 'actiontoview', 'posttoview', 'usertoview'],
+                          'page', 'cursor', 'actiontoview', 'posttoview',
+                          'usertoview'],
               'cookies': ['wakaadmin']}
 
     kwargs = kwargs_from_params(request, params)
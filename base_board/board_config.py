@@ -83,6 +83,7 @@ config['METAKEYWORDS'] = 'desuchan,rozen maiden,loli,anime,mangna,touhou,art,lit
 config['CONVERT_CHARSETS'] = 1			# Do character set conversions internally
 config['TRIM_METHOD'] = 1			# Which threads to trim (0: oldest - like futaba 1: least active - furthest back)
 config['ARCHIVE_MODE'] = 0			# Old images and posts are moved into an archive dir instead of deleted (0: no 1: yes). It is HIGHLY RECOMMENDED you use TRIM_METHOD} = 1 with this, or you may end up with unreferenced pictures in your archive
+config['ARCHIVE_PER_PAGE'] = 100		# Threads listed per page of the archive index (ARCHIVE_DIR/index.html)
 config['DATE_STYLE'] = 'futaba'			# Date style ('futaba', '2ch', 'localtime', 'tiny')
 config['DISPLAY_ID'] = ''			# How to display user IDs (0 or '': don't display,
 						#  'day' and 'board' in any combination: make IDs change for each day or board,
@@ -104,6 +105,7 @@ config['STYLE_COOKIE'] = 'wakastyle'		# Name of the board's style cookie. Genera
 # Internal paths and files - might as well leave this alone.
 config['IMG_DIR'] = 'src/'			# Image directory (needs to be writeable by the script)
 config['THUMB_DIR'] = 'thumb/'			# Thumbnail directory (needs to be writeable by the script)
+config['STORAGE_SHARDS'] = 0			# Levels of hash-named subdirectories in IMG_DIR and THUMB_DIR (0: flat, 2: src/ab/cd/). Run "wakarimasen.py migrate_storage" after changing.
 config['RES_DIR'] = 'res/'			# Reply cache directory (needs to be writeable by the script)
 config['ARCHIVE_DIR'] = 'arch/'			# Root of archive directories (all need to be writeable by the script)
 config['BACKUP_DIR'] = "backup/"		# Subdirectory in ARCHIVE_DIR for all backup images and thumbnails.
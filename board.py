@@ -1,16 +1,20 @@
 import os
 import re
 import time
+import errno
 import sys
-import hashlib
 import mimetypes
 from subprocess import Popen, PIPE
 
 import misc
+import filestore
+import thumbnailer
+import search
 import str_format
 import oekaki
 import util
 import model
+import metrics
 import staff
 import staff_interface
 # NOTE: I'm not sure if interboard is a good module to have here.
@@ -25,7 +29,8 @@ try:
 except ImportError:
     board_config_defaults = None
 
-from sqlalchemy.sql import case, or_, and_, select, func, null
+from sqlalchemy.sql import case, or_, and_, not_, select, func, null, \
+    literal
 
 class Board(object):
     def __init__(self, board):
@@ -60,11 +65,13 @@ class Board(object):
                                           local.environ['DOCUMENT_ROOT']), '')
         self.url = str_format.percent_encode(url_path)
         self.name = board
+        self._backup_dirs = {}
 
     def make_path(self, file='', dir='', dirc=None, page=None, thread=None,
                   ext=config.PAGE_EXT, abbr=False, hash=None, url=False,
-                  force_http=False):
-        '''Builds an url or a path'''
+                  force_http=False, archive=False):
+        '''Builds an url or a path. With archive, it points to the copy kept
+        under ARCHIVE_DIR.'''
         if url:
             base = self.url
             if force_http:
@@ -72,6 +79,9 @@ class Board(object):
         else:
             base = self.path
 
+        if archive:
+            base = os.path.join(base, self.options['ARCHIVE_DIR'])
+
         if page is not None:
             if page == 0:
                 file = self.options['HTML_SELF']
@@ -81,6 +91,11 @@ class Board(object):
 
         if dirc:
             dir = self.options[dirc]
+            # Uploads and thumbnails may be spread over hash-named
+            # subdirectories; see STORAGE_SHARDS.
+            if file and dirc in ('IMG_DIR', 'THUMB_DIR'):
+                dir = os.path.join(dir, *filestore.shard_dirs(file,
+                    self.options.get('STORAGE_SHARDS', 0)))
 
         if thread is not None:
             dir = self.options['RES_DIR']
@@ -100,6 +115,24 @@ class Board(object):
         else:
             return os.path.join(base, dir) + hash
 
+    def make_backup_path(self, filename, url=False):
+        '''Builds the path (or url) of the backup copy of an image or
+        thumbnail, mirroring its location under IMG_DIR or THUMB_DIR.'''
+        relative = os.path.basename(filename)
+        for dirc in ('IMG_DIR', 'THUMB_DIR'):
+            if filename.startswith(self.options[dirc]):
+                relative = filename[len(self.options[dirc]):]
+                break
+
+        try:
+            backup_dir = self._backup_dirs[url]
+        except KeyError:
+            backup_dir = self._backup_dirs[url] = self.make_path(
+                dir=os.path.join(self.options['ARCHIVE_DIR'],
+                                 self.options['BACKUP_DIR']),
+                ext=None, url=url)
+        return os.path.join(backup_dir, relative)
+
     def check_access(self, user):
         if user.account == staff.MODERATOR and self.name not in user.reign:
             raise WakaError('Access to this board (%s) denied.' % self.name)
@@ -135,8 +168,26 @@ class Board(object):
 
         return threads
 
-    def get_some_threads(self, page):
-        '''Grab a partial list of threads for pre-emptive pagination.'''
+    def _thread_keyset(self):
+        '''Board page order of threads, as a keyset (see model.Page).'''
+        table = self.table
+        return [(func.coalesce(table.c.stickied, 0), True),
+                (table.c.lasthit, True),
+                (table.c.num, False)]
+
+    def thread_cursor(self, direction, op):
+        '''Cursor for get_some_threads() to the page after ('next') or
+        before ('prev') the thread opened by op.'''
+        return model.encode_cursor(direction,
+                                   [op.stickied or 0, op.lasthit, op.num])
+
+    def get_some_threads(self, page, cursor=None):
+        '''Grab a partial list of threads for pre-emptive pagination.
+
+        Only the replies shown on board pages are loaded; the thread
+        openers carry the total reply_count and image_count. With a
+        cursor from thread_cursor(), the page is found by seeking past the
+        thread it names instead of counting threads off with OFFSET.'''
 
         session = model.Session()
         table = self.table
@@ -147,23 +198,68 @@ class Board(object):
         # Page is zero-indexed, so offset formula must differ.
         offset = page * per_page
 
-        # Query 1: Grab all thread (OP) entries.
-        op_sql = table.select().where(table.c.parent == 0).order_by(
-                    table.c.stickied.desc(),
-                    table.c.lasthit.desc(),
-                    table.c.num.asc()
-                ).limit(per_page).offset(offset)
-        op_query = session.execute(op_sql)
-
-        for op in op_query:
+        # Query 1: Grab all thread (OP) entries, with their reply counts
+        # and the number of the first reply shown (none if all are).
+        replies = table.alias('replies')
+        in_thread = replies.c.parent == table.c.num
+
+        def cutoff(max_replies):
+            return select([replies.c.num], in_thread)\
+                .order_by(replies.c.num.desc())\
+                .limit(1).offset(max(max_replies, 1) - 1).as_scalar()
+
+        op_sql = select([table,
+            select([func.count()], in_thread)\
+                .as_scalar().label('reply_count'),
+            select([func.count(replies.c.image)], in_thread)\
+                .as_scalar().label('image_count'),
+            case([(table.c.stickied != 0,
+                   cutoff(config.REPLIES_PER_STICKY))],
+                 else_=cutoff(self.options['REPLIES_PER_THREAD']))\
+                .label('cutoff')],
+            table.c.parent == 0)
+
+        keyset = self._thread_keyset()
+        (direction, values) = model.decode_cursor(cursor) if cursor \
+                              else (None, None)
+        ops = []
+        if direction in ('next', 'prev') and len(values) == len(keyset):
+            forward = direction == 'next'
+            ops = session.execute(op_sql\
+                      .where(model.keyset_seek(keyset, values, forward))\
+                      .order_by(*model.keyset_order(keyset, forward))\
+                      .limit(per_page)).fetchall()
+            if not forward:
+                ops.reverse()
+        if not ops:
+            ops = session.execute(op_sql\
+                      .order_by(*model.keyset_order(keyset))\
+                      .limit(per_page).offset(offset)).fetchall()
+
+        # Replies shown of each thread: from its cutoff on.
+        shown = []
+        for op in ops:
             thread_dict[op.num] = [model.CompactPost(op)]
             thread_nums.append(op.num)
+            if op.stickied:
+                max_replies = config.REPLIES_PER_STICKY
+            else:
+                max_replies = self.options['REPLIES_PER_THREAD']
+            if max_replies <= 0 or not op.reply_count:
+                continue
+            if op.cutoff is None:
+                shown.append(table.c.parent == op.num)
+            else:
+                shown.append(and_(table.c.parent == op.num,
+                                  table.c.num >= op.cutoff))
+
+        if not shown:
+            return [thread_dict[num] for num in thread_nums]
 
-        # Query 2: Grab all reply entries and process.
-        reply_sql = table.select().where(table.c.parent.in_(thread_nums))\
-                    .order_by(table.c.stickied.desc(),
-                        table.c.num.asc()
-                    )
+        # Query 2: Grab the last replies of each thread, one index range
+        # each.
+        reply_sql = table.select().where(or_(*shown))\
+                    .order_by(table.c.num.asc())
         reply_query = session.execute(reply_sql)
 
         for post in reply_query:
@@ -230,6 +326,11 @@ class Board(object):
             thread = {}
             thread['omit'] = 0
             thread['omitimages'] = 0
+            if parent.reply_count is not None:
+                # Replies not loaded by get_some_threads().
+                thread['omit'] = parent.reply_count - len(replies)
+                thread['omitimages'] = parent.image_count - len(images)
+
             while len(replies) > max_replies or len(images) > max_images:
                 post = replies.pop(0)
                 thread['omit'] += 1
@@ -374,56 +475,108 @@ class Board(object):
             if os.path.exists(abbreviated_filename):
                 os.unlink(abbreviated_filename)
 
-    def delete_thread_cache(self, parent, archiving):
-        archive_dir = self.options['ARCHIVE_DIR']
-
+    def delete_thread_cache(self, parent):
         base = os.path.join(self.path, self.options['RES_DIR'], '')
-        full_filename = "%s%s" % (parent, config.PAGE_EXT)
-        full_thread_page = base + full_filename
+        full_thread_page = base + "%s%s" % (parent, config.PAGE_EXT)
         abbrev_thread_page = base + "%s_abbr%s" % (parent, config.PAGE_EXT)
-        if archiving:
-            archive_base = os.path.join(self.path,
-                                        self.options['ARCHIVE_DIR'],
-                                        self.options['RES_DIR'], '')
-            try:
-                os.makedirs(archive_base, 0755)
-            except os.error:
-                pass
-            archive_thread_page = archive_base + full_filename
-
-            with open(full_thread_page, 'r') as res_in:
-                with open(archive_thread_page, 'w') as res_out:
-                    for line in res_in:
-                        # Update thumbnail links.
-                        line = re.sub(r'img src="(.*?)'
-                                          + self.options['THUMB_DIR'],
-                                      r'img src="\1'
-                                          + os.path.join(archive_dir,
-                                              self.options['THUMB_DIR'], ''),
-                                      line)
-                        # Update image links.
-                        line = re.sub(r'a href="(.*?)'
-                                          + self.options['IMG_DIR'],
-                                      r'a href="\1'
-                                          + os.path.join(archive_dir,
-                                              self.options['IMG_DIR'], ''),
-                                      line)
-                        # Update reply links.
-                        line = re.sub(r'a href="(.*?)'
-                            + os.path.join(self.path,
-                                           self.options['RES_DIR'], ''),
-                            r'a href="\1' + os.path.join(\
-                                           self.path,
-                                           self.options['RES_DIR'], ''),
-                            line)
-
-                        res_out.write(line)
-                
+
         if os.path.exists(full_thread_page):
             os.unlink(full_thread_page)
         if os.path.exists(abbrev_thread_page):
             os.unlink(abbrev_thread_page)
 
+    def archive_thread(self, threadid):
+        '''Render a thread that is about to be removed from the database
+        into ARCHIVE_DIR/RES_DIR, and list it in the archive index.'''
+
+        thread = self.get_thread_posts(threadid)
+
+        # Links within the thread follow it into the archive.
+        live_url = self.make_url(thread=threadid)
+        archive_url = self.make_url(thread=threadid, archive=True)
+        for post in thread:
+            if post.comment:
+                post.comment = post.comment\
+                    .replace('href="%s"' % live_url,
+                             'href="%s"' % archive_url)\
+                    .replace('href="%s#' % live_url,
+                             'href="%s#' % archive_url)
+
+        filename = self.make_path(thread=threadid, archive=True)
+        filestore.ensure_dir(filename)
+
+        Template('page_template',
+            threads=[{'posts': thread}],
+            thread=threadid,
+            postform=0,
+            image_inp=0,
+            textonly_inp=0,
+            dummy=thread[-1].num,
+            lockedthread='yes',
+            archive=True
+        ).render_to_file(filename)
+
+        self.add_to_archive_index(thread)
+
+    def make_archive_index_path(self, page, url=False):
+        if page is None:
+            file = 'index'
+        else:
+            file = 'index%d' % page
+        return self.make_path(file, url=url, archive=True)
+
+    def add_to_archive_index(self, thread):
+        '''Append a thread to the archive index. The index is paginated
+        oldest first, so only the last page (and, when a page is started,
+        the one before it) has to be rendered again.'''
+
+        session = model.Session()
+        table = model.archive
+        op = thread[0]
+        session.execute(table.insert().values(board_name=self.name,
+                                              thread=op.num,
+                                              subject=op.subject,
+                                              date=op.date,
+                                              postcount=len(thread),
+                                              timestampofarchival=\
+                                                  int(time.time())))
+
+        sql = select([func.count()], table.c.board_name == self.name)
+        position = session.execute(sql).scalar() - 1
+
+        per_page = self.options.get('ARCHIVE_PER_PAGE', 100)
+        last_page = position // per_page
+        if position % per_page == 0 and last_page > 0:
+            # The previous page gains a link to the new one.
+            self.build_archive_index_page(last_page - 1, last_page)
+        self.build_archive_index_page(last_page, last_page)
+
+    def build_archive_index_page(self, page, last_page):
+        session = model.Session()
+        table = model.archive
+        per_page = self.options.get('ARCHIVE_PER_PAGE', 100)
+
+        sql = table.select().where(table.c.board_name == self.name)\
+                   .order_by(table.c.num.asc())\
+                   .limit(per_page).offset(page * per_page)
+        entries = session.execute(sql).fetchall()
+
+        prevpage = nextpage = None
+        if page > 0:
+            prevpage = self.make_archive_index_path(page - 1, url=True)
+        if page < last_page:
+            nextpage = self.make_archive_index_path(page + 1, url=True)
+
+        index = Template('archive_index',
+                         entries=entries,
+                         page=page,
+                         prevpage=prevpage,
+                         nextpage=nextpage)
+        index.render_to_file(self.make_archive_index_path(page))
+        if page == last_page:
+            # The landing page shows the latest archived threads.
+            index.render_to_file(self.make_archive_index_path(None))
+
     def build_thread_cache_all(self):
         session = model.Session()
         sql = select([self.table.c.num], self.table.c.parent == 0)
@@ -682,8 +835,9 @@ class Board(object):
 
         # copy file, do checksums, make thumbnail, etc
         if file:
+            # Edits keep no backup of the replaced file.
             if filename or thumbnail:
-                self.delete_file(filename, thumbnail)
+                self.delete_file(filename, thumbnail, md5=md5, backup=False)
 
             filename, md5, width, height, thumbnail, tn_width, tn_height = \
                 self.process_file(file, timestamp, parent, bool(post_num))
@@ -751,6 +905,12 @@ class Board(object):
                         .values(lasthit=timestamp))
             post_num = result.inserted_primary_key[0]
 
+        if thumbnail:
+            thumbnailer.assign_post(self, thumbnail, post_num)
+
+        search.index_posts(self, [dict(num=post_num, name=name, trip=trip,
+                                       comment=comment)])
+
         # remove old threads from the database
         self.trim_database()
 
@@ -890,31 +1050,41 @@ class Board(object):
         try:
             ip = int(ip)
         except ValueError:
-            ip = misc.dot_to_dec(ip)
+            ip = misc.dot_to_dec(ip.strip())
+        if not isinstance(ip, (int, long)):
+            raise WakaError(strings.BADIP)
 
+        # A missing or host mask matches the address alone, of either
+        # family.
         try:
-            mask = int(mask)
+            mask = misc.netmask(ip, mask)
+            start, end = misc.ip_range(ip, mask)
         except ValueError:
-            mask = misc.dot_to_dec(mask or '255.255.255.255')
+            raise WakaError('Please enter a valid netmask.')
 
         session = model.Session()
         table = self.table
 
-        sql = table.select().where(table.c.ip.op('&')(mask) == ip & mask)
-        rows = session.execute(sql)
+        # Every post from the range, in one query; replies of threads
+        # started from it are taken along by _delete_matching().
+        matching = model.ip_in_range(table.c.ip, start, end)
+        targets = session.execute(table.select().where(matching)).fetchall()
 
         timestamp = None
         if config.POST_BACKUP:
             timestamp = time.time()
 
-        for row in rows:
-            try:
-                self.delete_post(row.num, '', False, False, admin=True,
-                                 timestampofarchival=timestamp)
-            except WakaError:
-                pass
+        removed, threads = 0, ()
+        if targets:
+            removed, threads = self._delete_matching(matching, targets,
+                                                     False, False, timestamp)
+            self.build_cache()
 
-        self.build_cache()
+        if task_data:
+            task_data.contents.append('%d posts, %d threads removed from /%s/'
+                                      % (removed, len(threads), self.name))
+
+        return removed, len(threads)
 
     def delete_stuff(self, posts, password, file_only, archiving,
                      caller='user', admindelete=False,
@@ -927,11 +1097,9 @@ class Board(object):
         if config.POST_BACKUP:
             timestamp = time.time()
 
-        for post in posts:
-            self.delete_post(post, password, file_only, archiving,
-                             from_window=False, admin=admindelete,
-                             timestampofarchival=timestamp,
-                             admin_task_data=admin_task_data)
+        self.delete_posts(posts, password, file_only, archiving,
+                          admin=admindelete, timestampofarchival=timestamp,
+                          admin_task_data=admin_task_data)
 
         self.build_cache()
 
@@ -944,169 +1112,182 @@ class Board(object):
 
     def delete_post(self, post, password, file_only, archiving,
                     admin_task_data=None, from_window=False, admin=False,
-                    timestampofarchival=None, recur=False):
+                    timestampofarchival=None):
         '''Delete a single post from the board. This method does not rebuild
         index cache automatically.'''
-        thumb = self.options['THUMB_DIR']
-        src = self.options['IMG_DIR']
+        self.delete_posts([post], password, file_only, archiving,
+                          admin=admin,
+                          timestampofarchival=timestampofarchival,
+                          admin_task_data=admin_task_data)
+
+    def delete_posts(self, posts, password, file_only, archiving,
+                     admin=False, timestampofarchival=None,
+                     admin_task_data=None):
+        '''Delete a batch of posts from the board. The posts are loaded,
+        backed up and deleted with one statement each, and every affected
+        thread page is rebuilt once. This method does not rebuild index
+        cache automatically.'''
 
         table = self.table
-
-        sql = table.select().where(table.c.num == post)
         session = model.Session()
-        query = session.execute(sql)
 
-        row = query.fetchone()
+        posts = [int(post) for post in posts]
+        if not posts:
+            return
 
-        if row is None:
-            raise WakaError(strings.POSTNOTFOUND % (int(post), self.name))
+        sql = table.select().where(table.c.num.in_(posts))
+        targets = dict((row.num, row) for row in session.execute(sql))
+
+        for post in posts:
+            row = targets.get(post)
+            if row is None:
+                raise WakaError(strings.POSTNOTFOUND % (post, self.name))
+
+            if not admin:
+                if row.admin_post:
+                    raise WakaError(strings.MODDELETEONLY)
+
+                if password != row.password:
+                    raise WakaError(str(post) + strings.BADDELPASS)
 
         if not admin: 
             archiving = False
 
-            if row.admin_post:
-                raise WakaError(strings.MODDELETEONLY)
+        self._delete_matching(table.c.num.in_(posts), targets.values(),
+                              file_only, archiving, timestampofarchival)
+
+        if admin_task_data:
+            for post in posts:
+                admin_task_data.contents.append('/%s/%d' % (self.name, post))
 
-            if password != row.password:
-                raise WakaError(post + strings.BADDELPASS)
+    def _delete_matching(self, where, targets, file_only, archiving,
+                         timestampofarchival=None):
+        '''Remove the posts matched by the where clause, already loaded as
+        targets, along with the replies of any thread among them (or only
+        their files, with file_only). Returns the number of posts removed
+        and the set of threads removed.'''
+
+        table = self.table
+        session = model.Session()
+
+        threads = set(row.num for row in targets if not row.parent)
+
+        if archiving and not file_only:
+            # Rendered while the posts are still there.
+            for thread in threads:
+                self.archive_thread(thread)
+
+        victims = where
+        if file_only:
+            # remove just the images and update the database
+            rows = targets
+        else:
+            # Whole threads go along with their replies. Only their files
+            # are needed here; the rows are copied and deleted server-side.
+            rows = [row for row in targets if row.parent not in threads]
+            if threads:
+                replies = table.c.parent.in_(list(threads))
+                sql = select([table.c.num, table.c.parent, table.c.image,
+                              table.c.thumbnail, table.c.md5], replies)
+                rows.extend(session.execute(sql).fetchall())
+                victims = or_(victims, replies)
 
         if config.POST_BACKUP and not archiving:
             if not timestampofarchival:
                 timestampofarchival = time.time()
-            sql = model.backup.insert().values(board_name=self.name,
-                                               postnum=row.num,
-                                               parent=row.parent,
-                                               timestamp=row.timestamp,
-                                               lasthit=row.lasthit,
-                                               ip=row.ip,
-                                               date=row.date,
-                                               name=row.name,
-                                               trip=row.trip,
-                                               email=row.email,
-                                               subject=row.subject,
-                                               password=row.password,
-                                               comment=row.comment,
-                                               image=row.image,
-                                               size=row.size,
-                                               md5=row.md5,
-                                               width=row.width,
-                                               height=row.height,
-                                               thumbnail=row.thumbnail,
-                                               tn_width=row.tn_width,
-                                               tn_height=row.tn_height,
-                                               lastedit=row.lastedit,
-                                               lastedit_ip=row.lastedit_ip,
-                                               admin_post=row.admin_post,
-                                               stickied=row.stickied,
-                                               locked=row.locked,
-                                               timestampofarchival=\
-                                                  timestampofarchival)
-            session.execute(sql)
-
-        if file_only:
-            # remove just the image and update the database
-            select_post_image = select([table.c.image, table.c.thumbnail],
-                                       or_(table.c.num == post))
-            baleet_me = session.execute(select_post_image).fetchone()
+            self.backup_posts(victims, timestampofarchival)
 
-            if baleet_me.image and baleet_me.thumbnail:
-                self.delete_file(baleet_me.image, baleet_me.thumbnail,
-                                 archiving=archiving)
+        for row in rows:
+            if row.image and row.thumbnail:
+                self.delete_file(row.image, row.thumbnail,
+                                 archiving=archiving, md5=row.md5)
 
-            postupdate = table.update().where(table.c.num == post).values(
-                size=0, md5=null(), thumbnail=null())
+        if file_only:
+            postupdate = table.update().where(victims)\
+                              .values(size=0, md5=null(), thumbnail=null())
             session.execute(postupdate)
-
         else:
-            if config.POST_BACKUP and not archiving:
-                select_thread_images \
-                    = select([table.c.image, table.c.thumbnail],
-                             table.c.num == post)
-            else:
-                select_thread_images \
-                    = select([table.c.image, table.c.thumbnail],
-                             or_(table.c.num == post, table.c.parent == post))
-            images_to_baleet = session.execute(select_thread_images)
-            
-            for i in images_to_baleet:
-                if i.image and i.thumbnail:
-                    self.delete_file(i.image, i.thumbnail, archiving=archiving)
-
-            if config.POST_BACKUP and not archiving:
-                delete_query = table.delete(table.c.num == post)
-            else:
-                delete_query = table.delete(or_(
-                    table.c.num == post, table.c.parent == post))
-            session.execute(delete_query)
-
-            # Also back-up child posts.
-            if config.POST_BACKUP and not archiving:
-                sql = select([table.c.num], table.c.parent == post)
-                sel_posts = session.execute(sql).fetchall()
-                for i in [p[0] for p in sel_posts]:
-                    self.delete_post(i, '', False, False,
-                                     from_window=from_window, admin=True,
-                                     recur=True)
+            search.remove_posts(self, select([table.c.num], victims))
+            session.execute(table.delete(victims))
 
         # Cache building
-        if not row.parent:
-            if file_only:
-                # removing parent (OP) image
-                self.build_thread_cache(post)
-            else:
+        if file_only:
+            rebuild = set(row.parent or row.num for row in targets)
+        else:
+            for thread in threads:
                 # removing an entire thread
-                self.delete_thread_cache(post, archiving)
-        elif not recur:
-            # removing a reply, or a reply's image
-            self.build_thread_cache(row.parent)
+                self.delete_thread_cache(thread)
+            rebuild = set(row.parent for row in targets
+                          if row.parent not in threads) - set([0])
 
-        if admin_task_data:
-            admin_task_data.contents.append('/%s/%d' % (self.name, int(post)))
+        for thread in rebuild:
+            self.build_thread_cache(thread)
+
+        return (len(rows), threads)
+
+    def backup_posts(self, where, timestampofarchival):
+        '''Copy the posts matched by the where clause to the backup table,
+        server-side, with a single INSERT ... SELECT.'''
+        table = self.table
+        columns = [column for column in table.c if column.name != 'num']
+
+        sql = model.backup.insert().from_select(
+            ['board_name', 'postnum'] + [column.name for column in columns]
+                + ['timestampofarchival'],
+            select([literal(self.name), table.c.num] + columns
+                       + [literal(timestampofarchival)], where))
+
+        session = model.Session()
+        session.execute(sql)
 
     def delete_file(self, relative_file_path, relative_thumb_path,
-                    archiving=False):
+                    archiving=False, md5=None, backup=None):
+        '''Remove the files of a post: archived, moved to the trash bin if
+        backup (by default, if POST_BACKUP) or deleted.'''
         # pch = oekaki.find_pch(row.image)
+        if backup is None:
+            backup = config.POST_BACKUP
         full_file_path = os.path.join(self.path, relative_file_path)
         full_thumb_path = os.path.join(self.path, relative_thumb_path)
         archive_base = os.path.join(self.path,
                                     self.options['ARCHIVE_DIR'], '')
-        backup_base = os.path.join(archive_base, self.options['BACKUP_DIR'])
-
-        if config.POST_BACKUP:
-            try:
-                os.makedirs(backup_base, 0755)
-            except os.error:
-                pass
 
+        # Archived and backed up files keep their (possibly sharded)
+        # subdirectories; os.renames() creates them as needed.
         full_archive_path = os.path.join(archive_base,
                                          relative_file_path)
         full_tarchive_path = os.path.join(archive_base,
                                           relative_thumb_path)
-        full_backup_path = os.path.join(backup_base,
-                                        os.path.basename(relative_file_path))
-        full_tbackup_path = os.path.join(backup_base, 
-                                         os.path.basename(relative_thumb_path))
+        full_backup_path = self.make_backup_path(relative_file_path)
+        full_tbackup_path = self.make_backup_path(relative_thumb_path)
 
         if os.path.exists(full_file_path):
             if archiving:
                 os.renames(full_file_path, full_archive_path)
                 os.chmod(full_archive_path, 0644)
-            elif config.POST_BACKUP:
+            elif backup:
                 os.renames(full_file_path, full_backup_path)
                 os.chmod(full_backup_path, 0644)
             else:
                 os.unlink(full_file_path)
-        if os.path.exists(full_thumb_path) \
-                and re.match(self.options['THUMB_DIR'], relative_file_path):
+        if relative_thumb_path \
+                and re.match(self.options['THUMB_DIR'], relative_thumb_path) \
+                and os.path.exists(full_thumb_path):
             if archiving:
                 os.renames(full_thumb_path, full_tarchive_path)
                 os.chmod(full_tarchive_path, 0644)
-            elif config.POST_BACKUP:
-                os.renames(full_file_path, full_tbackup_path)
+            elif backup:
+                os.renames(full_thumb_path, full_tbackup_path)
                 os.chmod(full_tbackup_path, 0644)
             else:
                 os.unlink(full_thumb_path)
 
+        # The post no longer holds a reference to the deduplicated copy,
+        # unless it went to the trash bin, where the reference stays until
+        # the backup is removed (see remove_backup_post()).
+        if config.FILE_DEDUPE and (archiving or not backup):
+            filestore.release_content(md5)
+
     def remove_backup_stuff(self, admin_task_data, posts, restore=False):
         user = self.check_access(admin_task_data.user)
 
@@ -1125,7 +1306,7 @@ class Board(object):
                                               board=self,
                                               dest=staff_interface.TRASH_PANEL)
 
-    def remove_backup_post(self, task_data, post, restore=False, child=False):
+    def remove_backup_post(self, task_data, post, restore=False):
         session = model.Session()
         table = model.backup
         sql = table.select().where(and_(table.c.postnum == post,
@@ -1135,102 +1316,80 @@ class Board(object):
         if not row:
             raise WakaError('Backup record not found for post %s.' % (post))
 
-        arch_dir = os.path.join(self.path,
-                                self.options['ARCHIVE_DIR'],
-                                self.options['BACKUP_DIR'], '')
-        if row.image:
-            arch_image = os.path.join(arch_dir, os.path.basename(row.image))
-        else:
-            arch_image = None
-        if row.thumbnail:
-            arch_thumb = os.path.join(arch_dir, os.path.basename(row.thumbnail))
-        else:
-            arch_thumb = None
+        # The backup, and for a thread all of its replies' backups made at
+        # the point of archival, are handled together.
+        selected = table.c.num == row.num
+        removed = table.c.postnum == post
+        if not row.parent:
+            replies = and_(table.c.parent == row.postnum,
+                           table.c.timestampofarchival \
+                               == row.timestampofarchival)
+            selected = or_(selected, replies)
+            removed = or_(removed, replies)
+        selected = and_(table.c.board_name == self.name, selected)
+        removed = and_(table.c.board_name == self.name, removed)
+
+        sql = select([table.c.image, table.c.thumbnail, table.c.md5],
+                     selected)
+        files = session.execute(sql).fetchall()
 
         if restore:
             my_table = self.table
-            if row.parent and not child:
+            columns = dict((column.name, table.c[column.name])
+                           for column in my_table.c if column.name != 'num')
+            columns['num'] = table.c.postnum
+
+            if row.parent:
                 sql = my_table.select().where(my_table.c.num == row.parent)
                 parent = session.execute(sql).fetchone()
                 if not parent:
                     raise WakaError('Cannot restore post %s: '
                                     'Parent thread deleted.' % (post))
-                stickied = parent.stickied
-                locked = parent.locked
-                lasthit = parent.lasthit
-            else:
-                stickied = row.stickied
-                locked = row.locked
-                lasthit = row.lasthit
-
-            # Perform insertion.
-            sql = my_table.insert().values(num=row.postnum,
-                                           parent=row.parent,
-                                           timestamp=row.timestamp,
-                                           lasthit=lasthit,
-                                           ip=row.ip,
-                                           date=row.date,
-                                           name=row.name,
-                                           trip=row.trip,
-                                           email=row.email,
-                                           subject=row.subject,
-                                           password=row.password,
-                                           comment=row.comment,
-                                           image=row.image,
-                                           size=row.size,
-                                           md5=row.md5,
-                                           width=row.width,
-                                           height=row.height,
-                                           thumbnail=row.thumbnail,
-                                           tn_width=row.tn_width,
-                                           tn_height=row.tn_height,
-                                           lastedit=row.lastedit,
-                                           lastedit_ip=row.lastedit_ip,
-                                           admin_post=row.admin_post,
-                                           stickied=stickied,
-                                           locked=locked)
+                columns['stickied'] = literal(parent.stickied)
+                columns['locked'] = literal(parent.locked)
+                columns['lasthit'] = literal(parent.lasthit)
+
+            # Perform insertion, server-side.
+            names = columns.keys()
+            sql = my_table.insert().from_select(names,
+                select([columns[name] for name in names], selected))
             session.execute(sql)
+            search.index_matching(self, my_table.c.num.in_(
+                select([table.c.postnum], selected)))
 
-            # Move file/thumb.
-            if arch_image and os.path.exists(arch_image):
-                orig_path = os.path.join(self.path, row.image)
-                os.renames(arch_image, os.path.join(self.path, row.image))
-                os.chmod(orig_path, 0644)
-            if arch_thumb \
-                    and re.match(self.options['THUMB_DIR'],
-                                 row.thumbnail) \
-                    and os.path.exists(arch_thumb):
-                os.renames(arch_thumb, os.path.join(self.path, row.thumb))
-
-            if not child:
-                if row.parent:
-                    self.build_thread_cache(row.parent)
-                else:
-                    self.build_thread_cache(row.postnum)
-        else:
-            # Delete file/thumb.
-            if arch_image and os.path.exists(arch_image):
-                os.unlink(os.path.join(arch_image))
-            if arch_thumb \
-                    and re.match(self.options['THUMB_DIR'],
-                                 row.thumbnail) \
-                    and os.path.exists(arch_thumb):
-                os.unlink(arch_thumb)
-
-        # Remove (and restore if appropriate) all thread backups made at the
-        # point of archival.
-        if not row.parent:
-            sql = table.select(and_(table.c.parent == row.postnum,
-                                    table.c.board_name == self.name,
-                                    table.c.timestampofarchival\
-                                        == row.timestampofarchival))\
-                       .order_by(table.c.num.asc())
-            for row in session.execute(sql):
-                self.remove_backup_post(None, row.postnum, restore=restore,
-                                        child=True)
-
-        sql = table.delete().where(and_(table.c.postnum == post,
-                                        table.c.board_name == self.name))
+        for backup in files:
+            if backup.image:
+                arch_image = self.make_backup_path(backup.image)
+            else:
+                arch_image = None
+            if backup.thumbnail \
+                    and re.match(self.options['THUMB_DIR'], backup.thumbnail):
+                arch_thumb = self.make_backup_path(backup.thumbnail)
+            else:
+                arch_thumb = None
+
+            if restore:
+                # Move file/thumb.
+                if arch_image and os.path.exists(arch_image):
+                    orig_path = os.path.join(self.path, backup.image)
+                    os.renames(arch_image, orig_path)
+                    os.chmod(orig_path, 0644)
+                if arch_thumb and os.path.exists(arch_thumb):
+                    os.renames(arch_thumb,
+                               os.path.join(self.path, backup.thumbnail))
+            else:
+                # Delete file/thumb.
+                if arch_image and os.path.exists(arch_image):
+                    os.unlink(arch_image)
+                if arch_thumb and os.path.exists(arch_thumb):
+                    os.unlink(arch_thumb)
+                if config.FILE_DEDUPE:
+                    filestore.release_content(backup.md5)
+
+        if restore:
+            self.build_thread_cache(row.parent or row.postnum)
+
+        sql = table.delete().where(removed)
         session.execute(sql)
 
     def make_report_post_window(self, posts, from_window=False):
@@ -1383,23 +1542,25 @@ class Board(object):
                (maxp and (width * height) > maxp):
             raise WakaError(strings.BADFORMAT)
 
-        # generate "random" filename
-        filebase = ("%.3f" % timestamp).replace(".", "")
-        filename = self.make_path(filebase, dirc='IMG_DIR', ext=ext)
-
-
-        if not known:
-            filename += self.options['MUNGE_UNKNOWN']
+        # reserve a unique filename
+        suffix = '' if known else self.options['MUNGE_UNKNOWN']
+        try:
+            filebase, filename = filestore.allocate_upload_name(self,
+                timestamp, ext, suffix)
+        except (IOError, OSError):
+            raise WakaError(strings.NOTWRITE)
 
-        # copy file
+        # move the spooled upload in place
         try:
-            filestorage.save(filename)
+            filestore.save_upload(filestorage, filename)
         except IOError:
+            os.unlink(filename)
             raise WakaError(strings.NOTWRITE)
 
         # Check file type with UNIX utility file()
-        file_response = Popen(["file", filename], stdout=PIPE)\
-                        .communicate()[0]
+        with metrics.timed(metrics.SUBPROCESS):
+            file_response = Popen(["file", filename], stdout=PIPE)\
+                            .communicate()[0]
         if re.match("\:.*(?:script|text|executable)", file_response):
             os.unlink(filename)
             raise WakaError(strings.BADFORMAT + " Potential Exploit")
@@ -1415,41 +1576,48 @@ class Board(object):
             thumb_ext = os.path.splitext(filename)[1]
         thumbnail = self.make_path(filebase + "s", dirc='THUMB_DIR',
                                    ext=thumb_ext)
+        try:
+            filestore.ensure_dir(thumbnail)
+        except OSError:
+            os.unlink(filename)
+            raise WakaError(strings.NOTWRITE)
 
-        # get the checksum
-        md5h = hashlib.md5()
-        filestorage.stream.seek(0)
-        while True:
-            buffer = filestorage.stream.read(16 * 1024)
-            if not buffer:
-                break
-            md5h.update(buffer)
-        md5 = md5h.hexdigest()
+        # get the checksum (computed while the upload was streamed in)
+        md5 = filestore.get_upload_md5(filestorage)
 
         # check for duplicate files
         if (not editing  and \
             (parent and self.options['DUPLICATE_DETECTION'] == 'thread') or
              self.options['DUPLICATE_DETECTION'] == 'board'):
             session = model.Session()
+            table = self.table
 
-            # Check dupes in same thread
+            # Both lookups are served by the md5 index.
+            sql = select([table.c.num], table.c.md5 == md5).limit(1)
             if self.options['DUPLICATE_DETECTION'] == 'thread':
-                sql = self.table.select("md5=:md5 AND (parent=:parent OR "
-                    "num=:num)").params(md5=md5, parent=parent, num=parent)
-                result = session.execute(sql)
-            else: # Check dupes throughout board
-                sql = self.table.select("md5=:md5").params(md5=md5)
-                result = session.execute(sql)
-
-            match = result.fetchone()
+                # Check dupes in same thread
+                sql = sql.where(or_(table.c.parent == parent,
+                                    table.c.num == parent))
+
+            match = session.execute(sql).fetchone()
             if match:
                 os.unlink(filename) # make sure to remove the file
                 raise WakaError(strings.DUPE %
                     self.get_reply_link(match['num'], parent))
 
+        # link to an already stored copy of the same file, if there is one
+        content = None
+        if config.FILE_DEDUPE:
+            content = filestore.find_content(md5,
+                misc.get_filestorage_size(filestorage))
+            if content and not filestore.reuse_content(content, filename):
+                content = None
+
         # do thumbnail
         tn_width = tn_height = 0
         tn_ext = ''
+        thumb_spec = ''
+        deferred = False
 
         if not width:  # unsupported file
             if ext in filetypes: # externally defined filetype
@@ -1494,10 +1662,23 @@ class Board(object):
             if self.options['STUPID_THUMBNAILING']:
                 thumbnail = filename
             else:
-                tn_width, tn_height \
-                    = misc.make_thumbnail(filename, thumbnail, tn_width,
-                        tn_height, self.options['THUMBNAIL_QUALITY'],
-                        self.options['CONVERT_COMMAND'])
+                thumb_spec = '%sx%s@%s' % (tn_width, tn_height,
+                                           self.options['THUMBNAIL_QUALITY'])
+                if content and filestore.reuse_thumbnail(content, thumbnail,
+                                                         thumb_spec):
+                    tn_width, tn_height = content.tn_width, content.tn_height
+                else:
+                    try:
+                        tn_width, tn_height, deferred \
+                            = thumbnailer.make_thumbnail(self, filename,
+                                                         thumbnail, tn_width,
+                                                         tn_height)
+                    except thumbnailer.ThumbnailerBusy:
+                        os.unlink(filename)
+                        raise
+                    if deferred:
+                        # Only the placeholder exists for now.
+                        thumb_spec = ''
                 if not tn_width and tn_height:
                     thumbnail = ''
         else:
@@ -1514,24 +1695,42 @@ class Board(object):
                                          dirc='IMG_DIR', ext=None)
                               
 
-            # verify no name clash
-            if not os.path.exists(newfilename):
-                os.rename(filename,
-                          newfilename.encode(sys.getfilesystemencoding()))
-                if thumbnail == filename:
-                    thumbnail = newfilename 
-                filename = newfilename
-            else:
+            # verify no name clash; linking fails atomically if one exists
+            try:
+                filestore.ensure_dir(newfilename)
+                os.link(filename,
+                        newfilename.encode(sys.getfilesystemencoding()))
+            except OSError, e:
                 os.unlink(filename)
+                if e.errno != errno.EEXIST:
+                    raise WakaError(strings.NOTWRITE)
                 raise WakaError(strings.DUPENAME)
+            os.unlink(filename)
+            if thumbnail == filename:
+                thumbnail = newfilename 
+            filename = newfilename
 
         if self.options['ENABLE_LOAD']:
             # TODO, some day
             raise NotImplementedError('ENABLE_LOAD not implemented')
 
-        # Make file and thumbnail world-readable
+        # Count this post in the cross-board file registry.
+        if content:
+            filestore.retain_content(md5)
+        elif config.FILE_DEDUPE and width:
+            if not (thumb_spec and tn_width):
+                # Nothing generated that another post could reuse.
+                thumb_spec = ''
+            spool = filestore.get_spool(filestorage)
+            filestore.register_content(md5,
+                misc.get_filestorage_size(filestorage), filename, width,
+                height, thumbnail if thumb_spec else '', thumb_spec,
+                tn_width, tn_height, spool and spool.sha256)
+
+        # Make file and thumbnail world-readable. A deferred thumbnail is
+        # made so by its worker; until then there may be no file at all.
         os.chmod(filename, 0644)
-        if thumbnail:
+        if thumbnail and not deferred:
             os.chmod(thumbnail, 0644)
 
         # Clear out the board path name.
@@ -1545,15 +1744,15 @@ class Board(object):
                 height, thumbnail, tn_width, tn_height)
 
     def get_reply_link(self, reply, parent='', abbreviated=False,
-                       force_http=False):
+                       force_http=False, archive=False):
         if parent:
             return self.make_url(thread=parent, hash=reply, abbr=abbreviated,
-                force_http=force_http)
+                force_http=force_http, archive=archive)
         else:
             return self.make_url(thread=reply, abbr=abbreviated,
-                force_http=force_http)
+                force_http=force_http, archive=archive)
 
-    def expand_url(self, filename, force_http=False):
+    def expand_url(self, filename, force_http=False, archive=False):
         # TODO: mark this as deprecated?
 
         # Is the filename already expanded?
@@ -1562,6 +1761,8 @@ class Board(object):
             return filename
 
         self_path = self.url
+        if archive:
+            self_path = os.path.join(self_path, self.options['ARCHIVE_DIR'])
 
         if force_http:
             self_path = 'http://' + local.environ['SERVER_NAME'] + self_path
@@ -1593,11 +1794,12 @@ class Board(object):
 
     def sage_count(self, parent):
         session = model.Session()
-        sql = select([func.count()], 'parent=:parent AND '
-            'NOT (timestamp<:timestamp AND ip=:ip)', self.table).params(
-                parent=parent.num,
-                timestamp=parent.timestamp + self.options['NOSAGE_WINDOW'],
-                ip=parent.ip)
+        table = self.table
+        window = parent.timestamp + self.options['NOSAGE_WINDOW']
+        sql = select([func.count()],
+                     and_(table.c.parent == parent.num,
+                          not_(and_(table.c.timestamp < window,
+                                    table.c.ip == parent.ip))))
         row = session.execute(sql).fetchone()
         return row[0]
 
@@ -1610,14 +1812,13 @@ class Board(object):
         if max_age:
             mintime = time.time() - max_age * 3600
 
-            sql = table.select().where(and_(table.c.parent == 0,
-                                            table.c.timestamp <= mintime,
-                                            table.c.stickied == 0))
-            query = session.execute(sql)
+            sql = select([table.c.num], and_(table.c.parent == 0,
+                                             table.c.timestamp <= mintime,
+                                             table.c.stickied == 0))
+            expired = [row.num for row in session.execute(sql)]
 
-            for row in query:
-                self.delete_post(row.num, '', False,
-                                 self.options['ARCHIVE_MODE'], admin=True)
+            self.delete_posts(expired, '', False,
+                              self.options['ARCHIVE_MODE'], admin=True)
 
         # TODO: Implement other maxes (even though no one freakin' uses
         #       them). :3c
@@ -1740,7 +1941,8 @@ class Board(object):
 
             # enterprise command launching system
             # may send crap to stderr on failure
-            retval = os.system(self.options['PROXY_COMMAND'] + " %s" % ip)
+            with metrics.timed(metrics.SUBPROCESS):
+                retval = os.system(self.options['PROXY_COMMAND'] + " %s" % ip)
 
             sql = model.proxy.insert().values(ip=ip,
                 timestamp=timestamp, date=date)
@@ -1763,7 +1965,7 @@ class NoBoard(object):
         'DEFAULT_STYLE': 'futaba',
     }
 
-    def expand_url(self, url, force_http=False):
+    def expand_url(self, url, force_http=False, archive=False):
         return url
 
 # utility functions
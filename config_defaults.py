@@ -8,10 +8,14 @@ SQL_PROXY_TABLE = 'proxy'
 SQL_REPORT_TABLE = 'reports'
 SQL_BACKUP_TABLE = '__waka_backup'
 SQL_ACCOUNT_TABLE = 'staff_accounts'
+SQL_SESSION_TABLE = 'staff_sessions'
 SQL_STAFFLOG_TABLE = 'staff_activity'
 SQL_COMMON_SITE_TABLE = 'board_index'
 SQL_PASSPROMPT_TABLE = 'passprompt'
 SQL_PASSFAIL_TABLE = 'passfail'
+SQL_FILE_TABLE = 'file_registry'
+SQL_ARCHIVE_TABLE = 'archive_index'
+SQL_SEARCH_TABLE = 'search_index'
 USE_TEMPFILES = 1
 DATE_STYLE = 'futaba'
 ERRORLOG = ''
@@ -33,14 +37,50 @@ WAKARIMASEN_VERSION = '' # we should put something here
 ALTERNATE_REDIRECT = 0
 
 SPAM_FILES = ['spam.txt']
+TRIPCODE_CACHE_SIZE = 1000
 
+MAX_UPLOAD_KB = 0
+UPLOAD_SPOOL_DIR = ''
+UPLOAD_SHA256 = False
+NODE_ID = 0
+FILE_DEDUPE = 1
+FILE_STORE_DIR = 'filestore/'
+STORAGE_MIGRATION_BATCH = 500
+
+THUMBNAIL_CONCURRENCY = 2
+THUMBNAIL_QUEUE_SIZE = 20
+THUMBNAIL_QUEUE_TIMEOUT = 30
+THUMBNAIL_MEMORY_LIMIT = '256MiB'
+THUMBNAIL_MAP_LIMIT = '512MiB'
+THUMBNAIL_TIME_LIMIT = 60
+THUMBNAIL_DEFERRED = 0
+THUMBNAIL_PLACEHOLDER = ''
+THUMBNAIL_LOCK_DIR = ''
+
+FCGI_WORKERS = 0
 MAX_FCGI_LOOPS = 250
+FCGI_MAX_RSS_KB = 0
+
+REQUEST_METRICS = 0
+METRICS_LOG = ''
+METRICS_WINDOW = 3600
+QUERY_STATS = 0
+QUERY_FINGERPRINTS = 500
+SLOW_QUERY_MS = 0
+SLOW_QUERY_LOG = ''
+SLOW_QUERY_EXPLAIN = 0
 
 REPORT_COMMENT_MAX_LENGTH = 250
 REPORT_RENZOKU = 60
 
 REPORT_RETENTION = 60*24*3600
 STAFF_LOG_RETENTION = 60*24*3600
+STAFF_LOG_DEFERRED = 0
+PAGE_COUNT_TTL = 30
+PAGE_COUNT_CACHE_SIZE = 256
+MAINTENANCE_INTERVAL = 3600
+GLOBAL_SEARCH_THREADS = 8
+GLOBAL_SEARCH_PER_BOARD = 50
 
 PROXY_WHITE_AGE = 14*24*3600
 PROXY_BLACK_AGE = 14*24*3600
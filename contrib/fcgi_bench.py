@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+'''Measures request/response throughput of fcgi.py over a local socket:
+small pages, large pages and large uploads, each on one persistent
+connection. The responses are checked as they are read.
+
+Run from the wakarimasen directory:
+
+    python contrib/fcgi_bench.py [-n REQUESTS]
+'''
+
+import os
+import sys
+import time
+import signal
+import socket
+import struct
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import fcgi
+
+HEADER = struct.Struct(fcgi.FCGI_Header)
+
+# (name, response size, upload size)
+CASES = [
+    ('small page', 2048, 0),
+    ('large page', 1024 * 1024, 0),
+    ('large upload', 2048, 1024 * 1024),
+]
+
+def application(environ, start_response):
+    stdin = environ['wsgi.input']
+    uploaded = 0
+    while True:
+        data = stdin.read(65536)
+        if not data:
+            break
+        uploaded += len(data)
+    size = int(environ['QUERY_STRING'])
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('X-Uploaded', str(uploaded))])
+    # Pages come from templates in a single chunk.
+    return ['x' * size]
+
+def record(type, content=''):
+    padding = -len(content) & 7
+    return HEADER.pack(fcgi.FCGI_VERSION_1, type, 1, len(content),
+                       padding) + content + '\0' * padding
+
+def make_request(size, upload):
+    params = ''.join([fcgi.encode_pair(name, value) for (name, value) in (
+        ('REQUEST_METHOD', upload and 'POST' or 'GET'),
+        ('QUERY_STRING', str(size)),
+        ('CONTENT_LENGTH', str(upload)),
+        ('SERVER_NAME', 'localhost'),
+        ('SERVER_PORT', '80'),
+        ('SERVER_PROTOCOL', 'HTTP/1.1'))])
+    parts = [record(fcgi.FCGI_BEGIN_REQUEST,
+                    struct.pack(fcgi.FCGI_BeginRequestBody,
+                                fcgi.FCGI_RESPONDER, fcgi.FCGI_KEEP_CONN)),
+             record(fcgi.FCGI_PARAMS, params),
+             record(fcgi.FCGI_PARAMS)]
+    body = 'u' * upload
+    for pos in xrange(0, upload, 32768):
+        parts.append(record(fcgi.FCGI_STDIN, body[pos:pos + 32768]))
+    parts.append(record(fcgi.FCGI_STDIN))
+    return ''.join(parts)
+
+def recv_exactly(sock, length):
+    data = []
+    while length:
+        chunk = sock.recv(length)
+        if not chunk:
+            raise EOFError
+        data.append(chunk)
+        length -= len(chunk)
+    return ''.join(data)
+
+def read_response(sock):
+    stdout = []
+    while True:
+        (version, type, request_id, length, padding) \
+            = HEADER.unpack(recv_exactly(sock, HEADER.size))
+        content = recv_exactly(sock, length + padding)[:length]
+        if type == fcgi.FCGI_STDOUT:
+            stdout.append(content)
+        elif type == fcgi.FCGI_END_REQUEST:
+            return ''.join(stdout)
+
+def check(response, size, upload):
+    (head, body) = response.split('\r\n\r\n', 1)
+    if len(body) != size or 'X-Uploaded: %d' % upload not in head:
+        raise AssertionError('bad response: %r...' % response[:200])
+
+def serve(address):
+    fcgi.WSGIServer(application, bindAddress=address).run()
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--requests', type='int', default=2000)
+    (options, args) = parser.parse_args()
+
+    address = os.path.join(tempfile.mkdtemp(), 'fcgi.sock')
+    pid = os.fork()
+    if not pid:
+        os.close(sys.stdout.fileno())
+        serve(address)
+        os._exit(0)
+
+    try:
+        for i in xrange(100):
+            if os.path.exists(address):
+                break
+            time.sleep(0.05)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+
+        for (name, size, upload) in CASES:
+            request = make_request(size, upload)
+            # Large transfers get fewer rounds.
+            rounds = max(200, options.requests * 4096
+                             / max(4096, size + upload))
+            check(sock.sendall(request) or read_response(sock), size,
+                  upload)
+
+            start = time.time()
+            for i in xrange(rounds):
+                sock.sendall(request)
+                check(read_response(sock), size, upload)
+            elapsed = time.time() - start
+
+            print '%-14s %6d requests %8.3f s %9.1f req/s %8.1f MB/s' % \
+                (name, rounds, elapsed, rounds / elapsed,
+                 rounds * (size + upload) / elapsed / 1048576)
+        sock.close()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        try:
+            os.unlink(address)
+            os.rmdir(os.path.dirname(address))
+        except OSError:
+            pass
+
+if __name__ == '__main__':
+    main()
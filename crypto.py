@@ -2,73 +2,124 @@
 
 import struct
 
-def rc4(message, key, skip=256):
+M32 = 0xffffffff
+
+# Key schedules are memoized: the keys used in practice (SECRET, and the
+# derived tripcode key) are few and fixed, so each process computes their
+# schedules once. The caches are simply emptied when they fill up.
+SCHEDULE_CACHE_SIZE = 64
+
+_rc4_schedules = {}
+_rc6_schedules = {}
+
+_BLOCK = struct.Struct("<4L")
+
+def _remember(cache, key, value):
+    if len(cache) >= SCHEDULE_CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+    return value
+
+def _rc4_schedule(key, skip):
+    '''State of the RC4 generator after the key setup and the discarded
+    initial bytes, as (s, x, y).'''
     s = range(256)  #0..255
     k = [ord(x) for x in key]   #unpack 'C*'
-    message = [ord(x) for x in message]
-
-    def swap(x, y):
-        s[x], s[y] = s[y], s[x]
+    k = (k * (256 // len(k) + 1))[:256]
 
-    x = y = 0
+    y = 0
     for x in xrange(256):
-        y = (y + s[x] + k[x % len(k)]) % 256
-        swap(x, y)
+        sx = s[x]
+        y = (y + sx + k[x]) & 255
+        s[x] = s[y]
+        s[y] = sx
 
     x = y = 0
-    for x in xrange(skip):
-        x = (x + 1) % 256
-        y = (y + s[x]) % 256
-        swap(x, y)
+    for i in xrange(skip):
+        x = (x + 1) & 255
+        sx = s[x]
+        y = (y + sx) & 255
+        s[x] = s[y]
+        s[y] = sx
+
+    return (s, x, y)
 
+def rc4(message, key, skip=256):
+    try:
+        (s, x, y) = _rc4_schedules[key, skip]
+    except KeyError:
+        (s, x, y) = _remember(_rc4_schedules, (key, skip),
+                              _rc4_schedule(key, skip))
+    s = s[:]
+
+    message = bytearray(message)
     for i in xrange(len(message)):
-        x = (x + 1) % 256
-        y = (y + s[x]) % 256
-        swap(x, y)
-        message[i] = message[i] ^ s[(s[x] + s[y]) % 256]
+        x = (x + 1) & 255
+        sx = s[x]
+        y = (y + sx) & 255
+        sy = s[x] = s[y]
+        s[y] = sx
+        message[i] ^= s[(sx + sy) & 255]
 
-    return ''.join([chr(x) for x in message])
+    return str(message)
 
-class RC6(object):
-    def __init__(self, key):
-        self.state = S = []
-        key += "\0" * (4 - len(key) & 3) # pad key
+def _rc6_schedule(key):
+    key += "\0" * (4 - len(key) & 3) # pad key
 
-        L = list(struct.unpack("<%sL" % (len(key) / 4), key))
+    L = list(struct.unpack("<%sL" % (len(key) / 4), key))
 
-        S.append(0xb7e15163)
-        for i in range(43):
-            S.append(_add(S[i], 0x9e3779b9))
+    S = [0xb7e15163]
+    for i in xrange(43):
+        S.append((S[i] + 0x9e3779b9) & M32)
 
-        v = max(132, len(L) * 3)
+    v = max(132, len(L) * 3)
 
-        A = B = i = j = 0
+    A = B = i = j = 0
 
-        for n in range(v):
-            A = S[i] = _rol(_add(S[i], A, B), 3)
-            B = L[j] = _rol(_add(L[j] + A + B), _add(A + B))
-            i = (i + 1) % len(S)
-            j = (j + 1) % len(L)
+    for n in xrange(v):
+        A = (S[i] + A + B) & M32
+        A = S[i] = (A << 3 | A >> 29) & M32
+        r = (A + B) & 31
+        B = (L[j] + A + B) & M32
+        B = L[j] = (B << r | B >> 32 - r) & M32
+        i = (i + 1) % 44
+        j = (j + 1) % len(L)
+
+    return S
+
+class RC6(object):
+    def __init__(self, key):
+        try:
+            self.state = _rc6_schedules[key]
+        except KeyError:
+            self.state = _remember(_rc6_schedules, key, _rc6_schedule(key))
 
     def encrypt(self, block):
         S = self.state
-        A, B, C, D = struct.unpack("<4L", block.ljust(16, '\0'))
+        A, B, C, D = _BLOCK.unpack(block.ljust(16, '\0'))
 
-        B = _add(B, S[0])
-        D = _add(D, S[1])
+        B = (B + S[0]) & M32
+        D = (D + S[1]) & M32
 
-        for i in range(1, 21): # 1..20
-            t = _rol(_mul(B, _rol(B, 1) | 1), 5)
-            u = _rol(_mul(D, _rol(D, 1) | 1), 5)
-            A = _add(_rol(A ^ t, u), S[2 * i])
-            C = _add(_rol(C ^ u, t), S[2 * i + 1])
+        for i in xrange(2, 42, 2): # rounds 1..20
+            t = B * (B << 1 | B >> 31 | 1) & M32
+            t = (t << 5 | t >> 27) & M32
+            u = D * (D << 1 | D >> 31 | 1) & M32
+            u = (u << 5 | u >> 27) & M32
+
+            r = u & 31
+            A ^= t
+            A = ((A << r | A >> 32 - r) + S[i]) & M32
+            r = t & 31
+            C ^= u
+            C = ((C << r | C >> 32 - r) + S[i + 1]) & M32
 
             A, B, C, D = B, C, D, A
 
-        A = _add(A, S[42])
-        C = _add(C, S[43])
+        A = (A + S[42]) & M32
+        C = (C + S[43]) & M32
 
-        return struct.pack("<4L", A, B, C, D)
+        return _BLOCK.pack(A, B, C, D)
 
     def decrypt(self, block):
         S = self.state
@@ -104,4 +155,4 @@ def _ror(x, y): # rorororor
 
 def _mul(a, b):
     return (((a >> 16) * (b & 65535) + (b >> 16) * (a & 65535)) * 65536 +
-            (a & 65535) * (b & 65535)) % 4294967296 
+            (a & 65535) * (b & 65535)) % 4294967296
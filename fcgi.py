@@ -60,6 +60,7 @@ import select
 import socket
 import errno
 import traceback
+import time
 
 try:
     import thread
@@ -74,7 +75,7 @@ except ImportError:
 if not hasattr(socket, 'SHUT_WR'):
     socket.SHUT_WR = 1
 
-__all__ = ['WSGIServer']
+__all__ = ['WSGIServer', 'PreforkWSGIServer']
 
 # Constants from the spec.
 FCGI_LISTENSOCK_FILENO = 0
@@ -150,8 +151,9 @@ class InputStream(object):
         # See Server.
         self._shrinkThreshold = conn.server.inputStreamShrinkThreshold
 
-        self._buf = ''
-        self._bufList = []
+        # Received data is appended to one growing buffer, and read data
+        # is dropped from its front now and then.
+        self._buf = bytearray()
         self._pos = 0 # Current read position.
         self._avail = 0 # Number of bytes currently available.
 
@@ -160,12 +162,19 @@ class InputStream(object):
     def _shrinkBuffer(self):
         """Gets rid of already read data (since we can't rewind)."""
         if self._pos >= self._shrinkThreshold:
-            self._buf = self._buf[self._pos:]
+            del self._buf[:self._pos]
             self._avail -= self._pos
             self._pos = 0
 
             assert self._avail >= 0
 
+    def _take(self, newPos):
+        """Returns the data up to newPos, and moves past it."""
+        r = memoryview(self._buf)[self._pos:newPos].tobytes()
+        self._pos = newPos
+        self._shrinkBuffer()
+        return r
+
     def _waitForData(self):
         """Waits for more data to become available."""
         self._conn.process_input()
@@ -187,23 +196,12 @@ class InputStream(object):
             else:
                 newPos = self._pos + n
                 break
-        # Merge buffer list, if necessary.
-        if self._bufList:
-            self._buf += ''.join(self._bufList)
-            self._bufList = []
-        r = self._buf[self._pos:newPos]
-        self._pos = newPos
-        self._shrinkBuffer()
-        return r
+        return self._take(newPos)
 
     def readline(self, length=None):
         if self._pos == self._avail and self._eof:
             return ''
         while True:
-            # Unfortunately, we need to merge the buffer list early.
-            if self._bufList:
-                self._buf += ''.join(self._bufList)
-                self._bufList = []
             # Find newline.
             i = self._buf.find('\n', self._pos)
             if i < 0:
@@ -222,10 +220,7 @@ class InputStream(object):
         if length is not None:
             if self._pos + length < newPos:
                 newPos = self._pos + length
-        r = self._buf[self._pos:newPos]
-        self._pos = newPos
-        self._shrinkBuffer()
-        return r
+        return self._take(newPos)
 
     def readlines(self, sizehint=0):
         total = 0
@@ -252,7 +247,7 @@ class InputStream(object):
         if not data:
             self._eof = True
         else:
-            self._bufList.append(data)
+            self._buf += data
             self._avail += len(data)
 
 class MultiplexedInputStream(InputStream):
@@ -312,18 +307,17 @@ class OutputStream(object):
         self.dataWritten = False
         self.closed = False
 
-    def _write(self, data):
-        length = len(data)
-        while length:
-            toWrite = min(length, self._req.server.maxwrite - FCGI_HEADER_LEN)
-
-            rec = Record(self._type, self._req.requestId)
-            rec.contentLength = toWrite
-            rec.contentData = data[:toWrite]
-            self._conn.writeRecord(rec)
-
-            data = data[toWrite:]
-            length -= toWrite
+    def _write(self, pieces):
+        """
+        Sends the strings in pieces as one stream of Records, each as large
+        as maxwrite allows, with a single write to the socket.
+        """
+        # Record lengths are kept a multiple of 8: no padding but at
+        # the end.
+        maxContent = (self._req.server.maxwrite - FCGI_HEADER_LEN) & ~7
+        self._conn.writeBuffer(encode_records(self._type,
+                                              self._req.requestId,
+                                              pieces, maxContent))
 
     def write(self, data):
         assert not self.closed
@@ -336,18 +330,26 @@ class OutputStream(object):
         if self._buffered:
             self._bufList.append(data)
         else:
-            self._write(data)
+            self._write([data])
 
     def writelines(self, lines):
         assert not self.closed
 
-        for line in lines:
-            self.write(line)
+        lines = [line for line in lines if line]
+        if not lines:
+            return
+
+        self.dataWritten = True
+
+        if self._buffered:
+            self._bufList.extend(lines)
+        else:
+            self._write(lines)
 
     def flush(self):
         # Only need to flush if this OutputStream is actually buffered.
-        if self._buffered:
-            data = ''.join(self._bufList)
+        if self._buffered and self._bufList:
+            data = self._bufList
             self._bufList = []
             self._write(data)
 
@@ -356,8 +358,9 @@ class OutputStream(object):
         """Sends end-of-stream notification, if necessary."""
         if not self.closed and self.dataWritten:
             self.flush()
+            # Goes out along with the end of the request.
             rec = Record(self._type, self._req.requestId)
-            self._conn.writeRecord(rec)
+            self._conn.writeRecord(rec, defer=True)
             self.closed = True
 
 class TeeOutputStream(object):
@@ -448,6 +451,64 @@ def encode_pair(name, value):
 
     return s + name + value
     
+_Header = struct.Struct(FCGI_Header)
+
+# Largest record: header, content and padding.
+FCGI_MAX_RECORD_LEN = FCGI_HEADER_LEN + 0xffff + 0xff
+
+def _sendall(sock, data):
+    """
+    Writes data (a string or buffer) to a socket and does not return until
+    all the data is sent.
+    """
+    view = memoryview(data)
+    length = len(view)
+    pos = 0
+    while pos < length:
+        try:
+            pos += sock.send(view[pos:])
+        except socket.error, e:
+            if e[0] == errno.EAGAIN:
+                select.select([], [sock], [])
+                continue
+            else:
+                raise
+
+def encode_records(type, requestId, pieces, maxContent):
+    """
+    Encodes the concatenation of the strings in pieces as a stream of
+    Records of up to maxContent bytes each, in a single buffer.
+    """
+    total = sum(map(len, pieces))
+    lengths = [maxContent] * (total // maxContent)
+    if total % maxContent:
+        lengths.append(total % maxContent)
+
+    buf = bytearray(sum([FCGI_HEADER_LEN + length + (-length & 7)
+                         for length in lengths]))
+    view = memoryview(buf)
+
+    # Copy the pieces into place, record by record.
+    pieces = iter(pieces)
+    piece = memoryview('')
+    offset = 0
+    for length in lengths:
+        padding = -length & 7
+        _Header.pack_into(buf, offset, FCGI_VERSION_1, type, requestId,
+                          length, padding)
+        offset += FCGI_HEADER_LEN
+        end = offset + length
+        while offset < end:
+            if not len(piece):
+                piece = memoryview(pieces.next())
+                continue
+            n = min(len(piece), end - offset)
+            view[offset:offset + n] = piece[:n]
+            piece = piece[n:]
+            offset += n
+        offset += padding
+    return buf
+
 class Record(object):
     """
     A FastCGI Record.
@@ -462,101 +523,95 @@ class Record(object):
         self.paddingLength = 0
         self.contentData = ''
 
-    def _recvall(sock, length):
-        """
-        Attempts to receive length bytes from a socket, blocking if necessary.
-        (Socket may be blocking or non-blocking.)
-        """
-        dataList = []
-        recvLen = 0
-        while length:
-            try:
-                data = sock.recv(length)
-            except socket.error, e:
-                if e[0] == errno.EAGAIN:
-                    select.select([sock], [], [])
-                    continue
-                else:
-                    raise
-            if not data: # EOF
-                break
-            dataList.append(data)
-            dataLen = len(data)
-            recvLen += dataLen
-            length -= dataLen
-        return ''.join(dataList), recvLen
-    _recvall = staticmethod(_recvall)
-
-    def read(self, sock):
-        """Read and decode a Record from a socket."""
-        try:
-            header, length = self._recvall(sock, FCGI_HEADER_LEN)
-        except:
-            raise EOFError
-
-        if length < FCGI_HEADER_LEN:
-            raise EOFError
-        
-        self.version, self.type, self.requestId, self.contentLength, \
-                      self.paddingLength = struct.unpack(FCGI_Header, header)
+    def encode(self):
+        """Encode the Record, padding included."""
+        self.paddingLength = -self.contentLength & 7
 
-        if __debug__: _debug(9, 'read: fd = %d, type = %d, requestId = %d, '
+        if __debug__: _debug(9, 'encode: type = %d, requestId = %d, '
                              'contentLength = %d' %
-                             (sock.fileno(), self.type, self.requestId,
-                              self.contentLength))
-        
-        if self.contentLength:
-            try:
-                self.contentData, length = self._recvall(sock,
-                                                         self.contentLength)
-            except:
-                raise EOFError
+                             (self.type, self.requestId, self.contentLength))
 
-            if length < self.contentLength:
-                raise EOFError
+        return _Header.pack(self.version, self.type, self.requestId,
+                            self.contentLength, self.paddingLength) + \
+               self.contentData + '\x00' * self.paddingLength
 
-        if self.paddingLength:
-            try:
-                self._recvall(sock, self.paddingLength)
-            except:
-                raise EOFError
+    def write(self, sock):
+        """Encode and write a Record to a socket."""
+        _sendall(sock, self.encode())
 
-    def _sendall(sock, data):
+class RecordReader(object):
+    """
+    Reads Records from a socket through a preallocated buffer, which is
+    filled with recv_into() as far as the data available allows, so that
+    several Records usually arrive with a single call.
+    """
+    bufferSize = FCGI_MAX_RECORD_LEN + 8192
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._buf = bytearray(self.bufferSize)
+        self._view = memoryview(self._buf)
+        self._start = self._end = 0
+
+    def pending(self):
+        """Whether a complete Record is buffered."""
+        avail = self._end - self._start
+        if avail < FCGI_HEADER_LEN:
+            return False
+        version, type, requestId, contentLength, paddingLength = \
+                 _Header.unpack_from(self._buf, self._start)
+        return avail >= FCGI_HEADER_LEN + contentLength + paddingLength
+
+    def _fill(self, length):
         """
-        Writes data to a socket and does not return until all the data is sent.
+        Buffers at least length bytes past the read position, blocking if
+        necessary. (Socket may be blocking or non-blocking.) Raises
+        EOFError if the connection ends first.
         """
-        length = len(data)
-        while length:
+        if self._end - self._start >= length:
+            return
+        if self._start + length > self.bufferSize:
+            # Move the partial Record to the front. (Through a copy: the
+            # two ranges may overlap.)
+            self._view[:self._end - self._start] = \
+                self._view[self._start:self._end].tobytes()
+            self._end -= self._start
+            self._start = 0
+        while self._end - self._start < length:
             try:
-                sent = sock.send(data)
+                received = self._sock.recv_into(self._view[self._end:])
             except socket.error, e:
                 if e[0] == errno.EAGAIN:
-                    select.select([], [sock], [])
+                    select.select([self._sock], [], [])
                     continue
-                else:
-                    raise
-            data = data[sent:]
-            length -= sent
-    _sendall = staticmethod(_sendall)
+                raise EOFError
+            if not received:
+                raise EOFError
+            self._end += received
 
-    def write(self, sock):
-        """Encode and write a Record to a socket."""
-        self.paddingLength = -self.contentLength & 7
+    def read(self):
+        """Read and decode a Record."""
+        self._fill(FCGI_HEADER_LEN)
+        rec = Record()
+        rec.version, rec.type, rec.requestId, rec.contentLength, \
+                     rec.paddingLength = _Header.unpack_from(self._buf,
+                                                             self._start)
 
-        if __debug__: _debug(9, 'write: fd = %d, type = %d, requestId = %d, '
+        if __debug__: _debug(9, 'read: fd = %d, type = %d, requestId = %d, '
                              'contentLength = %d' %
-                             (sock.fileno(), self.type, self.requestId,
-                              self.contentLength))
-
-        header = struct.pack(FCGI_Header, self.version, self.type,
-                             self.requestId, self.contentLength,
-                             self.paddingLength)
-        self._sendall(sock, header)
-        if self.contentLength:
-            self._sendall(sock, self.contentData)
-        if self.paddingLength:
-            self._sendall(sock, '\x00'*self.paddingLength)
-            
+                             (self._sock.fileno(), rec.type, rec.requestId,
+                              rec.contentLength))
+
+        self._fill(FCGI_HEADER_LEN + rec.contentLength + rec.paddingLength)
+        start = self._start + FCGI_HEADER_LEN
+        if rec.contentLength:
+            rec.contentData = \
+                self._view[start:start + rec.contentLength].tobytes()
+        self._start = start + rec.contentLength + rec.paddingLength
+        if self._start == self._end:
+            self._start = self._end = 0
+        return rec
+
 class Request(object):
     """
     Represents a single FastCGI request.
@@ -643,6 +698,10 @@ class Connection(object):
         # Active Requests for this Connection, mapped by request ID.
         self._requests = {}
 
+        self._reader = RecordReader(sock)
+        # Encoded Records waiting to go out with the next write.
+        self._deferred = []
+
     def _cleanupSocket(self):
         """Close the Connection's socket."""
         try:
@@ -679,7 +738,7 @@ class Connection(object):
         # that it is no longer needed by closing the Connection's socket.
         # We need to put a timeout on select, otherwise we might get
         # stuck in it indefinitely... (I don't like this solution.)
-        while self._keepGoing:
+        while self._keepGoing and not self._reader.pending():
             try:
                 r, w, e = select.select([self._sock], [], [], 1.0)
             except ValueError:
@@ -689,8 +748,7 @@ class Connection(object):
             if r: break
         if not self._keepGoing:
             return
-        rec = Record()
-        rec.read(self._sock)
+        rec = self._reader.read()
 
         if rec.type == FCGI_GET_VALUES:
             self._do_get_values(rec)
@@ -710,11 +768,24 @@ class Connection(object):
             # Need to complain about this.
             pass
 
-    def writeRecord(self, rec):
+    def writeRecord(self, rec, defer=False):
         """
-        Write a Record to the socket.
+        Write a Record to the socket. With defer, the Record is held back
+        and sent along with the next one, to save a write.
         """
-        rec.write(self._sock)
+        if defer:
+            self._deferred.append(rec.encode())
+        else:
+            self.writeBuffer(rec.encode())
+
+    def writeBuffer(self, data):
+        """
+        Write encoded Records to the socket, after any deferred ones.
+        """
+        if self._deferred:
+            data = ''.join(self._deferred) + str(data)
+            self._deferred = []
+        _sendall(self._sock, data)
 
     def end_request(self, req, appStatus=0L,
                     protocolStatus=FCGI_REQUEST_COMPLETE, remove=True):
@@ -817,7 +888,7 @@ class Connection(object):
         outrec = Record(FCGI_UNKNOWN_TYPE)
         outrec.contentData = struct.pack(FCGI_UnknownTypeBody, inrec.type)
         outrec.contentLength = FCGI_UnknownTypeBody_LEN
-        self.writeRecord(rec)
+        self.writeRecord(outrec)
         
 class MultiplexedConnection(Connection):
     """
@@ -846,13 +917,19 @@ class MultiplexedConnection(Connection):
 
         super(MultiplexedConnection, self)._cleanupSocket()
         
-    def writeRecord(self, rec):
+    def writeRecord(self, rec, defer=False):
         # Must use locking to prevent intermingling of Records from different
         # threads.
         self._lock.acquire()
         try:
-            # Probably faster than calling super. ;)
-            rec.write(self._sock)
+            super(MultiplexedConnection, self).writeRecord(rec, defer)
+        finally:
+            self._lock.release()
+
+    def writeBuffer(self, data):
+        self._lock.acquire()
+        try:
+            super(MultiplexedConnection, self).writeBuffer(data)
         finally:
             self._lock.release()
 
@@ -1214,10 +1291,12 @@ class WSGIServer(Server):
         headers_sent = []
         result = None
 
-        def write(data):
+        def write(data, *more):
             assert type(data) is str, 'write() argument must be string'
             assert headers_set, 'write() before start_response()'
 
+            chunks = [data]
+            chunks.extend(more)
             if not headers_sent:
                 status, responseHeaders = headers_sent[:] = headers_set
                 found = False
@@ -1236,9 +1315,10 @@ class WSGIServer(Server):
                 for header in responseHeaders:
                     s += '%s: %s\r\n' % header
                 s += '\r\n'
-                req.stdout.write(s)
+                # The headers go out in the same Records as the body.
+                chunks.insert(0, s)
 
-            req.stdout.write(data)
+            req.stdout.writelines(chunks)
             req.stdout.flush()
 
         def start_response(status, response_headers, exc_info=None):
@@ -1271,9 +1351,15 @@ class WSGIServer(Server):
             try:
                 result = self.application(environ, start_response)
                 try:
-                    for data in result:
-                        if data:
-                            write(data)
+                    if type(result) in (list, tuple) and result and \
+                           headers_set and not headers_sent:
+                        # The whole body is at hand, so it can all be sent
+                        # at once.
+                        write(*result)
+                    else:
+                        for data in result:
+                            if data:
+                                write(data)
                     if not headers_sent:
                         write('') # in case body was empty
                 finally:
@@ -1307,6 +1393,200 @@ class WSGIServer(Server):
                                              (self.__class__.__name__, name))
                 environ[name] = default
             
+class PreforkWSGIServer(WSGIServer):
+    """
+    WSGIServer that serves requests from a pool of forked worker
+    processes, one request at a time each, instead of from threads of a
+    single process. This puts every core to use, and a worker that leaks
+    memory or crashes takes only itself down.
+
+    The master process sets up the listening socket, forks the workers
+    and replaces each one that exits. A worker exits after maxRequests
+    requests, or once its peak resident memory exceeds maxRSS kilobytes
+    (0 disables either limit).
+
+    childInit, if present, is called in each worker right after the fork,
+    to reinitialize state that must not be shared between processes,
+    such as database connections and random number generators.
+    """
+    # Seconds the master waits for workers to finish their requests on
+    # shutdown, before killing them.
+    shutdownTimeout = 10
+
+    # Workers exiting sooner than this after being forked are considered
+    # to be crashing on startup; their replacement is delayed.
+    minChildLifetime = 1.0
+
+    def __init__(self, application, workers=4, maxRequests=0, maxRSS=0,
+                 childInit=None, **kw):
+        kw['multithreaded'] = False
+        super(PreforkWSGIServer, self).__init__(application, **kw)
+
+        self._workers = workers
+        self._maxRequests = maxRequests
+        self._maxRSS = maxRSS
+        self._childInit = childInit
+        self._children = {}
+        self._requestCount = 0
+
+        # Each worker handles a single connection at a time.
+        self._connectionClass = Connection
+        self.capability = {
+            FCGI_MAX_CONNS: workers,
+            FCGI_MAX_REQS: workers,
+            FCGI_MPXS_CONNS: 0
+            }
+
+    def run(self, timeout=1.0):
+        """
+        The master's loop: keeps the pool full until SIGHUP, SIGINT or
+        SIGTERM, then stops the workers. Returns True if SIGHUP was
+        received, False otherwise.
+        """
+        sock = self._setupSocket()
+        # Workers wait on the socket together; whichever loses the race
+        # for a connection must not block in accept().
+        sock.setblocking(0)
+
+        self._keepGoing = True
+        self._hupReceived = False
+        self._installSignalHandlers()
+
+        try:
+            while self._keepGoing:
+                while self._keepGoing and \
+                          len(self._children) < self._workers:
+                    self._spawnChild(sock, timeout)
+
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e[0] in (errno.EINTR, errno.ECHILD):
+                        continue
+                    raise
+
+                started = self._children.pop(pid, None)
+                if started is None:
+                    continue
+                if status and self._keepGoing:
+                    sys.stderr.write('%s: worker %d exited with status %d\n'
+                                     % (self.__class__.__name__, pid,
+                                        status))
+                    if time.time() - started < self.minChildLifetime:
+                        time.sleep(self.minChildLifetime)
+        finally:
+            self._stopChildren()
+            self._restoreSignalHandlers()
+            self._cleanupSocket(sock)
+
+        return self._hupReceived
+
+    def _spawnChild(self, sock, timeout):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = time.time()
+            return
+
+        # In the worker.
+        status = 0
+        try:
+            self._children = {}
+            self._keepGoing = True
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, self._intHandler)
+            if self._childInit is not None:
+                self._childInit()
+            self._childLoop(sock, timeout)
+        except:
+            traceback.print_exc(file=sys.stderr)
+            status = 1
+        sys.stderr.flush()
+        os._exit(status)
+
+    def _childLoop(self, sock, timeout):
+        web_server_addrs = os.environ.get('FCGI_WEB_SERVER_ADDRS')
+        if web_server_addrs is not None:
+            web_server_addrs = map(lambda x: x.strip(),
+                                   web_server_addrs.split(','))
+
+        while self._keepGoing and not self._spent():
+            try:
+                r, w, e = select.select([sock], [], [], timeout)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            if not r:
+                continue
+
+            try:
+                clientSock, addr = sock.accept()
+            except socket.error, e:
+                if e[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise
+            clientSock.setblocking(1)
+
+            if web_server_addrs and \
+                   (len(addr) != 2 or addr[0] not in web_server_addrs):
+                clientSock.close()
+                continue
+
+            conn = self._connectionClass(clientSock, addr, self)
+            conn.run()
+
+    def _spent(self):
+        """Whether this worker has reached its request or memory limit."""
+        if self._maxRequests and self._requestCount >= self._maxRequests:
+            return True
+        if self._maxRSS:
+            import resource
+            # Kilobytes on Linux.
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if rss > self._maxRSS:
+                return True
+        return False
+
+    def handler(self, req):
+        try:
+            return super(PreforkWSGIServer, self).handler(req)
+        finally:
+            self._requestCount += 1
+            if self._spent() or not self._keepGoing:
+                # Have the web server close the connection, so the worker
+                # can exit after this request.
+                req.flags &= ~FCGI_KEEP_CONN
+
+    def _stopChildren(self):
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        deadline = time.time() + self.shutdownTimeout
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e[0] == errno.EINTR:
+                    continue
+                if e[0] != errno.ECHILD:
+                    raise
+                break
+            if pid:
+                self._children.pop(pid, None)
+            elif time.time() < deadline:
+                time.sleep(0.1)
+            else:
+                for pid in self._children:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                deadline = time.time() + self.shutdownTimeout
+
 if __name__ == '__main__':
     def test_app(environ, start_response):
         """Probably not the most efficient example."""
@@ -0,0 +1,406 @@
+'''Upload ingestion and on-disk storage of posted files.'''
+
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+import itertools
+import threading
+
+import werkzeug
+from sqlalchemy.sql import select
+
+import config, config_defaults
+import model
+import strings
+from util import WakaError, local
+
+class UploadTooLarge(WakaError):
+    '''Raised while the request body is still streaming in, as soon as an
+    upload crosses the size ceiling.'''
+    def __init__(self, message=strings.TOOBIG):
+        WakaError.__init__(self, message)
+
+class HashingSpool(object):
+    '''File-like object handed to werkzeug's form parser for file fields.
+
+    Bytes are written straight to a temporary file while the MD5 (and,
+    optionally, SHA-256) digests and the size are updated incrementally,
+    so the upload never has to be traversed again to be checked. The spooled
+    file is then moved in place with land() instead of being copied.'''
+
+    def __init__(self, limit=0, spool_dir=None, sha256=False):
+        spool_dir = spool_dir or config.UPLOAD_SPOOL_DIR or None
+        fd, self.name = tempfile.mkstemp(prefix='upload', dir=spool_dir)
+        self._file = os.fdopen(fd, 'w+b')
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256() if sha256 else None
+        self.limit = limit
+        self.size = 0
+        self.landed = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit and self.size > self.limit:
+            self.discard()
+            raise UploadTooLarge()
+
+        self._md5.update(data)
+        if self._sha256:
+            self._sha256.update(data)
+        self._file.write(data)
+
+    @property
+    def md5(self):
+        return self._md5.hexdigest()
+
+    @property
+    def sha256(self):
+        if self._sha256:
+            return self._sha256.hexdigest()
+
+    # Read-side file interface, used by misc.analyze_image() et al.
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self):
+        return self._file.flush()
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def land(self, filename):
+        '''Move the spooled data to filename. A rename is tried first; the
+        data is only copied when the spool lives on another filesystem.'''
+
+        self._file.flush()
+        try:
+            os.rename(self.name, filename)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise IOError(e.errno, e.strerror, filename)
+            self._file.seek(0)
+            with open(filename, 'wb') as dest:
+                shutil.copyfileobj(self._file, dest)
+            os.unlink(self.name)
+
+        # Keep the (renamed) descriptor open for reading.
+        self.name = filename
+        self.landed = True
+        self._file.seek(0)
+
+    def discard(self):
+        '''Remove the spooled file unless it was landed.'''
+        if not self._file.closed:
+            self._file.close()
+        if not self.landed and os.path.exists(self.name):
+            os.unlink(self.name)
+
+    def close(self):
+        self.discard()
+
+    def __del__(self):
+        try:
+            self.discard()
+        except (OSError, AttributeError):
+            pass
+
+class UploadRequest(werkzeug.BaseRequest):
+    '''Request class whose file fields are ingested through HashingSpool.'''
+
+    @property
+    def max_upload_size(self):
+        return config.MAX_UPLOAD_KB * 1024
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return HashingSpool(limit=self.max_upload_size,
+                            sha256=config.UPLOAD_SHA256)
+
+def get_spool(filestorage):
+    '''Return the HashingSpool behind a werkzeug FileStorage, if any.'''
+    stream = filestorage.stream
+    if isinstance(stream, HashingSpool):
+        return stream
+
+def save_upload(filestorage, filename):
+    '''Store an uploaded file at filename, landing the spool in place when
+    the upload was ingested by UploadRequest.'''
+    spool = get_spool(filestorage)
+    if spool is not None:
+        spool.land(filename)
+    else:
+        filestorage.save(filename)
+
+def get_upload_md5(filestorage):
+    spool = get_spool(filestorage)
+    if spool is not None:
+        return spool.md5
+
+    md5h = hashlib.md5()
+    filestorage.stream.seek(0)
+    while True:
+        buffer = filestorage.stream.read(16 * 1024)
+        if not buffer:
+            break
+        md5h.update(buffer)
+    return md5h.hexdigest()
+
+# Storage layout. With STORAGE_SHARDS set, files are spread over levels of
+# two-hex-digit subdirectories of IMG_DIR and THUMB_DIR named after a hash of
+# the file name, e.g. src/3f/a2/1352412345123000.jpg, so no directory grows
+# to millions of entries.
+
+def shard_dirs(name, levels):
+    '''List of subdirectories a file called name is stored in.'''
+    if not levels:
+        return []
+    base = os.path.splitext(os.path.basename(name))[0]
+    if isinstance(base, unicode):
+        base = base.encode('utf-8')
+    digest = hashlib.md5(base).hexdigest()
+    return [digest[2*i:2*i+2] for i in xrange(min(levels, 16))]
+
+def ensure_dir(filename):
+    '''Create the directory filename goes in, if it does not exist yet.'''
+    try:
+        os.makedirs(os.path.dirname(filename), 0755)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _relocate(board, path, dirc):
+    '''Return where path (relative to the board) belongs in the board's
+    current layout, or None if it is already there or is not stored
+    under dirc.'''
+    if not path or not path.startswith(board.options[dirc]):
+        return None
+    new_path = board.make_path(os.path.basename(path), dirc=dirc, ext=None)
+    new_path = new_path.replace(board.path, '').lstrip('/')
+    if new_path != path:
+        return new_path
+
+def migrate_layout(board, batch_size=None):
+    '''Move a board's images and thumbnails to the layout selected by its
+    STORAGE_SHARDS option, rewriting the stored paths batch by batch.
+
+    Files are linked to their new location before the posts are updated,
+    and the old names are only removed once every page has been rebuilt,
+    so the board stays fully browsable during the migration.'''
+
+    batch_size = batch_size or config.STORAGE_MIGRATION_BATCH
+    session = model.Session()
+    table = board.table
+    stale = []
+    last = 0
+
+    while True:
+        sql = select([table.c.num, table.c.image, table.c.thumbnail],
+                     table.c.num > last).order_by(table.c.num.asc())\
+                    .limit(batch_size)
+        rows = session.execute(sql).fetchall()
+        if not rows:
+            break
+        last = rows[-1].num
+
+        for row in rows:
+            values = {}
+            for (column, dirc) in (('image', 'IMG_DIR'),
+                                   ('thumbnail', 'THUMB_DIR')):
+                path = row[column]
+                if column == 'thumbnail' and path == row.image:
+                    # Unthumbnailed image: follows the image.
+                    if 'image' in values:
+                        values[column] = values['image']
+                    continue
+
+                new_path = _relocate(board, path, dirc)
+                if not new_path:
+                    continue
+                src = os.path.join(board.path, path)
+                dest = os.path.join(board.path, new_path)
+                if not os.path.exists(src):
+                    continue
+                ensure_dir(dest)
+                if not os.path.exists(dest):
+                    os.link(src, dest)
+                values[column] = new_path
+                stale.append((src, os.path.join(board.path,
+                                                board.options[dirc], '')))
+
+            if values:
+                session.execute(table.update()
+                                     .where(table.c.num == row.num)
+                                     .values(**values))
+        session.commit()
+
+    # Pages still point at the old names until they are rebuilt.
+    board.rebuild_cache()
+
+    for (src, root) in stale:
+        if os.path.exists(src):
+            os.unlink(src)
+        # Prune shard directories emptied by the move.
+        directory = os.path.dirname(src)
+        while directory.startswith(root):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    return len(stale)
+
+# Upload names. A name is a millisecond timestamp followed by the node id and
+# a per-process sequence number, and is reserved with an O_EXCL create, so
+# concurrent uploads on one or several nodes sharing storage never end up
+# with the same src/ (and, through the "s" suffix, thumb/) path.
+
+_sequence = itertools.count()
+_sequence_lock = threading.Lock()
+
+def _next_sequence():
+    with _sequence_lock:
+        return _sequence.next() % 1000
+
+def allocate_upload_name(board, timestamp, ext, suffix=''):
+    '''Reserve a unique file in board's IMG_DIR. Returns the base name
+    (for deriving the thumbnail name) and the full path of the file.'''
+    timebase = '%d' % (timestamp * 1000)
+    while True:
+        filebase = '%s%02d%03d' % (timebase, config.NODE_ID,
+                                   _next_sequence())
+        filename = board.make_path(filebase, dirc='IMG_DIR', ext=ext) \
+                   + suffix
+        ensure_dir(filename)
+        try:
+            fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                         0644)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            os.close(fd)
+            return (filebase, filename)
+
+# Content-addressed file registry. Identical uploads, on any board, are
+# hardlinks of one stored copy; the registry keeps a reference count so the
+# stored copy is dropped once no post links to it anymore.
+
+def get_store_path(relative=''):
+    return os.path.join(local.environ['DOCUMENT_ROOT'], config.BOARD_DIR,
+                        config.FILE_STORE_DIR, relative)
+
+def _link(src, dest):
+    '''Hardlink src to dest, atomically replacing dest if it exists.'''
+    tempname = dest + '.link'
+    os.link(src, tempname)
+    os.rename(tempname, dest)
+
+def find_content(md5, size):
+    '''Return the registry row for md5, if its stored copy is usable.'''
+    session = model.Session()
+    table = model.files
+    row = session.execute(table.select().where(table.c.md5 == md5))\
+                 .fetchone()
+    if row and row.size == size \
+            and os.path.exists(get_store_path(row.image)):
+        return row
+
+def reuse_content(row, filename):
+    '''Replace the freshly stored upload at filename by a link to the stored
+    copy of the same content. Returns False if linking is impossible.'''
+    try:
+        _link(get_store_path(row.image), filename)
+    except OSError:
+        return False
+    return True
+
+def reuse_thumbnail(row, thumbnail, thumb_spec):
+    if not row.thumbnail or row.thumb_spec != thumb_spec:
+        return False
+    try:
+        _link(get_store_path(row.thumbnail), thumbnail)
+    except OSError:
+        return False
+    return True
+
+def retain_content(md5):
+    session = model.Session()
+    table = model.files
+    session.execute(table.update().where(table.c.md5 == md5)
+                         .values(refcount=table.c.refcount + 1))
+
+def register_content(md5, size, filename, width, height, thumbnail='',
+                     thumb_spec='', tn_width=0, tn_height=0, sha256=None):
+    '''Add a newly stored file (and its thumbnail, if one was generated for
+    it) to the registry by linking them into the file store. An entry for
+    md5 whose stored copy was unusable is pointed at the new one; one that
+    another upload of the same content registered meanwhile is retained.'''
+    ext = os.path.splitext(filename)[1]
+    image = os.path.join(md5[:2], md5 + ext)
+
+    try:
+        store_dir = get_store_path(md5[:2])
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir, 0755)
+        _link(filename, get_store_path(image))
+
+        stored_thumb = None
+        if thumbnail:
+            stored_thumb = os.path.join(md5[:2], md5 + 's'
+                                        + os.path.splitext(thumbnail)[1])
+            _link(thumbnail, get_store_path(stored_thumb))
+    except OSError:
+        # Not on the same filesystem, or no hardlink support. Nothing to
+        # deduplicate against, then.
+        return
+
+    session = model.Session()
+    table = model.files
+    values = dict(sha256=sha256, size=size, image=image, width=width,
+                  height=height, thumbnail=stored_thumb,
+                  thumb_spec=thumb_spec, tn_width=tn_width,
+                  tn_height=tn_height)
+    # The posts linked to the previous copy keep their references.
+    result = session.execute(table.update().where(table.c.md5 == md5)
+                                  .values(refcount=table.c.refcount + 1,
+                                          **values))
+    if result.rowcount:
+        return
+    try:
+        session.execute(table.insert().values(md5=md5, refcount=1, **values))
+    except model.IntegrityError:
+        # Registered by a concurrent upload; its copy has the same data.
+        retain_content(md5)
+
+def release_content(md5):
+    '''Drop one reference to md5, removing the stored copy along with the
+    last one. Posts keep their own links to the data either way.'''
+    if not md5:
+        return
+
+    session = model.Session()
+    table = model.files
+    row = session.execute(table.select().where(table.c.md5 == md5))\
+                 .fetchone()
+    if not row:
+        return
+
+    if row.refcount > 1:
+        session.execute(table.update().where(table.c.md5 == md5)
+                             .values(refcount=table.c.refcount - 1))
+        return
+
+    for stored in (row.image, row.thumbnail):
+        if stored and os.path.exists(get_store_path(stored)):
+            os.unlink(get_store_path(stored))
+    session.execute(table.delete().where(table.c.md5 == md5))
@@ -3,12 +3,18 @@ e.g., transferring and merging threads.'''
 
 import time
 import re
+import random
 import os
 import sys
+import errno
+import fcntl
+import hashlib
+import tempfile
 import traceback
 from datetime import datetime
 from calendar import timegm
 from subprocess import Popen
+from multiprocessing.pool import ThreadPool
 
 import config
 import strings
@@ -18,10 +24,13 @@ import model
 import util
 import str_format
 import misc
+import filestore
+import search
 from template import Template
 from util import WakaError, local
 
-from sqlalchemy.sql import or_, and_, select
+from sqlalchemy import Text, type_coerce
+from sqlalchemy.sql import or_, and_, select, bindparam
 
 # Common Site Table!
 
@@ -64,6 +73,8 @@ def remove_board_from_index(board_name):
 # Board looping (andwich pattern).
 
 def loop_thru_boards(board_obj_task, exc_msg, *args, **kwargs):
+    '''Run a Board method on each of the given boards, or on all of them.
+    Returns (board name, result) pairs of the boards it succeeded on.'''
     try:
         boards = kwargs.pop('boards')
     except KeyError:
@@ -72,16 +83,18 @@ def loop_thru_boards(board_obj_task, exc_msg, *args, **kwargs):
     if not boards:
         boards = [x['board_entry'] for x in get_all_boards()]
 
+    results = []
     for board_str in boards:
         try:
             board_obj = board.Board(board_str)
             local.environ['waka.board'] = board_obj
-            getattr(board_obj, board_obj_task)(*args, **kwargs)
-            board_obj.rebuild_cache()
+            results.append((board_str,
+                getattr(board_obj, board_obj_task)(*args, **kwargs)))
         except:
             if exc_msg:
                 sys.stderr.write(exc_msg % board_str + '\n')
                 traceback.print_exc(file=sys.stderr)
+    return results
 
 # Global rebuilding
 
@@ -103,8 +116,8 @@ def global_cache_rebuild_proxy(task_data):
 
 # Global post management.
 
-def process_global_delete_by_ip(ip, boards):
-    loop_thru_boards(
+def process_global_delete_by_ip(ip, boards, username=None, staff_ip=None):
+    results = loop_thru_boards(
         'delete_by_ip',
         'Error in deleting posts from %s in %%s' % ip,
         task_data = None,
@@ -112,8 +125,228 @@ def process_global_delete_by_ip(ip, boards):
         boards = boards
     )
 
+    if not username:
+        return
+
+    # The request that started this worker only logged the address, as the
+    # posts are deleted here.
+    timestamp = time.time()
+    date = misc.make_date(timestamp, style=config.DATE_STYLE)
+    info = []
+    total_posts = total_threads = 0
+    for (name, (removed, threads)) in results:
+        info.append('%d posts, %d threads removed from /%s/'
+                    % (removed, threads, name))
+        total_posts += removed
+        total_threads += threads
+    info.append('%d posts, %d threads removed from %d of %d boards'
+                % (total_posts, total_threads, len(results), len(boards)))
+
+    rows = [dict(username=username,
+                 ip=misc.dot_to_dec(staff_ip),
+                 action='delete_by_ip_global',
+                 info=line,
+                 date=date,
+                 timestamp=timestamp,
+                 admin_id=None)
+            for line in info]
+    model.Session().execute(model.activity.insert(), rows)
+
+# Global post search.
+
+GLOBAL_SEARCH_TYPES = ('ip', 'text', 'author', 'md5')
+
+def _global_search_query(board_obj, search_type, text, ip_block):
+    table = board_obj.table
+    if search_type == 'ip':
+        sql = table.select().where(model.ip_in_range(table.c.ip, *ip_block))
+    elif search_type == 'md5':
+        sql = table.select().where(table.c.md5 == text.lower())
+    elif search_type == 'text':
+        sql = search.select_matching(board_obj, search.COMMENT, text)
+        if sql is None:
+            sql = table.select().where(table.c.comment.like('%'+text+'%'))
+    else:
+        sql = search.select_matching(board_obj, search.AUTHOR, text)
+        if sql is None:
+            sql = table.select().where(or_(table.c.name.like('%'+text+'%'),
+                                           table.c.trip.like('%'+text+'%')))
+    return sql.order_by(table.c.timestamp.desc())\
+              .limit(config.GLOBAL_SEARCH_PER_BOARD)
+
+def global_search(user, search_type, text, failed):
+    '''Search the posts of every board the user moderates. The boards are
+    queried at the same time, one worker thread (and database connection)
+    each, so the search takes about as long as the slowest board rather
+    than the sum of all of them.
+
+    Returns an iterator of (board, post) pairs, newest first, with at most
+    GLOBAL_SEARCH_PER_BOARD posts from each board. The queries are already
+    running when this returns; iterating waits for them. Names of boards
+    whose query failed are appended to failed.'''
+
+    if search_type not in GLOBAL_SEARCH_TYPES:
+        raise WakaError('Unknown search type.')
+    text = (text or '').strip()
+    if not text:
+        raise WakaError('Please enter something to search for.')
+    ip_block = None
+    if search_type == 'ip':
+        try:
+            ip_block = misc.parse_ip_block(text)
+        except ValueError:
+            raise WakaError('Please enter a valid IP.')
+
+    if user.account == staff.MODERATOR:
+        names = user.reign
+    else:
+        names = [x['board_entry'] for x in get_all_boards()]
+    boards = []
+    for name in names:
+        try:
+            boards.append(board.Board(name))
+        except board.BoardNotFound:
+            failed.append(name)
+    if not boards:
+        return iter([])
+
+    # The worker threads have their own, empty environ. Hand them the parts
+    # of the request's that time and log their statements.
+    environ = dict((key, local.environ[key])
+                   for key in ('waka.timer', 'waka.task', 'waka.boardname')
+                   if key in local.environ)
+
+    def search_board(board_obj):
+        local.environ = environ
+        session = model.Session()
+        try:
+            sql = _global_search_query(board_obj, search_type, text,
+                                       ip_block)
+            return [dict(row.items()) for row in session.execute(sql)]
+        except:
+            sys.stderr.write('Error in global search of %s\n'
+                             % board_obj.name)
+            traceback.print_exc(file=sys.stderr)
+            return None
+        finally:
+            model.Session.remove()
+            local.environ = {}
+
+    pool = ThreadPool(max(1, min(len(boards),
+                                 config.GLOBAL_SEARCH_THREADS)))
+    pending = pool.map_async(search_board, boards)
+    pool.close()
+
+    def merged_results():
+        results = []
+        for (board_obj, posts) in zip(boards, pending.get()):
+            if posts is None:
+                failed.append(board_obj.name)
+                continue
+            results.extend((board_obj, post) for post in posts)
+        pool.join()
+        results.sort(key=lambda result: result[1]['timestamp'],
+                     reverse=True)
+        for result in results:
+            yield result
+
+    return merged_results()
+
 # Bans and Whitelists
 
+def _ban_block(ip, mask):
+    '''Parse the address and netmask (or prefix length) of an IP ban or
+    whitelist entry. Returns the address and the mask as integers, followed
+    by the first and last address of the block.'''
+    ival1 = misc.dot_to_dec(ip.strip())
+    if not isinstance(ival1, (int, long)):
+        raise WakaError('Please enter a valid IP.')
+
+    try:
+        ival2 = misc.netmask(ival1, mask)
+        (ip_start, ip_end) = misc.ip_range(ival1, ival2)
+    except ValueError:
+        raise WakaError('Please enter a valid netmask.')
+
+    return (ival1, ival2, ip_start, ip_end)
+
+def fill_ban_ranges():
+    '''Compute the address ranges of IP entries added before they were
+    stored.'''
+    session = model.Session()
+    table = model.admin
+    sql = select([table.c.num, table.c.ival1, table.c.ival2],
+                 and_(table.c.type.in_(('ipban', 'whitelist')),
+                      table.c.ip_start == None))
+    for row in session.execute(sql).fetchall():
+        try:
+            ival1 = misc.legacy_ip(long(row.ival1))
+            (ip_start, ip_end) = misc.ip_range(ival1, long(row.ival2))
+        except (TypeError, ValueError):
+            continue
+        session.execute(table.update().where(table.c.num == row.num)
+                             .values(ip_start=ip_start, ip_end=ip_end))
+    session.commit()
+
+def migrate_ips(batch_size=None):
+    '''Rewrite addresses stored in the decimal format of older versions in
+    the format of model.IPAddress, batch by batch. Run when the database is
+    first opened after an upgrade; if that is interrupted, running the
+    migrate_ips command resumes it. Until it is done, old posts are missed
+    by lookups such as flood checks and delete-by-IP. Returns the number of
+    values converted.'''
+
+    batch_size = batch_size or config.STORAGE_MIGRATION_BATCH
+    session = model.Session()
+    tables = []
+    for row in get_all_boards():
+        try:
+            tables.append(board.Board(row['board_entry']).table)
+        except board.BoardNotFound:
+            pass
+    tables += [model.backup, model.report, model.activity, model.admin]
+    converted = 0
+
+    for table in tables:
+        columns = [column for column in table.columns
+                   if isinstance(column.type, model.IPAddress)]
+        raw = [type_coerce(column, Text).label(column.name)
+               for column in columns]
+        last = 0
+
+        while True:
+            sql = select([table.c.num] + raw, table.c.num > last)\
+                    .order_by(table.c.num.asc()).limit(batch_size)
+            rows = session.execute(sql).fetchall()
+            if not rows:
+                break
+            last = rows[-1].num
+
+            for column in columns:
+                values = []
+                for row in rows:
+                    value = row[column.name]
+                    if not value or len(value) == 32:
+                        continue
+                    try:
+                        value = misc.legacy_ip(long(value))
+                    except ValueError:
+                        value = misc.dot_to_dec(value)
+                        if not isinstance(value, (int, long)):
+                            continue
+                    values.append({'_num': row.num, '_ip': value})
+
+                if values:
+                    sql = table.update()\
+                               .where(table.c.num == bindparam('_num'))\
+                               .values({column.name: bindparam('_ip',
+                                            type_=column.type)})
+                    session.execute(sql, values)
+                    converted += len(values)
+            session.commit()
+
+    return converted
+
 def add_admin_entry(task_data, option, comment, ip='', mask='255.255.255.255',
                     sval1='', total='', expiration=0,
                     caller=''):
@@ -121,6 +354,7 @@ def add_admin_entry(task_data, option, comment, ip='', mask='255.255.255.255',
     table = model.admin
 
     ival1 = ival2 = 0
+    ip_start = ip_end = None
 
     if not comment:
         raise WakaError(strings.COMMENT_A_MUST)
@@ -129,19 +363,15 @@ def add_admin_entry(task_data, option, comment, ip='', mask='255.255.255.255',
             raise WakaError('IP address required.')
         if not mask:
             mask = '255.255.255.255'
-        # Convert to decimal.
-        (ival1, ival2) = (misc.dot_to_dec(ip), misc.dot_to_dec(mask))
-        sql = table.select().where(table.c.type == option)
-        query = session.execute(sql)
+        (ival1, ival2, ip_start, ip_end) = _ban_block(ip, mask)
+        sql = table.select().where(and_(table.c.type == option,
+                                        table.c.ip_start == ip_start,
+                                        table.c.ip_end == ip_end))
+        row = session.execute(sql).fetchone()
 
-        for row in query:
-            try:
-                if int(row.ival1) & int(row.ival2) == ival1 & ival2:
-                    raise WakaError('IP address and mask match ban #%d.' % \
-                                    (row.num))
-            except ValueError:
-                raise WakaError("Entry #%s on ban table is inconsistent. "
-                    "This shouldn't happen." % row.num)
+        if row:
+            raise WakaError('IP address and mask match ban #%d.' % \
+                            (row.num))
         # Add info to task data.
         content = ip + (' (' + mask + ')' if mask else '')
 
@@ -169,8 +399,10 @@ def add_admin_entry(task_data, option, comment, ip='', mask='255.255.255.255',
     if expiration:
         expiration = expiration + time.time()
 
-    sql = table.insert().values(type=option, comment=comment, ival1=int(ival1),
-                                ival2=int(ival2), sval1=sval1, total=total,
+    sql = table.insert().values(type=option, comment=comment,
+                                ival1=str(ival1), ival2=str(ival2),
+                                ip_start=ip_start, ip_end=ip_end,
+                                sval1=sval1, total=total,
                                 expiration=expiration)
     result = session.execute(sql)
 
@@ -236,22 +468,21 @@ def remove_old_backups():
     table = model.backup
     sql = table.select().where(table.c.timestampofarchival.op('+')\
                                (config.POST_BACKUP_EXPIRE) <= time.time())
-    query = session.execute(sql)
+    query = session.execute(sql).fetchall()
 
     for row in query:
         board_obj = board.Board(row['board_name'])
-        backup_path = os.path.join(board_obj.path,
-                                   board_obj.options['ARCHIVE_DIR'],
-                                   board_obj.options['BACKUP_DIR'], '')
         if row.image:
             # Delete backup image; then, mark post for deletion.
-            filename = os.path.join(backup_path, os.path.basename(row.image))
+            filename = board_obj.make_backup_path(row.image)
             if os.path.exists(filename):
                 os.unlink(filename)
+            # The backup held the post's reference to the stored copy.
+            if config.FILE_DEDUPE:
+                filestore.release_content(row.md5)
         if row.thumbnail \
                 and re.match(board_obj.options['THUMB_DIR'], row.thumbnail):
-            filename = os.path.join(backup_path,
-                                    os.path.basename(row.thumbnail))
+            filename = board_obj.make_backup_path(row.thumbnail)
             if os.path.exists(filename):
                 os.unlink(filename)
 
@@ -318,8 +549,8 @@ def ban_check(numip, name, subject, comment):
 
     # IP Banned?
     sql = table.select().where(and_(table.c.type == 'ipban',
-                                    table.c.ival1.op('&')(table.c.ival2) \
-                                        == table.c.ival2.op('&')(numip)))
+                                    table.c.ip_start <= numip,
+                                    table.c.ip_end >= numip))
     ip_row = session.execute(sql).fetchone()
 
     if ip_row:
@@ -425,15 +656,18 @@ def edit_admin_entry(task_data, num, comment='', ival1=None,
             expiration = timegm(expiration.utctimetuple())
         else:
             expiration = 0
-        ival1 = misc.dot_to_dec(ival1)
-        ival2 = misc.dot_to_dec(ival2)
         task_data.contents.append(ival1 + ' (' + ival2 + ')')
+        (ival1, ival2, ip_start, ip_end) = _ban_block(ival1, ival2)
+        ival1 = str(ival1)
+        ival2 = str(ival2)
     else:
         expiration = 0
+        ip_start = ip_end = None
         task_data.contents.append(sval1)
 
     sql = table.update().where(table.c.num == num)\
                .values(comment=comment, ival1=ival1, ival2=ival2, sval1=sval1,
+                       ip_start=ip_start, ip_end=ip_end,
                        total=total, expiration=expiration)
     row = session.execute(sql)
 
@@ -452,6 +686,8 @@ def delete_by_ip(task_data, ip, mask='255.255.255.255'):
         [sys.executable, sys.argv[0], 'delete_by_ip',
         ip,
         ','.join(reign),
+        user.username,
+        user.login_data.addr,
         local.environ['DOCUMENT_ROOT'],
         local.environ['SCRIPT_NAME'],
         local.environ['SERVER_NAME']]
@@ -475,6 +711,59 @@ def trim_reported_posts(date=0):
         sql = table.delete().where(table.c.timestamp <= mintime)
         session.execute(sql)
 
+# Time before which this process need not look at the maintenance stamp.
+_next_maintenance = 0
+
+def _maintenance_stamp():
+    # One per database, shared by the processes of the host.
+    key = hashlib.md5(config.SQL_ENGINE).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), 'waka-maintenance-%s' % key)
+
+def scheduled_maintenance(force=False):
+    '''Housekeeping that need not happen on every request. Runs at most
+    once every MAINTENANCE_INTERVAL seconds on each host, unless forced by
+    the maintenance command. The time of the last run is kept in a stamp
+    file, which is locked while the run is decided and made.'''
+    global _next_maintenance
+
+    now = time.time()
+    if force:
+        trim_activity()
+        trim_reported_posts()
+        return
+    if now < _next_maintenance:
+        return
+
+    fd = os.open(_maintenance_stamp(), os.O_CREAT | os.O_RDWR, 0600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            # Another process is running it.
+            _next_maintenance = now + config.MAINTENANCE_INTERVAL
+            return
+
+        try:
+            last = float(os.read(fd, 32) or 0)
+        except ValueError:
+            last = 0
+        if now - last < config.MAINTENANCE_INTERVAL:
+            _next_maintenance = last + config.MAINTENANCE_INTERVAL
+            return
+        _next_maintenance = now + config.MAINTENANCE_INTERVAL
+
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, '%d' % now)
+
+        trim_activity()
+        trim_reported_posts()
+    finally:
+        # Closing the file unlocks it.
+        os.close(fd)
+
 def trim_activity():
     mintime = time.time() - config.STAFF_LOG_RETENTION
     session = model.Session()
@@ -520,75 +809,115 @@ def move_thread(task_data, parent, src_brd_obj, dest_brd_obj):
     elif row[0]:
         # Automatically correct if reply instead of thread was given.
         parent = row[0]
+    parent = int(parent)
 
-    sql = src_table.select().where(or_(src_table.c.num == parent,
-                                       src_table.c.parent == parent))\
-                            .order_by(src_table.c.num.asc())
-    thread = [dict(x.items()) for x in session.execute(sql).fetchall()]
+    in_thread = or_(src_table.c.num == parent, src_table.c.parent == parent)
+    sql = src_table.select().where(in_thread).order_by(src_table.c.num.asc())
+    thread = session.execute(sql).fetchall()
 
-    # Indicate OP post number after insertion.
-    new_parent = 0
+    # List of (source, destination) images/thumbs to move around.
+    file_move = []
 
-    # List of images/thumbs to move around.
-    image_move = []
-    thumb_move = []
+    # Files are stored where the destination board's layout puts them.
+    def relocate(filename, dir_type):
+        dest_filename = dest_brd_obj.make_path(os.path.basename(filename),
+                                               dirc=dir_type, ext=None)
+        file_move.append((os.path.join(src_brd_obj.path, filename),
+                          dest_filename))
+        return dest_filename.replace(dest_brd_obj.path, '').lstrip('/')
 
-    lasthit = time.time()
-
-    # DB operations
+    files = {}
     for post in thread:
-        # Grab post contents as dictionary of updates. Remove primary key.
-        del post['num']
+        image = post.image
+        thumbnail = post.thumbnail
+        new_image = new_thumbnail = None
+        if image:
+            new_image = relocate(image, 'IMG_DIR')
+        if thumbnail == image:
+            new_thumbnail = new_image
+        elif thumbnail and re.match(src_brd_obj.options['THUMB_DIR'],
+                                    thumbnail):
+            new_thumbnail = relocate(thumbnail, 'THUMB_DIR')
+        files[post.num] = (new_image, new_thumbnail)
+
+    # Links to posts of the thread, as stored in comments by
+    # str_format.format_comment().
+    link_re = re.compile(r'<a href="%s(\d+)%s(?:#(\d+))?" '
+                         r'onclick="highlight\((\d+)\)">&gt;&gt;(\d+)</a>'
+        % (re.escape(os.path.join(src_brd_obj.url,
+                                  src_brd_obj.options['RES_DIR'], '')),
+           re.escape('.' + config.PAGE_EXT.lstrip('.'))))
+
+    # Reserve the destination numbers through the board's auto-increment,
+    # as new posts are numbered: one placeholder row per post, inserted in
+    # one batch and found again by a parent no thread has.
+    marker = -random.randint(1, 0x7fffffff)
+    session.execute(dest_table.insert(), [{'parent': marker}] * len(thread))
+    sql = select([dest_table.c.num], dest_table.c.parent == marker)\
+            .order_by(dest_table.c.num.asc())
+    reserved = [row.num for row in session.execute(sql)]
+    session.execute(dest_table.delete(dest_table.c.parent == marker))
+    numbers = dict(zip([post.num for post in thread], reserved))
+    new_parent = numbers[parent]
+
+    def rewrite_link(match):
+        num = int(match.group(4))
+        if int(match.group(1)) != parent or num not in numbers:
+            return match.group(0)
+        num = numbers[num]
+        return '<a href="%s" onclick="highlight(%d)">&gt;&gt;%d</a>' \
+            % (dest_brd_obj.get_reply_link(num,
+                   new_parent if num != new_parent else ''), num, num)
 
-        post['lasthit'] = lasthit
-        image = post['image']
-        thumbnail = post['thumbnail']
+    lasthit = time.time()
+    rows = []
+    for post in thread:
+        values = dict(post.items())
+        values['num'] = numbers[post.num]
+        values['parent'] = new_parent if post.parent else 0
+        values['lasthit'] = lasthit
+        if post.comment:
+            values['comment'] = link_re.sub(rewrite_link, post.comment)
+        new_image, new_thumbnail = files[post.num]
+        if new_image is not None:
+            values['image'] = new_image
+        if new_thumbnail is not None:
+            values['thumbnail'] = new_thumbnail
+        rows.append(values)
+
+    # Link the files in place first; nothing is lost if this fails.
+    linked = []
+    def unlink_all():
+        for filename in linked:
+            os.unlink(filename)
+    try:
+        for (src_filename, dest_filename) in file_move:
+            filestore.ensure_dir(dest_filename)
+            os.link(src_filename, dest_filename)
+            linked.append(dest_filename)
+    except OSError, e:
+        unlink_all()
+        raise WakaError('Could not move thread files: %s' % e)
 
-        if image:
-            image_move.append(image)
-        if re.match(src_brd_obj.options['THUMB_DIR'], thumbnail):
-            thumb_move.append(thumbnail)
-
-        # Update post reference links.
-        if new_parent:
-            post['parent'] = new_parent
-
-            new_comment = re.sub(r'a href="(.*?)'
-                + os.path.join(src_brd_obj.path,
-                               src_brd_obj.options['RES_DIR'],
-                               '%d%s' % (int(parent)), config.PAGE_EXT),
-                r'a href="\1' + os.path.join(\
-                               dest_brd_obj.path,
-                               dest_brd_obj.options['RES_DIR'],
-                               '%d%s' % (int((new_parent), config.PAGE_EXT))),
-                post['comment'])
-
-            post['comment'] = new_comment
-
-        sql = dest_table.insert().values(**post)
-        result = session.execute(sql)
-
-        if not new_parent:
-            new_parent = result.inserted_primary_key[0]
-
-    # Nested associate for moving files in bulk.
-    def rename_files(filename_list, dir_type):
-        for filename in filename_list:
-            src_filename = os.path.join(src_brd_obj.path, filename)
-            dest_filename = re.sub('^/?' + src_brd_obj.options[dir_type],
-                                   dest_brd_obj.options[dir_type],
-                                   filename)
-            dest_filename = os.path.join(dest_brd_obj.path, dest_filename)
-            os.rename(src_filename, dest_filename)
-
-    # File transfer operations.
-    rename_files(image_move, 'IMG_DIR')
-    rename_files(thumb_move, 'THUMB_DIR')
+    try:
+        session.execute(dest_table.insert(), rows)
+    except:
+        unlink_all()
+        raise
+
+    # The posts and files now belong to the destination board. (The
+    # file registry reference count carries over with them.)
+    search.remove_posts(src_brd_obj, numbers.keys())
+    search.index_posts(dest_brd_obj, rows)
+    session.execute(src_table.delete(in_thread))
+    for (src_filename, dest_filename) in file_move:
+        os.unlink(src_filename)
 
     dest_brd_obj.build_cache()
     dest_brd_obj.build_thread_cache(new_parent)
 
-    src_brd_obj.delete_stuff([parent], '', False, False, caller='internal')
+    src_brd_obj.delete_thread_cache(parent)
+    src_brd_obj.build_cache()
 
     forward_url = misc.make_script_url(task='mpanel',
         board=dest_brd_obj.name, page=('t%s' % new_parent))
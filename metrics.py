@@ -0,0 +1,261 @@
+'''Per-request timing, enabled with REQUEST_METRICS.
+
+A request records its wall time and the time spent in SQL statements,
+template rendering, subprocesses and lock waits. When it is done, the
+totals are written as a JSON line to METRICS_LOG and added to the
+histograms of its task, which are kept in memory by each process for the
+last one to two METRICS_WINDOW periods.
+
+Statements run by the worker threads of a global search count towards the
+request that started them. As they run side by side, the SQL time of such
+a request may exceed its wall time.
+
+When disabled, nothing is hooked into the database engine and timed()
+blocks cost one dictionary lookup.'''
+
+import os
+import sys
+import time
+import json
+import threading
+
+from sqlalchemy import event
+
+import config, config_defaults
+import model
+from util import local
+
+SQL = 'sql'
+TEMPLATE = 'template'
+SUBPROCESS = 'subprocess'
+LOCK = 'lock'
+CATEGORIES = (SQL, TEMPLATE, SUBPROCESS, LOCK)
+
+# Upper bounds of the histogram buckets, in milliseconds. Longer requests
+# go to a last, unbounded bucket.
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Histograms of at most this many tasks are kept, as task names come from
+# the query string. Requests of further tasks are counted together.
+MAX_TASKS = 100
+OTHER_TASKS = '(other)'
+
+class RequestTimer(object):
+    '''Counts and durations of the timed operations of one request, which
+    may be added to from several threads.'''
+
+    def __init__(self):
+        self.start = time.time()
+        self.counts = dict.fromkeys(CATEGORIES, 0)
+        self.seconds = dict.fromkeys(CATEGORIES, 0.0)
+        self._lock = threading.Lock()
+
+    def add(self, category, seconds):
+        with self._lock:
+            self.counts[category] += 1
+            self.seconds[category] += seconds
+
+class _Timed(object):
+    __slots__ = ('timer', 'category', 'start')
+
+    def __init__(self, timer, category):
+        self.timer = timer
+        self.category = category
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, type, value, traceback):
+        self.timer.add(self.category, time.time() - self.start)
+
+class _NotTimed(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_not_timed = _NotTimed()
+
+def timed(category):
+    '''Context manager adding the time spent in its block to the current
+    request. Does nothing outside of timed requests.'''
+    timer = local.environ.get('waka.timer')
+    if timer is None:
+        return _not_timed
+    return _Timed(timer, category)
+
+def bucket_index(bounds, value):
+    '''Index of the histogram bucket of value, given the upper bounds of
+    all but the last bucket.'''
+    bucket = 0
+    while bucket < len(bounds) and value > bounds[bucket]:
+        bucket += 1
+    return bucket
+
+def percentile(bounds, counts, fraction, largest):
+    '''Upper bound of the histogram bucket holding the given fraction of
+    the values counted, or largest if it is smaller.'''
+    seen = 0
+    total = sum(counts)
+    for (bound, count) in zip(bounds, counts):
+        seen += count
+        if seen >= fraction * total:
+            return min(bound, largest)
+    return largest
+
+class _Period(object):
+    def __init__(self, start):
+        self.start = start
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.requests = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.counts = dict.fromkeys(CATEGORIES, 0)
+        self.category_seconds = dict.fromkeys(CATEGORIES, 0.0)
+
+class Histogram(object):
+    '''Request durations of a task in the current and the previous
+    METRICS_WINDOW period.'''
+
+    def __init__(self):
+        self.current = _Period(time.time())
+        self.previous = None
+        self._lock = threading.Lock()
+
+    def _rotate(self, now):
+        window = config.METRICS_WINDOW
+        if now - self.current.start >= window:
+            if now - self.current.start < 2 * window:
+                self.previous = self.current
+            else:
+                self.previous = None
+            self.current = _Period(now)
+
+    def add(self, wall, timer):
+        bucket = bucket_index(BUCKETS, wall * 1000)
+        with self._lock:
+            self._rotate(time.time())
+            period = self.current
+            period.buckets[bucket] += 1
+            period.requests += 1
+            period.seconds += wall
+            period.max = max(period.max, wall)
+            for category in CATEGORIES:
+                period.counts[category] += timer.counts[category]
+                period.category_seconds[category] += timer.seconds[category]
+
+    def summary(self):
+        '''Dictionary of the totals over both periods, for templating.
+        Times are in milliseconds.'''
+        with self._lock:
+            self._rotate(time.time())
+            periods = [self.current]
+            if self.previous:
+                periods.append(self.previous)
+
+            buckets = [sum(counts) for counts
+                       in zip(*[period.buckets for period in periods])]
+            requests = sum(period.requests for period in periods)
+            seconds = sum(period.seconds for period in periods)
+            slowest = max(period.max for period in periods)
+            since = periods[-1].start
+            categories = dict((category, {
+                'count': sum(period.counts[category] for period in periods),
+                'ms': sum(period.category_seconds[category]
+                          for period in periods) * 1000})
+                for category in CATEGORIES)
+
+        per_request = float(max(requests, 1))
+        return {'requests': requests,
+                'since': since,
+                'mean': seconds * 1000 / per_request,
+                'p50': percentile(BUCKETS, buckets, .5, slowest * 1000),
+                'p95': percentile(BUCKETS, buckets, .95, slowest * 1000),
+                'max': slowest * 1000,
+                'buckets': buckets,
+                'categories': dict((category, {
+                    'count': values['count'] / per_request,
+                    'ms': values['ms'] / per_request})
+                    for (category, values) in categories.iteritems())}
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+def get_histogram(task):
+    try:
+        return _histograms[task]
+    except KeyError:
+        pass
+    with _histograms_lock:
+        if task not in _histograms and len(_histograms) >= MAX_TASKS:
+            task = OTHER_TASKS
+        return _histograms.setdefault(task, Histogram())
+
+def summaries():
+    '''List of (task, summary dictionary) pairs of this process, busiest
+    task first.'''
+    with _histograms_lock:
+        items = _histograms.items()
+    rows = [(task, histogram.summary()) for (task, histogram) in items]
+    rows = [row for row in rows if row[1]['requests']]
+    rows.sort(key=lambda row: -row[1]['requests'])
+    return rows
+
+_log_fds = {}
+
+def write_line(path, line):
+    '''Append a line to the log file at path, or to the error log of the
+    current request if path is empty.'''
+    if not path:
+        local.environ.get('wsgi.errors', sys.stderr).write(line)
+        return
+    # One write() per line keeps lines from different processes apart.
+    fd = _log_fds.get(path)
+    if fd is None:
+        fd = _log_fds.setdefault(path, os.open(path,
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644))
+    os.write(fd, line)
+
+def begin(environ):
+    '''Start timing the request of environ, if enabled.'''
+    if config.REQUEST_METRICS:
+        environ['waka.timer'] = RequestTimer()
+
+def finish(environ):
+    '''Log and record the request of environ, if it was timed.'''
+    timer = environ.pop('waka.timer', None)
+    if timer is None:
+        return
+    wall = time.time() - timer.start
+    task = (environ.get('waka.task') or '').lower()
+
+    entry = {'time': int(timer.start),
+             'pid': os.getpid(),
+             'task': task,
+             'board': environ.get('waka.boardname', ''),
+             'wall_ms': round(wall * 1000, 2)}
+    for category in CATEGORIES:
+        entry['%s_count' % category] = timer.counts[category]
+        entry['%s_ms' % category] = round(timer.seconds[category] * 1000, 2)
+    write_line(config.METRICS_LOG, json.dumps(entry, sort_keys=True) + '\n')
+
+    get_histogram(task).add(wall, timer)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info['waka.query_start'] = time.time()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    timer = local.environ.get('waka.timer')
+    if timer is not None:
+        timer.add(SQL, time.time() - conn.info['waka.query_start'])
+
+def install():
+    '''Time the statements run through model.engine, if enabled.'''
+    if config.REQUEST_METRICS:
+        event.listen(model.engine, 'before_cursor_execute',
+                     _before_cursor_execute)
+        event.listen(model.engine, 'after_cursor_execute',
+                     _after_cursor_execute)
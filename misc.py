@@ -3,7 +3,11 @@ import os
 import re
 import time
 import crypt
+import binascii
+import hashlib
 import struct
+import socket
+import threading
 import strings
 from subprocess import Popen, PIPE
 
@@ -14,21 +18,98 @@ import str_format
 import urllib
 from util import local
 
+# Addresses are integers: IPv4 ones below IPV4_LIMIT, IPv6 ones above it
+# (IPv4-mapped IPv6 addresses count as IPv4). The database stores IPv4 ones
+# in the IPv4-mapped block, which IPv6 blocks must therefore not overlap.
+IPV4_LIMIT = 1 << 32
+IPV4_MAPPED = (0xffff << 32, (0xffff << 32) | 0xffffffff)
+
 def dot_to_dec(ip):
     try:
+        if ':' in ip:
+            high, low = struct.unpack('>QQ',
+                socket.inet_pton(socket.AF_INET6, ip))
+            numip = (high << 64) | low
+            if numip >> 32 == 0xffff:
+                numip &= 0xffffffff
+            return numip
         parts = [int(x) for x in ip.split(".")]
         return struct.unpack('>L', struct.pack('>4B', *parts))[0]
-    except ValueError:
+    except (ValueError, struct.error, socket.error):
         return ip
 
+def ip_range(ip, mask):
+    '''First and last address of the block ip/mask, as integers. The mask
+    may also be given as a prefix length. Raises ValueError if an IPv6
+    block would take in IPv4 addresses.'''
+    bits = 32 if ip < IPV4_LIMIT else 128
+    full = (1 << bits) - 1
+    if mask <= bits:
+        mask = full ^ (full >> mask)
+    start = ip & mask
+    end = start | (full & ~mask)
+    if bits == 128 and (start < IPV4_LIMIT or
+            (start <= IPV4_MAPPED[1] and end >= IPV4_MAPPED[0])):
+        raise ValueError(mask)
+    return (start, end)
+
+def netmask(ip, mask):
+    '''Netmask of the block of address ip (an integer) given by mask: a
+    prefix length, a netmask, or nothing for ip alone. The IPv4 host mask,
+    which the staff forms default to, stands for a single address of either
+    family. IPv6 blocks need a prefix length or an IPv6 netmask. Raises
+    ValueError if mask is invalid.'''
+    bits = 32 if ip < IPV4_LIMIT else 128
+    full = (1 << bits) - 1
+    mask = str(mask).strip()
+    if not mask:
+        return full
+    if mask.isdigit() and int(mask) <= bits:
+        return full ^ (full >> int(mask))
+    if mask.isdigit():
+        mask = int(mask)
+    else:
+        mask = dot_to_dec(mask)
+    if not isinstance(mask, (int, long)) or mask > full:
+        raise ValueError(mask)
+    if mask == 0xffffffff:
+        return full
+    if bits == 128 and mask < IPV4_LIMIT:
+        raise ValueError(mask)
+    return mask
+
+def parse_ip_block(text):
+    '''Parse "address", "address/prefix" or "address/mask" into the first
+    and last address of the block. Raises ValueError if it is no address.'''
+    if '/' in text:
+        ip, mask = text.split('/', 1)
+    else:
+        ip, mask = text, ''
+    ip = dot_to_dec(ip.strip())
+    if not isinstance(ip, (int, long)):
+        raise ValueError(text)
+    return ip_range(ip, netmask(ip, mask))
+
+def legacy_ip(numip):
+    '''Address held by a decimal value of an older database. Those written
+    with Perl's 'N' packing format hold IPv4 addresses in the low 4 bytes
+    of a 64-bit integer; real IPv6 addresses (and IPv4-mapped ones) are
+    returned as they are.'''
+    if IPV4_LIMIT <= numip < 1 << 64 and numip >> 32 != 0xffff:
+        return numip & 0xffffffff
+    return numip
+
 def dec_to_dot(numip):
     try:
-        # Parse 64-bit integer for compatibility with database written
-        # with Perl's 'N' packing format.
-        parts = struct.unpack('>8B', struct.pack('>Q', long(numip)))
-        return '.'.join([str(x) for x in parts[4:8]])
-    except ValueError:
+        numip = legacy_ip(long(numip))
+    except (ValueError, TypeError):
+        return numip
+    if numip < 0:
         return numip
+    if numip < IPV4_LIMIT:
+        return socket.inet_ntoa(struct.pack('>L', numip))
+    return socket.inet_ntop(socket.AF_INET6,
+        struct.pack('>QQ', numip >> 64, numip & 0xffffffffffffffff))
 
 def is_whitelisted(numip):
     return False
@@ -37,18 +118,50 @@ TRIP_RE = '^(.*?)((?<!&)#|%s)(.*)$'
 SECURE_TRIP_RE = '(?:%s)(?<!&#)(?:%s)*(.*)$'
 SALT_CLEAN_RE = re.compile('[^\.-z]')
 
+# Tripcodes are deterministic, and the same few keys are used over and over,
+# so generated trips are kept in an LRU cache. It is keyed by a hash of the
+# tripcode key rather than the key itself.
+tripcode_cache = util.LRUCache(config.TRIPCODE_CACHE_SIZE,
+                                name='Tripcodes')
+_trip_res = {}
+_secure_trip_res = {}
+
+def _trip_re(tripkey):
+    try:
+        return _trip_res[tripkey]
+    except KeyError:
+        return _trip_res.setdefault(tripkey,
+            re.compile(TRIP_RE % re.escape(tripkey)))
+
+def _secure_trip_re(marker):
+    try:
+        return _secure_trip_res[marker]
+    except KeyError:
+        return _secure_trip_res.setdefault(marker,
+            re.compile(SECURE_TRIP_RE.replace("%s", re.escape(marker))))
+
 def process_tripcode(name, tripkey='!'):
-    match = re.match(TRIP_RE % re.escape(tripkey), name)
+    match = _trip_re(tripkey).match(name)
     if not match:
         return (str_format.clean_string(str_format.decode_string(name)), '')
 
-    trip = ''
     namepart, marker, trippart = match.groups()
     namepart = str_format.clean_string(str_format.decode_string(namepart))
 
+    cache_key = hashlib.sha1(repr((tripkey, marker, trippart))).digest()
+    trip = tripcode_cache.get(cache_key)
+    if trip is None:
+        trip = make_tripcode(tripkey, marker, trippart)
+        tripcode_cache.set(cache_key, trip)
+
+    return (namepart, trip)
+
+def make_tripcode(tripkey, marker, trippart):
+    trip = ''
+
     # do we want secure trips, and is there one?
     if config.SECRET:
-        regexp = re.compile(SECURE_TRIP_RE.replace("%s", re.escape(marker)))
+        regexp = _secure_trip_re(marker)
         smatch = regexp.match(trippart)
         if smatch:
             trippart = regexp.sub('', trippart)
@@ -58,7 +171,7 @@ def process_tripcode(name, tripkey='!'):
                 config.SECRET, True)
 
             if not trippart: # return directly if there's no normal tripcode
-                return (namepart, trip)
+                return trip
 
     # 2ch trips are processed as Shift_JIS whenever possible
     trippart = trippart.encode("shiftjis", "xmlcharrefreplace")
@@ -68,9 +181,7 @@ def process_tripcode(name, tripkey='!'):
     salt = SALT_CLEAN_RE.sub('.', salt)
     for old, new in map(None, ':;<=>?@[\\]^_`', 'ABCDEFGabcdef'):
         salt = salt.replace(old, new)
-    trip = tripkey + crypt.crypt(trippart, salt)[-10:] + trip
-
-    return (namepart, trip)
+    return tripkey + crypt.crypt(trippart, salt)[-10:] + trip
 
 def make_key(key, secret, length):
     return crypto.rc4('\0' * length, key + secret)
@@ -83,12 +194,8 @@ def hide_data(data, bytes, key, secret, base64=False):
 
 def hide_critical_data(string, key):
     rc6 = crypto.RC6(key)
-    ret = ''
-    i = 0
-    while i < len(string):
-        ret += rc6.encrypt(string[i:i+15]).encode("base64")[:-1]
-        i += 15
-    return ret
+    return ''.join([binascii.b2a_base64(rc6.encrypt(string[i:i+15]))[:-1]
+                    for i in xrange(0, len(string), 15)])
 
 def compile_spam_checker(spam_files):
     # TODO caching this by timestamps would be nice
@@ -236,6 +343,11 @@ def make_script_url(**kwargs):
     return url
 
 def get_filestorage_size(filestorage):
+    # Spooled uploads already know their size (see filestore.HashingSpool).
+    size = getattr(filestorage.stream, 'size', None)
+    if size is not None:
+        return size
+
     filestorage.stream.seek(0, 2)
     size = filestorage.stream.tell()
     filestorage.stream.seek(0, 0)
@@ -314,17 +426,46 @@ def analyze_gif(file):
         return
     return (width, height)
 
+def get_convert_limits():
+    '''ImageMagick resource limits for a single thumbnailing job.'''
+    limits = []
+    for resource, value in (('memory', config.THUMBNAIL_MEMORY_LIMIT),
+                            ('map', config.THUMBNAIL_MAP_LIMIT),
+                            ('time', config.THUMBNAIL_TIME_LIMIT)):
+        if value:
+            limits.extend(['-limit', resource, str(value)])
+    return limits
+
+def wait_process(process, timeout):
+    '''Wait for a subprocess, killing it once timeout seconds are up.'''
+    if not timeout:
+        return process.wait()
+
+    def kill():
+        if process.poll() is None:
+            process.kill()
+
+    # A timer thread rather than an alarm, which only the main thread may
+    # set.
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        return process.wait()
+    finally:
+        timer.cancel()
+
 def make_thumbnail(filename, thumbnail, width, height, quality, convert):
     is_animated = False
     magickname = filename
     convert = convert or 'convert' # lol
-    popen_array = [convert, '-resize', '%sx%s!' % (width, height),
+    popen_array = [convert] + get_convert_limits() + \
+                  ['-resize', '%sx%s!' % (width, height),
                    '-quality', str(quality)]
 
     if magickname.endswith(".gif"):
         identify = config.IDENTIFY_COMMAND
         gif_check = Popen([identify, '-format', '%n', magickname],
-                          stdout=PIPE).communicate()[0]
+                          stdout=PIPE, close_fds=True).communicate()[0]
         try:
             if int(gif_check) > 1:
                 magickname += '[0]'
@@ -342,9 +483,12 @@ def make_thumbnail(filename, thumbnail, width, height, quality, convert):
         height += 15
     else:
         popen_array.extend([magickname, thumbnail])
-    process = Popen(popen_array)
+    # No lock files (see thumbnailer) are passed on to convert.
+    process = Popen(popen_array, close_fds=True)
 
-    if process.wait() == 0 and os.path.exists(thumbnail) and \
+    # The time limit above is advisory; make sure it is enforced.
+    timeout = config.THUMBNAIL_TIME_LIMIT and config.THUMBNAIL_TIME_LIMIT + 5
+    if wait_process(process, timeout) == 0 and os.path.exists(thumbnail) and \
            os.path.getsize(thumbnail) != 0:
         return width, height
     elif os.path.exists(thumbnail):
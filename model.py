@@ -1,9 +1,17 @@
+import time
+import json
+import base64
+import hashlib
+
 import config, config_defaults
-from sqlalchemy import create_engine
-from sqlalchemy import Table, Column, Integer, Text, String, MetaData
+import util
+import strings
+from sqlalchemy import create_engine, inspect
+from sqlalchemy import Table, Column, Index, Integer, Text, String, MetaData
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.exc import OperationalError
-from sqlalchemy.sql import func
+from sqlalchemy.exc import OperationalError, IntegrityError, DontWrapMixin
+from sqlalchemy.sql import func, select, and_, or_
 
 pool_opts = {}
 
@@ -31,9 +39,13 @@ class CompactPost(object):
         'lastedit_ip', 'admin_post', 'stickied', 'locked',
         # extensions
         'abbrev',
+        # thread totals, when only some replies are loaded, and the number
+        # of the first reply loaded
+        'reply_count', 'image_count', 'cutoff',
     ]
 
     def __init__(self, rowproxy):
+        self.reply_count = self.image_count = self.cutoff = None
         for key, value in rowproxy.items():
             setattr(self, key, value)
         self.abbrev = 0
@@ -54,7 +66,7 @@ def board(name):
         Column("parent", Integer),                      # Parent post for replies in threads. For original posts, must be set to 0 (and not null)
         Column("timestamp", Integer),                   # Timestamp in seconds for when the post was created
         Column("lasthit", Integer),                     # Last activity in thread. Must be set to the same value for BOTH the original post and all replies!
-        Column("ip", Text),                             # IP number of poster, in integer form!
+        Column("ip", IPAddress),                        # IP number of poster, in integer form!
 
         Column("date", Text),                           # The date, as a string
         Column("name", Text(convert_unicode=True)),     # Name of the poster
@@ -73,17 +85,102 @@ def board(name):
         Column("tn_width", Text),                       # Thumbnail width in pixels
         Column("tn_height", Text),                      # Thumbnail height in pixels
         Column("lastedit", Text),                       # ADDED - Date of previous edit, as a string 
-        Column("lastedit_ip", Text),                    # ADDED - Previous editor of the post, if any
+        Column("lastedit_ip", IPAddress),               # ADDED - Previous editor of the post, if any
         Column("admin_post", Text),                  # ADDED - Admin post?
         # TODO: Probably should make this Boolean. Keeping as int for now to maintain compatibility with sorting functions.
         Column("stickied", Integer),                    # ADDED - Stickied?
         Column("locked", Text)                          # ADDED - Locked?
     )
 
+    # Duplicate file detection looks posts up by checksum.
+    Index('%s_md5' % name, table.c.md5, mysql_length=32)
+    # Delete-by-IP looks posts up by address.
+    Index('%s_ip' % name, table.c.ip, mysql_length=32)
+    # Threads are read a page at a time, along with their last replies.
+    Index('%s_thread' % name, table.c.parent, table.c.num)
+
     table.create(bind=engine, checkfirst=True)
+    ensure_indexes(table)
     _boards[name] = table
     return _boards[name]
 
+class InvalidAddress(util.WakaError, DontWrapMixin):
+    '''Raised when a value bound to an IPAddress column is no address. It
+    reaches the caller unwrapped, to be reported like any WakaError.'''
+    def __init__(self, message=strings.BADIP):
+        util.WakaError.__init__(self, message)
+
+class IPAddress(TypeDecorator):
+    '''An IPv4 or IPv6 address, as an integer (see misc.dot_to_dec()).
+
+    Addresses are stored as the 32 hex digits of their IPv6 form, IPv4 ones
+    mapped into ::ffff:0:0/96, so both families sort numerically and ranges
+    of them can be looked up through an index. Decimal values written
+    before the migration to this format are still read back.'''
+
+    impl = String(32)
+
+    IPV4_LIMIT = 1 << 32
+    IPV4_MAPPED = 0xffff << 32
+
+    def process_bind_param(self, value, dialect):
+        if value is None or value == '':
+            return value
+        try:
+            value = long(value)
+        except (ValueError, TypeError):
+            raise InvalidAddress()
+        if value < 0 or value >> 128:
+            raise InvalidAddress()
+        if value < self.IPV4_LIMIT:
+            value |= self.IPV4_MAPPED
+        return '%032x' % value
+
+    def process_result_value(self, value, dialect):
+        if not value:
+            return value
+        try:
+            if len(value) != 32:
+                return long(value)
+            value = long(value, 16)
+        except (ValueError, TypeError):
+            return value
+        if value >> 32 == 0xffff:
+            value &= 0xffffffff
+        return value
+
+def ip_in_range(column, start, end):
+    '''Condition matching the addresses in an IPAddress column from start
+    to end, inclusive. The column's index serves it.'''
+    if start == end:
+        return column == start
+    return column.between(start, end)
+
+def ensure_columns(table):
+    '''Add columns declared on a table that predates them. Returns the
+    names of the columns added.'''
+    existing = set(column['name'] for column
+                   in inspect(engine).get_columns(table.name))
+    preparer = engine.dialect.identifier_preparer
+    added = []
+    for column in table.columns:
+        if column.name not in existing:
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s'
+                % (preparer.format_table(table),
+                   preparer.format_column(column),
+                   column.type.compile(dialect=engine.dialect)))
+            added.append(column.name)
+    return added
+
+def ensure_indexes(table):
+    '''Create indexes declared on a table that predates them. (create_all()
+    and Table.create() only add indexes along with new tables.)'''
+    existing = set(index['name'] for index
+                   in inspect(engine).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(bind=engine)
+
 
 admin = Table(config.SQL_ADMIN_TABLE, metadata,
     Column("num", Integer, primary_key=True),           # Entry number, auto-increments
@@ -91,10 +188,14 @@ admin = Table(config.SQL_ADMIN_TABLE, metadata,
     Column("comment", Text(convert_unicode=True)),      # Comment for the entry
     Column("ival1", Text),                              # Integer value 1 (usually IP)
     Column("ival2", Text),                              # Integer value 2 (usually netmask)
+    Column("ip_start", IPAddress),                      # First address of a banned/whitelisted range
+    Column("ip_end", IPAddress),                        # Last address of a banned/whitelisted range
     Column("sval1", Text),                              # String value 1
     Column("total", Text),                              # ADDED - Total Ban?
     Column("expiration", Integer)                       # ADDED - Ban Expiration?
 )
+# Bans are matched by address range.
+Index('%s_range' % config.SQL_ADMIN_TABLE, admin.c.ip_start, admin.c.ip_end)
 
 proxy = Table(config.SQL_PROXY_TABLE, metadata,
     Column("num", Integer, primary_key=True),           # Entry number, auto-increments
@@ -112,16 +213,28 @@ account = Table(config.SQL_ACCOUNT_TABLE, metadata,
     Column("disabled", Integer)                         # Disabled account?
 )
 
+staff_session = Table(config.SQL_SESSION_TABLE, metadata,
+    Column("token", String(48), primary_key=True),      # Random token held by the wakaadmin cookie
+    Column("username", String(25), nullable=False),     # Staff member logged in
+    Column("addr", Text),                               # Address the session is bound to
+    Column("expires", Integer)                          # Expiration timestamp
+)
+# Sessions are dropped per user on password changes and account removal.
+Index('%s_username' % config.SQL_SESSION_TABLE, staff_session.c.username)
+
 activity = Table(config.SQL_STAFFLOG_TABLE, metadata,
     Column("num", Integer, primary_key=True),           # ID
     Column("username", String(25), nullable=False),     # Name of moderator involved
     Column("action", Text),                             # Action performed: post_delete, admin_post, admin_edit, ip_ban, ban_edit, ban_remove
     Column("info", Text),                               # Information
     Column("date", Text),                               # Date of action
-    Column("ip", Text),                                 # IP address of the moderator
+    Column("ip", IPAddress),                            # IP address of the moderator
     Column("admin_id", Integer),                        # For associating certain entries with the corresponding key on the admin table
     Column("timestamp", Integer)                        # Timestamp, for trimming
 )
+# Latest action of each staff member, and trimming.
+Index('%s_user_time' % config.SQL_STAFFLOG_TABLE, activity.c.username,
+      activity.c.timestamp)
 
 common = Table(config.SQL_COMMON_SITE_TABLE, metadata,
     Column("board", String(25), primary_key=True),      # Name of comment table
@@ -131,8 +244,8 @@ common = Table(config.SQL_COMMON_SITE_TABLE, metadata,
 report = Table(config.SQL_REPORT_TABLE, metadata,
     Column("num", Integer, primary_key=True),           # Report number, auto-increments
     Column("board", String(25), nullable=False),        # Board name
-    Column("reporter", Text, nullable=False),           # Reporter's IP address (decimal encoded)
-    Column("offender", Text),                           # IP Address of the offending poster. Why the form-breaking redundancy with SQL_TABLE? If a post is deleted by the perpetrator, the trace is still logged. :)
+    Column("reporter", IPAddress, nullable=False),      # Reporter's IP address
+    Column("offender", IPAddress),                      # IP Address of the offending poster. Why the form-breaking redundancy with SQL_TABLE? If a post is deleted by the perpetrator, the trace is still logged. :)
     Column("postnum", Integer, nullable=False),         # Post number
     Column("comment", Text(convert_unicode=True),
                       nullable=False),                  # Mandated reason for the report.
@@ -140,6 +253,9 @@ report = Table(config.SQL_REPORT_TABLE, metadata,
     Column("date", Text),                               # Date of the report
     Column("resolved", Integer)                         # Is it resolved? (1: yes 0: no)
 )
+# Report flood checks look reporters up by address.
+Index('%s_reporter' % config.SQL_REPORT_TABLE, report.c.reporter,
+      mysql_length=32)
 
 backup = Table(config.SQL_BACKUP_TABLE, metadata,
     Column("num", Integer, primary_key=True),           # Primary key, auto-increments
@@ -148,7 +264,7 @@ backup = Table(config.SQL_BACKUP_TABLE, metadata,
     Column("parent", Integer),                          # Parent post for replies in threads. For original posts, must be set to 0 (and not null)
     Column("timestamp", Integer),                       # Timestamp in seconds for when the post was created
     Column("lasthit", Integer),                         # Last activity in thread. Must be set to the same value for BOTH the original post and all replies!
-    Column("ip", Text),                                 # IP number of poster, in integer form!
+    Column("ip", IPAddress),                            # IP number of poster, in integer form!
 
     Column("date", Text),                               # The date, as a string
     Column("name", Text(convert_unicode=True)),         # Name of the poster
@@ -167,12 +283,53 @@ backup = Table(config.SQL_BACKUP_TABLE, metadata,
     Column("tn_width", Text),                           # Thumbnail width in pixels
     Column("tn_height", Text),                          # Thumbnail height in pixels
     Column("lastedit", Text),                           # ADDED - Date of previous edit, as a string 
-    Column("lastedit_ip", Text),                        # ADDED - Previous editor of the post, if any
+    Column("lastedit_ip", IPAddress),                   # ADDED - Previous editor of the post, if any
     Column("admin_post", Text),                         # ADDED - Admin post?
     Column("stickied", Integer),                        # ADDED - Stickied?
     Column("locked", Text),                             # ADDED - Locked?
     Column("timestampofarchival", Integer)              # When was this backed up?
 )
+# The trash bin reads a board's backups a thread at a time, in archival order.
+Index('%s_thread' % config.SQL_BACKUP_TABLE, backup.c.board_name,
+      backup.c.parent, backup.c.timestampofarchival)
+
+archive = Table(config.SQL_ARCHIVE_TABLE, metadata,
+    Column("num", Integer, primary_key=True),           # Primary key, auto-increments (archive order)
+    Column("board_name", String(25), nullable=False),   # Board name
+    Column("thread", Integer),                          # Post number of the archived thread
+    Column("subject", Text(convert_unicode=True)),      # Subject of the opening post
+    Column("date", Text),                               # Date of the opening post, as a string
+    Column("postcount", Integer),                       # Number of posts in the thread
+    Column("timestampofarchival", Integer)              # When was this archived?
+)
+# Archive index pages are read a board at a time, in archive order.
+Index('%s_board' % config.SQL_ARCHIVE_TABLE, archive.c.board_name,
+      archive.c.num)
+
+search_index = Table(config.SQL_SEARCH_TABLE, metadata,
+    Column("board_name", String(25), primary_key=True), # Board name
+    Column("field", String(1), primary_key=True),       # Indexed field: c(omment) or a(uthor)
+    Column("word", String(40, convert_unicode=True),
+                   primary_key=True),                   # Word, lowercase (see search.tokenize())
+    Column("num", Integer, primary_key=True)            # Post number
+)
+# Posts are removed from the index by number.
+Index('%s_post' % config.SQL_SEARCH_TABLE, search_index.c.board_name,
+      search_index.c.num)
+
+files = Table(config.SQL_FILE_TABLE, metadata,
+    Column("md5", String(32), primary_key=True),        # md5 sum in hex
+    Column("sha256", String(64)),                       # sha256 sum in hex, if computed
+    Column("size", Integer),                            # File size in bytes
+    Column("image", Text),                              # Stored copy, relative to FILE_STORE_DIR
+    Column("width", Integer),                           # Width of image in pixels
+    Column("height", Integer),                          # Height of image in pixels
+    Column("thumbnail", Text),                          # Stored thumbnail, relative to FILE_STORE_DIR
+    Column("thumb_spec", Text),                         # Requested thumbnail size and quality (WxH@Q)
+    Column("tn_width", Integer),                        # Thumbnail width in pixels
+    Column("tn_height", Integer),                       # Thumbnail height in pixels
+    Column("refcount", Integer)                         # Number of posts linking to the stored copy
+)
 
 passprompt = Table(config.SQL_PASSPROMPT_TABLE, metadata,
     Column("id", Integer, primary_key=True),
@@ -184,12 +341,74 @@ passprompt = Table(config.SQL_PASSPROMPT_TABLE, metadata,
     Column("passfail", Integer) 
 )
 
+# Total row counts of paginated queries, shared by the requests a process
+# serves for PAGE_COUNT_TTL seconds.
+_page_counts = util.LRUCache(config.PAGE_COUNT_CACHE_SIZE,
+                              name='Page counts')
+
+def encode_cursor(direction, values):
+    return base64.urlsafe_b64encode(json.dumps([direction] + list(values)))
+
+def decode_cursor(cursor):
+    '''Return the direction and the key values of a page cursor, or
+    (None, None) if it is malformed.'''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return (values[0], values[1:])
+    except (ValueError, TypeError, IndexError, UnicodeError):
+        return (None, None)
+
+def keyset_order(keyset, forward=True):
+    '''ORDER BY terms walking a keyset, a list of (column, descending)
+    pairs, forwards or backwards.'''
+    return [column.desc() if descending == forward else column.asc()
+            for (column, descending) in keyset]
+
+def keyset_seek(keyset, values, forward=True):
+    '''Condition for the rows past the given key values, walking the keyset
+    forwards or backwards.'''
+    # (a, b) > (x, y) as a > x OR (a = x AND b > y), which every
+    # database can serve from an index on (a, b).
+    clauses = []
+    for (i, (column, descending)) in enumerate(keyset):
+        if descending == forward:
+            beyond = column < values[i]
+        else:
+            beyond = column > values[i]
+        clauses.append(and_(*[keyset[j][0] == values[j]
+                              for j in xrange(i)] + [beyond]))
+    return or_(*clauses)
+
+def count_rows(query):
+    '''Number of rows query returns, cached for PAGE_COUNT_TTL seconds.'''
+    count = select([func.count()]).select_from(query.order_by(None).alias())
+    compiled = count.compile(bind=engine)
+    key = hashlib.sha1(repr((unicode(compiled),
+                             sorted(compiled.params.items())))).digest()
+
+    cached = _page_counts.get(key)
+    if cached and cached[1] > time.time():
+        return cached[0]
+
+    total = Session().execute(count).scalar()
+    if config.PAGE_COUNT_TTL:
+        _page_counts.set(key, (total, time.time() + config.PAGE_COUNT_TTL))
+    return total
+
 class Page(object):
     '''Pagination class: Given an SQL query and pagination information,
     produce only the relevant rows. N.B.: The board.Board class uses
-    different pagination logic.'''
+    different pagination logic.
 
-    def __init__(self, query, page_num, per_page):
+    With a keyset, a list of (column, descending) pairs whose last column
+    is unique, the query is sorted by it and pages are also reachable by
+    cursor: next_cursor, prev_cursor and last_cursor seek directly to the
+    neighbouring and last pages, however deep, instead of counting off
+    rows with OFFSET. The keyset columns must be selected by the query and
+    must not be NULL. Without a cursor (the first page, or jumps to an
+    arbitrary page), OFFSET is used as before.'''
+
+    def __init__(self, query, page_num, per_page, keyset=None, cursor=None):
         assert str(page_num).isdigit() and page_num > 0,\
             'Invalid page number.'
         assert str(per_page).isdigit() and per_page > 0,\
@@ -201,16 +420,11 @@ class Page(object):
         else:
             self.per_page = per_page
         self.offset = (page_num - 1) * self.per_page
+        self.next_cursor = self.prev_cursor = self.last_cursor = None
 
         session = Session()
 
-        count = query.column(func.count())
-        self.total_entries = session.execute(count).fetchone()['count_1']
-        row_proxies = session.execute(query.limit(per_page)\
-                                           .offset(self.offset))
-
-        self.rows = [dict(row.items()) for row in row_proxies]
-
+        self.total_entries = count_rows(query)
         self.total_pages = (self.total_entries + self.per_page - 1)\
                             / self.per_page
         if self.total_pages == 0:
@@ -218,6 +432,33 @@ class Page(object):
 
         if self.total_pages < self.num:
             self.num = self.total_pages
+            self.offset = (self.num - 1) * self.per_page
+
+        self.rows = None
+        if keyset:
+            query = query.order_by(None)
+            (direction, values) = decode_cursor(cursor) if cursor \
+                                  else (None, None)
+            if direction in ('next', 'prev', 'last'):
+                self.rows = self._seek(session, query, keyset, direction,
+                                       values)
+
+            query = query.order_by(*keyset_order(keyset))
+
+        if self.rows is None:
+            row_proxies = session.execute(query.limit(self.per_page)\
+                                               .offset(self.offset))
+            self.rows = [dict(row.items()) for row in row_proxies]
+
+        if keyset and self.rows:
+            names = [column.name for (column, descending) in keyset]
+            if self.num < self.total_pages:
+                self.next_cursor = encode_cursor('next',
+                    [self.rows[-1][name] for name in names])
+                self.last_cursor = encode_cursor('last', [])
+            if self.num > 1:
+                self.prev_cursor = encode_cursor('prev',
+                    [self.rows[0][name] for name in names])
 
         # Quick fix for 'board' -> 'board_name' column renaming.
         if self.rows:
@@ -230,3 +471,30 @@ class Page(object):
             row['entry_number'] = row_ctr
             if ren_board:
                 row['board_name'] = row['board']
+
+    def _seek(self, session, query, keyset, direction, values):
+        '''Rows of the page next to, or before, the one whose boundary
+        key values are given, or of the last page. Returns None if the
+        cursor does not fit the keyset or matches nothing.'''
+        limit = self.per_page
+        if direction == 'last':
+            self.num = self.total_pages
+            limit = self.total_entries - (self.num - 1) * self.per_page
+            if limit <= 0:
+                return None
+        elif len(values) != len(keyset):
+            return None
+
+        # Walk backwards through the keyset for the previous and last pages.
+        forward = direction == 'next'
+        query = query.order_by(*keyset_order(keyset, forward))
+        if values:
+            query = query.where(keyset_seek(keyset, values, forward))
+
+        rows = [dict(row.items()) for row
+                in session.execute(query.limit(limit))]
+        if not rows:
+            return None
+        if not forward:
+            rows.reverse()
+        return rows
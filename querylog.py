@@ -0,0 +1,184 @@
+'''Statistics of the SQL statements run through model.engine, enabled with
+QUERY_STATS, and a log of the slow ones, enabled with SLOW_QUERY_MS.
+
+Statements are grouped by fingerprint: the statement text with literals
+and bind parameters replaced by ?, so that every run of a query counts
+towards the same entry whatever its arguments. Each process keeps the
+count and latency distribution of its QUERY_FINGERPRINTS most recently
+run fingerprints for the query panel.
+
+Statements slower than SLOW_QUERY_MS are logged as JSON lines to
+SLOW_QUERY_LOG by fingerprint, with the types of their bind parameters
+but never their values. With SLOW_QUERY_EXPLAIN, the database's query plan
+is added; note that some databases (PostgreSQL) show the values compared
+against in their plans.'''
+
+import os
+import re
+import time
+import json
+import threading
+
+from sqlalchemy import event
+
+import config, config_defaults
+import model
+import metrics
+from util import local, LRUCache
+
+# Upper bounds of the latency buckets, in milliseconds.
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+PARAM_RE = re.compile(r'%\(\w+\)s|%s|\?|(?<!:):\w+')
+PARAM_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+SPACE_RE = re.compile(r'\s+')
+
+def fingerprint(statement):
+    '''Statement text with its values replaced by ?, and lists of them
+    collapsed into one.'''
+    statement = STRING_RE.sub('?', statement)
+    statement = NUMBER_RE.sub('?', statement)
+    statement = PARAM_RE.sub('?', statement)
+    statement = PARAM_LIST_RE.sub('(?+)', statement)
+    return SPACE_RE.sub(' ', statement).strip()
+
+_fingerprints = LRUCache(config.QUERY_FINGERPRINTS,
+                         name='Statement fingerprints')
+
+def get_fingerprint(statement):
+    '''fingerprint(), memoized.'''
+    key = _fingerprints.get(statement)
+    if key is None:
+        key = fingerprint(statement)
+        _fingerprints.set(statement, key)
+    return key
+
+def _shape(parameters):
+    if isinstance(parameters, dict):
+        return dict((name, type(value).__name__)
+                    for (name, value) in parameters.iteritems())
+    return [type(value).__name__ for value in parameters or ()]
+
+def parameter_shape(parameters, executemany):
+    '''Types of the bind parameters of a statement, or of its first row of
+    parameters and the number of rows for an executemany().'''
+    if executemany:
+        return {'rows': len(parameters),
+                'first': _shape(parameters[0]) if parameters else None}
+    return _shape(parameters)
+
+class QueryStats(object):
+    '''Count and latency distribution of one fingerprint, with the last
+    slow run of it.'''
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.slow = 0
+        self.sample = None
+
+    def summary(self):
+        '''Dictionary of the statistics, for templating. Times are in
+        milliseconds.'''
+        return {'fingerprint': self.fingerprint,
+                'count': self.count,
+                'total': self.seconds * 1000,
+                'mean': self.seconds * 1000 / max(self.count, 1),
+                'p95': metrics.percentile(BUCKETS, self.buckets, .95,
+                                          self.max * 1000),
+                'max': self.max * 1000,
+                'slow': self.slow,
+                'sample': self.sample}
+
+_stats = LRUCache(config.QUERY_FINGERPRINTS)
+_lock = threading.Lock()
+
+def record(statement, seconds, sample=None):
+    '''Count a run of statement that took the given time, and keep sample
+    as its last slow run if given.'''
+    key = get_fingerprint(statement)
+    bucket = metrics.bucket_index(BUCKETS, seconds * 1000)
+    with _lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = QueryStats(key)
+            _stats.set(key, stats)
+        stats.count += 1
+        stats.seconds += seconds
+        stats.max = max(stats.max, seconds)
+        stats.buckets[bucket] += 1
+        if sample is not None:
+            stats.slow += 1
+            stats.sample = sample
+
+def summaries():
+    '''Statistics of the fingerprints run by this process, the one taking
+    the most time in total first.'''
+    with _lock:
+        rows = [stats.summary() for stats in _stats.values()]
+    rows.sort(key=lambda row: -row['total'])
+    return rows
+
+def clear():
+    with _lock:
+        _stats.clear()
+
+def explain(conn, statement, parameters):
+    '''Query plan of a SELECT statement as a list of lines, run on the
+    same database connection but bypassing the engine events.'''
+    if statement.lstrip()[:6].upper() != 'SELECT':
+        return None
+    if conn.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return [' | '.join([unicode(column) for column in row])
+                for row in cursor.fetchall()]
+    except Exception, e:
+        return ['EXPLAIN failed: %s' % e]
+    finally:
+        cursor.close()
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info['waka.statement_start'] = time.time()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    seconds = time.time() - conn.info['waka.statement_start']
+
+    sample = None
+    if config.SLOW_QUERY_MS and seconds * 1000 >= config.SLOW_QUERY_MS:
+        # Only the fingerprint is logged, as statements may carry literal
+        # values, such as those entered in the SQL interface.
+        sample = {'time': int(time.time()),
+                  'pid': os.getpid(),
+                  'task': local.environ.get('waka.task', ''),
+                  'board': local.environ.get('waka.boardname', ''),
+                  'ms': round(seconds * 1000, 2),
+                  'fingerprint': get_fingerprint(statement),
+                  'parameters': parameter_shape(parameters, executemany)}
+        if config.SLOW_QUERY_EXPLAIN and not executemany:
+            sample['explain'] = explain(conn, statement, parameters)
+        metrics.write_line(config.SLOW_QUERY_LOG,
+                           json.dumps(sample, sort_keys=True) + '\n')
+
+    if config.QUERY_STATS:
+        record(statement, seconds, sample)
+
+def install():
+    '''Watch the statements run through model.engine, if enabled.'''
+    if config.QUERY_STATS or config.SLOW_QUERY_MS:
+        event.listen(model.engine, 'before_cursor_execute',
+                     _before_cursor_execute)
+        event.listen(model.engine, 'after_cursor_execute',
+                     _after_cursor_execute)
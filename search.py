@@ -0,0 +1,183 @@
+'''Full-text index of board posts, for the staff post search.
+
+Posts are split into words, which are stored in one inverted index table
+shared by all boards, so a search is an index lookup per word instead of a
+LIKE scan over the whole board. The same plain table works on every
+supported database. Runs of CJK characters, which have no spaces between
+words, are indexed as overlapping character pairs.
+
+A board's index is only used once rebuild_index() has gone through all of
+its posts, which it records with a marker entry; until then searches fall
+back to scanning the board.'''
+
+import re
+
+from sqlalchemy.sql import select, and_, func
+
+import config, config_defaults
+import model
+import str_format
+
+# Indexed fields.
+COMMENT = 'c'
+AUTHOR = 'a'
+# Field of the entry marking a board as fully indexed.
+INDEXED = '-'
+
+MAX_WORD_LENGTH = 40
+MAX_QUERY_WORDS = 16
+
+TAG_RE = re.compile(r'<[^>]*>')
+NAMED_ENTITY_RE = re.compile(r'&[a-zA-Z]+;')
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+CJK_RE = re.compile(u'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff'
+                    u'\uac00-\ud7af\uf900-\ufaff\uff66-\uff9f]+')
+
+def tokenize(text):
+    '''Distinct words of a comment, name or search string, ignoring the
+    markup added by str_format.format_comment() and clean_string().'''
+    if not text:
+        return []
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+
+    text = TAG_RE.sub(' ', text)
+    text = str_format.decode_string(text)
+    text = NAMED_ENTITY_RE.sub(' ', text).lower()
+
+    words = set()
+    for word in WORD_RE.findall(text):
+        for part in CJK_RE.split(word):
+            if part:
+                words.add(part[:MAX_WORD_LENGTH])
+        for run in CJK_RE.findall(word):
+            if len(run) == 1:
+                words.add(run)
+            else:
+                words.update(run[i:i+2] for i in xrange(len(run) - 1))
+    return list(words)
+
+def _entries(board, post):
+    entries = []
+    for (field, text) in ((COMMENT, post['comment']),
+                          (AUTHOR, u' '.join([post['name'] or u'',
+                                              post['trip'] or u'']))):
+        entries.extend({'board_name': board.name, 'field': field,
+                        'word': word, 'num': post['num']}
+                       for word in tokenize(text))
+    return entries
+
+def index_posts(board, posts):
+    '''Add posts (rows or dicts with num, name, trip and comment) to the
+    index, replacing what was indexed for their numbers before.'''
+    posts = list(posts)
+    if not posts:
+        return
+    remove_posts(board, [post['num'] for post in posts])
+
+    entries = []
+    for post in posts:
+        entries.extend(_entries(board, post))
+    _insert(entries)
+
+def _insert(entries):
+    if not entries:
+        return
+    # Words that differ only in case or accents are one under the default
+    # MySQL collations, and would collide on the primary key.
+    sql = model.search_index.insert().prefix_with('IGNORE', dialect='mysql')
+    session = model.Session()
+    session.execute(sql, entries)
+
+def index_matching(board, where):
+    '''Index the posts of board matched by the where clause.'''
+    session = model.Session()
+    table = board.table
+    sql = select([table.c.num, table.c.name, table.c.trip, table.c.comment],
+                 where)
+    index_posts(board, session.execute(sql).fetchall())
+
+def remove_posts(board, nums):
+    '''Drop posts from the index. nums is a list of post numbers or a
+    select of them.'''
+    session = model.Session()
+    table = model.search_index
+    session.execute(table.delete().where(
+        and_(table.c.board_name == board.name, table.c.num.in_(nums))))
+
+def drop_board(board_name):
+    session = model.Session()
+    table = model.search_index
+    session.execute(table.delete().where(table.c.board_name == board_name))
+
+def is_indexed(board):
+    '''Whether all posts of the board have been indexed (see
+    rebuild_index()).'''
+    session = model.Session()
+    table = model.search_index
+    sql = select([table.c.num], and_(table.c.board_name == board.name,
+                                     table.c.field == INDEXED))
+    return session.execute(sql).fetchone() is not None
+
+def search_posts(board, field, text):
+    '''Select of the numbers of the board's posts whose field contains
+    every word of text, or None if text has no words.'''
+    words = tokenize(text)[:MAX_QUERY_WORDS]
+    if not words:
+        return None
+
+    table = model.search_index
+    return select([table.c.num], and_(table.c.board_name == board.name,
+                                      table.c.field == field,
+                                      table.c.word.in_(words)))\
+             .group_by(table.c.num)\
+             .having(func.count() == len(words))
+
+def select_matching(board, field, text):
+    '''Select of the board's posts whose field has all the words of text,
+    through the index. None if the board has not been indexed yet or text
+    has no words.'''
+    if not is_indexed(board):
+        return None
+    matches = search_posts(board, field, text)
+    if matches is None:
+        return None
+    table = board.table
+    matches = matches.alias()
+    return select([table],
+        from_obj=[table.join(matches, table.c.num == matches.c.num)])
+
+def rebuild_index(board, batch_size=None):
+    '''Index all posts of a board, batch by batch. Returns the number of
+    posts indexed.'''
+    batch_size = batch_size or config.STORAGE_MIGRATION_BATCH
+    session = model.Session()
+    table = board.table
+    drop_board(board.name)
+    session.commit()
+
+    indexed = last = 0
+    while True:
+        sql = select([table.c.num, table.c.name, table.c.trip,
+                      table.c.comment], table.c.num > last)\
+                .order_by(table.c.num.asc()).limit(batch_size)
+        rows = session.execute(sql).fetchall()
+        if not rows:
+            break
+        last = rows[-1].num
+
+        # Posts of the batch made or edited since the rebuild started were
+        # indexed as they came in; their entries are replaced.
+        entries = []
+        for row in rows:
+            entries.extend(_entries(board, row))
+        remove_posts(board, [row.num for row in rows])
+        _insert(entries)
+        session.commit()
+        indexed += len(rows)
+
+    # Posts made after the last batch were indexed as they came in.
+    _insert([{'board_name': board.name, 'field': INDEXED, 'word': u'',
+              'num': 0}])
+    session.commit()
+    return indexed
@@ -1,7 +1,8 @@
 '''Staff management.'''
 
+import os
 import time
-from sqlalchemy.sql import select, func
+from sqlalchemy.sql import select, func, and_
 
 import strings
 import model
@@ -22,19 +23,26 @@ CLASSES = (ADMIN, GLOBAL_MOD, MODERATOR)
 SAVED_LOGIN_EXPIRE = 365 * 24 * 3600
 UNSAVED_LOGIN_EXPIRE = 3600
 
+# Logins are server-side sessions: the wakaadmin cookie holds a random token
+# naming a row of the session table, so checking a login is one lookup
+# instead of an RC6 encryption of the password. Cookies of the older
+# "username,crypt" format are checked the old way once and exchanged for a
+# session.
+SESSION_TOKEN_BYTES = 24
+
 # Staff Accounts and Logins
 class LoginData(object):
     '''Class for interfacing with prefetched login data.'''
 
-    def __init__(self, user, addr):
+    def __init__(self, user, addr, token, expires):
         self.addr = addr
-        self.crypt = crypt_pass(user.password, addr)
         self.username = user.username
-        self.cookie = ','.join((self.username, self.crypt))
+        self.token = token
+        self.expires = expires
+        self.cookie = token
 
     def make_cookie(self, save_login=False):
-        expires = time.time() + (SAVED_LOGIN_EXPIRE if save_login
-            else UNSAVED_LOGIN_EXPIRE)
+        expires = self.expires
 
         misc.make_cookies(wakaadmin=self.cookie, httponly=1, expires=expires)
 
@@ -51,11 +59,12 @@ class StaffMember(object):
     
     To create new staff accounts, use the add_staff() function instead.'''
 
-    def __init__(self, username):
-        session = model.Session()
+    def __init__(self, username, row=None):
         table = model.account
-        sql = table.select().where(table.c.username == username)
-        row = session.execute(sql).fetchone()
+        if row is None:
+            session = model.Session()
+            sql = table.select().where(table.c.username == username)
+            row = session.execute(sql).fetchone()
         self._table = table
 
         if row is None:
@@ -131,12 +140,29 @@ class StaffMember(object):
 
         self._update_db(disabled=disable)
 
-    def login_host(self, ip):
-        login_data = LoginData(self, ip)
+    def login_host(self, ip, save_login=False):
+        session = model.Session()
+        table = model.staff_session
+        now = time.time()
+        expires = int(now + (SAVED_LOGIN_EXPIRE if save_login
+                             else UNSAVED_LOGIN_EXPIRE))
+        token = os.urandom(SESSION_TOKEN_BYTES).encode('hex')
+
+        session.execute(table.delete().where(table.c.expires < now))
+        session.execute(table.insert().values(token=token,
+                                              username=self.username,
+                                              addr=ip, expires=expires))
+
+        login_data = LoginData(self, ip, token, expires)
         self._login_data = login_data
         return login_data
 
     def logout_user(self):
+        if self._login_data:
+            session = model.Session()
+            table = model.staff_session
+            session.execute(table.delete().where(
+                table.c.token == self._login_data.token))
         self._login_data = None
 
     def flush_db(self):
@@ -149,6 +175,9 @@ class StaffMember(object):
                              .values(**self._update_dict)
             session.execute(db_update)
 
+            if 'password' in self._update_dict or self._disabled:
+                end_sessions(self.username)
+
     @classmethod
     def get(cls, username):
 #        if username in _staff:
@@ -192,6 +221,7 @@ def del_staff(username):
     table = model.account
     sql = table.delete(table.c.username == username)
     session.execute(sql)
+    end_sessions(username)
 
 #    try:
 #        del _staff[username]
@@ -225,28 +255,53 @@ def staff_exists():
 
     return row[0] != 0
 
+def end_sessions(username):
+    '''Log a staff member out everywhere.'''
+    session = model.Session()
+    table = model.staff_session
+    session.execute(table.delete().where(table.c.username == username))
+
 def check_password(cookie_str, editing=None):
-    if not cookie_str or not cookie_str.count(','):
+    if not cookie_str:
         raise LoginError('Cookie data missing.')
 
     remote = local.environ['REMOTE_ADDR']
+    if cookie_str.count(','):
+        return _upgrade_login(cookie_str, remote)
+
+    session = model.Session()
+    table = model.staff_session
+    account = model.account
+    sql = select([table.c.addr, table.c.expires, account],
+                 and_(table.c.token == cookie_str,
+                      account.c.username == table.c.username))
+    row = session.execute(sql).fetchone()
+
+    if row is None or row.expires < time.time() or row.addr != remote:
+        raise LoginError(strings.WRONGPASS)
+    elif row.disabled:
+        raise LoginError('You have been disabled.')
+
+    staff_entry = StaffMember(row.username, row)
+    staff_entry._login_data = LoginData(staff_entry, remote, cookie_str,
+                                        row.expires)
+    return staff_entry
+
+def _upgrade_login(cookie_str, remote):
+    '''Check a cookie of the "username,crypt" format and start a session
+    for it.'''
     (username, crypt) = cookie_str.split(',')
     staff_entry = StaffMember.get(username)
-    cache = staff_entry.login_data
 
-    if cache and cache.addr == remote:
-        # The host is already logged in.
-        pass
-    elif crypt != crypt_pass(staff_entry.password, remote):
+    if crypt != crypt_pass(staff_entry.password, remote):
         raise LoginError(strings.WRONGPASS)
     elif staff_entry.disabled:
         raise LoginError('You have been disabled.')
-    else:
-        # NOTE: This will overwrite the current network address login.
-        staff_entry.login_host(remote)
-        # Needs save_login parameter. Only useful once sessions and
-        # user caches are implemented.
-        # staff_entry.login_data.make_cookie()
+
+    request = local.environ['werkzeug.request']
+    save_login = request.cookies.get('wakaadminsave') == '1'
+    staff_entry.login_host(remote, save_login)
+    staff_entry.login_data.make_cookie(save_login=save_login)
 
     return staff_entry
 
@@ -13,6 +13,10 @@ import staff
 import model
 import str_format
 import misc
+import search as fulltext
+import metrics
+import querylog
+import util
 from util import WakaError, local, make_http_forward
 from template import Template
 import config
@@ -25,10 +29,13 @@ REPORTS_PANEL = 'reportspanel'
 STAFF_PANEL = 'staffpanel'
 TRASH_PANEL = 'trashpanel'
 POST_SEARCH_PANEL = 'postsearchpanel'
+GLOBAL_SEARCH_PANEL = 'globalsearchpanel'
 SQL_PANEL = 'sqlpanel'
+QUERY_PANEL = 'querypanel'
 PROXY_PANEL = 'proxypanel'
 SECURITY_PANEL = 'securitypanel'
 STAFF_ACTIVITY_PANEL = 'stafflog'
+PERFORMANCE_PANEL = 'perfpanel'
 
 BAN_POPUP = 'banpopup'
 BAN_EDIT_POPUP = 'baneditwindow'
@@ -75,7 +82,7 @@ class StaffInterface(Template):
     pages served by Wakarimasen.'''
 
     def __init__(self, admin, board=None, dest=None, page=None,
-                 perpage=50, **kwargs):
+                 perpage=50, cursor=None, **kwargs):
         try:
             self.user = staff.check_password(admin)
         except staff.LoginError:
@@ -101,6 +108,7 @@ class StaffInterface(Template):
             page = int(page)
         self.page = page
         self.perpage = int(perpage)
+        self.cursor = cursor
         self.board = local.environ['waka.board']
 
         if dest not in INTERFACE_MAPPING:
@@ -152,9 +160,8 @@ class StaffInterface(Template):
         else:
             # Grab count of all threads.
             table = board.table
-            session = model.Session()
-            sql = select([func.count()], table.c.parent == 0)
-            thread_count = session.execute(sql).fetchone()[0]
+            thread_count = model.count_rows(select([table.c.num],
+                                                   table.c.parent == 0))
             total = (thread_count + self.perpage - 1) / self.perpage
 
             if total <= self.page and total > 0:
@@ -162,14 +169,21 @@ class StaffInterface(Template):
                 # Pages are 0-indexed.
                 self.page = total - 1
             # Get partial board posts.
-            pagethreads = board.get_some_threads(self.page)
+            pagethreads = board.get_some_threads(self.page, self.cursor)
             (pages, prevpage, nextpage)\
                 = board.get_board_page_data(self.page, total,
                                             admin_page='mpanel')
-            threads = board.parse_page_threads(pagethreads)
             kwargs = {'pages' : pages,
                       'prevpage' : prevpage,
                       'nextpage' : nextpage}
+            # The neighbouring pages are reached by seeking from this one.
+            if pagethreads and prevpage != 'none':
+                kwargs['prev_cursor'] \
+                    = board.thread_cursor('prev', pagethreads[0][0])
+            if pagethreads and nextpage != 'none':
+                kwargs['next_cursor'] \
+                    = board.thread_cursor('next', pagethreads[-1][0])
+            threads = board.parse_page_threads(pagethreads)
 
         Template.__init__(self, 'post_panel_template', 
                           postform=board.options['ALLOW_TEXTONLY'] or
@@ -184,32 +198,41 @@ class StaffInterface(Template):
     def make_admin_staff_panel(self):
         session = model.Session()
         table = model.account
-        sql = table.select().order_by(table.c.account.asc(),
-                                      table.c.username.asc())
-
-        query = session.execute(sql)
-        users = [dict(row.items()) for row in query]
-
+        action_table = model.activity
+
+        # Latest action of each user, found through the activity table's
+        # (username, timestamp) index.
+        last_action = select([action_table.c.num])\
+                    .where(action_table.c.username == table.c.username)\
+                    .order_by(action_table.c.timestamp.desc(),
+                              action_table.c.num.desc())\
+                    .limit(1).as_scalar()
+        sql = select([table,
+                      action_table.c.num.label('last_num'),
+                      action_table.c.action.label('last_action'),
+                      action_table.c.date.label('last_date')])\
+                .select_from(table.outerjoin(action_table,
+                                             action_table.c.num == last_action))\
+                .order_by(table.c.account.asc(), table.c.username.asc())
+
+        users = []
         rowtype = 1
-        for row in users:
+        for row in session.execute(sql):
+            row = dict(row.items())
             # Alternate between values 1 and 2.
             rowtype ^= 0x3
             row['rowtype'] = rowtype
 
-            # Get latest action from DB.
-            action_table = model.activity
-            action_grab_sql = action_table.select()\
-                        .where(action_table.c.username == row['username'])\
-                        .order_by(action_table.c.date.desc())
-            last_action = session.execute(action_grab_sql).fetchone()
-
             # Copy to row.
-            if last_action:
-                row['action'] = last_action['action']
-                row['actiondate'] = last_action['date']
+            action = row.pop('last_action')
+            actiondate = row.pop('last_date')
+            if row.pop('last_num') is not None:
+                row['action'] = action
+                row['actiondate'] = actiondate
             else:
                 row['action'] = 'None'
                 row['actiondate'] = 'Never'
+            users.append(row)
 
         Template.__init__(self, 'staff_management', users=users)
 
@@ -234,7 +257,8 @@ class StaffInterface(Template):
                              table.c.action,
                              table.c.info,
                              table.c.date,
-                             table.c.ip]
+                             table.c.ip,
+                             table.c.num]
         sql = select(dual_table_select,
                      from_obj=[table.join(account_table,
                      table.c.username == model.account.c.username)])
@@ -294,16 +318,19 @@ class StaffInterface(Template):
         if self.board:
             inputs.append({'name' : 'board', 'value' : self.board.name})
 
-        # Apply sorting.
-        if sortby_name and hasattr(table.c, sortby_name):
-            order_col = getattr(table.c, sortby_name)
-            if sortby_dir.lower() == 'asc':
-                sort_spec = order_col.asc()
-            else:
-                sort_spec = order_col.desc()
-            sql = sql.order_by(sort_spec)
+        # Apply sorting. Dates are sorted by their timestamps; the entry
+        # number breaks ties.
+        descending = sortby_dir.lower() != 'asc'
+        keyset = [(table.c.num, descending)]
+        if sortby_name == 'date':
+            sql = sql.column(table.c.timestamp)
+            keyset.insert(0, (table.c.timestamp, descending))
+        elif sortby_name and sortby_name != 'num' \
+                and hasattr(table.c, sortby_name):
+            keyset.insert(0, (getattr(table.c, sortby_name), descending))
 
-        res = model.Page(sql, self.page, self.perpage)
+        res = model.Page(sql, self.page, self.perpage, keyset=keyset,
+                         cursor=self.cursor)
 
         Template.__init__(self, template_view,
                           user_to_view=user_to_view,
@@ -318,7 +345,10 @@ class StaffInterface(Template):
                           sortby=sortby_name,
                           number_of_pages=res.total_pages,
                           rooturl=rooturl,
-                          inputs=inputs)
+                          inputs=inputs,
+                          next_cursor=res.next_cursor,
+                          prev_cursor=res.prev_cursor,
+                          last_cursor=res.last_cursor)
 
     @interface_for(BAN_PANEL)
     def make_admin_ban_panel(self, ip=''):
@@ -420,21 +450,17 @@ class StaffInterface(Template):
         if self.user.account == staff.MODERATOR:
             sql = sql.where(table.c.board.in_(self.user.reign))
 
-        # Determine order.
+        # Determine order. Dates are sorted by their timestamps; the report
+        # number breaks ties.
+        keyset = [(table.c.timestamp, True), (table.c.num, True)]
         if sortby_type in ('board', 'postnum', 'date'):
-            try:
-                column = getattr(table.c, sortby_type)
-            except AttributeError:
-                raise WakaError('Sort-by column is absent from table.')
-            sort = column.desc
-            if sortby_dir == 'asc':
-                sort = column.asc
-            sql = sql.order_by(sort(), table.c.date.desc())
-        else:
-            sql = sql.order_by(table.c.date.desc())
+            column = table.c.timestamp if sortby_type == 'date' \
+                     else getattr(table.c, sortby_type)
+            keyset = [(column, sortby_dir != 'asc'), (table.c.num, True)]
 
         # Paginate.
-        res = model.Page(sql, self.page, self.perpage)
+        res = model.Page(sql, self.page, self.perpage, keyset=keyset,
+                         cursor=self.cursor)
 
         # Hidden input fields.
         inputs = [{'name' : 'task', 'value' : 'reports'},
@@ -451,7 +477,10 @@ class StaffInterface(Template):
                           number_of_pages=res.total_pages,
                           rowcount=res.total_entries,
                           inputs=inputs,
-                          rooturl=rooturl)
+                          rooturl=rooturl,
+                          next_cursor=res.next_cursor,
+                          prev_cursor=res.prev_cursor,
+                          last_cursor=res.last_cursor)
 
     # NOTE: For this and other make_*_window functions, I took out
     # the sanity checks and instead delegated them to the non-interface
@@ -522,18 +551,19 @@ class StaffInterface(Template):
 
         elif config.POST_BACKUP:
             max_res = board.options['IMAGES_PER_PAGE']
+            max_replies = board.options['REPLIES_PER_THREAD']
 
-            sqlcond = and_(or_(table.c.parent == 0,
-                and_(table.c.parent > 0, not_(exists([table.c.num],
-                    table.c.parent == table.c.postnum)))),
-                table.c.board_name == board.name)
+            # Thread openers, and replies whose thread is not in the trash.
+            head = table.alias('head')
+            orphaned = not_(exists([head.c.num],
+                and_(head.c.board_name == table.c.board_name,
+                     head.c.postnum == table.c.parent,
+                     head.c.parent == 0)))
+            sqlcond = and_(table.c.board_name == board.name,
+                           or_(table.c.parent == 0, orphaned))
 
             # Acquire the number of full threads *and* orphaned posts.
-            sql = select([func.count()], sqlcond, table)\
-                  .order_by(table.c.timestampofarchival.desc(),
-                              table.c.postnum.asc())
-
-            thread_ct = session.execute(sql).fetchone()[0]
+            thread_ct = model.count_rows(select([table.c.num], sqlcond))
 
             total = int(thread_ct + max_res - 1) / max_res
             offset = self.page * max_res
@@ -546,13 +576,72 @@ class StaffInterface(Template):
             if self.page > last_page and last_page > 0:
                 self.page = last_page
 
-            sql = table.select().where(sqlcond)\
+            # With each thread opener, the first of the last max_replies
+            # replies in the order shown (none if all are shown).
+            window = table.alias('window')
+            def cutoff(column):
+                return select([column],
+                    and_(window.c.board_name == table.c.board_name,
+                         window.c.parent == table.c.postnum))\
+                    .order_by(window.c.timestampofarchival.asc(),
+                              window.c.postnum.desc())\
+                    .limit(1).offset(max(max_replies, 1) - 1).as_scalar()
+
+            sql = select([table,
+                          cutoff(window.c.timestampofarchival)\
+                              .label('cutoff_time'),
+                          cutoff(window.c.postnum).label('cutoff_num')],
+                         sqlcond)\
                   .order_by(table.c.timestampofarchival.desc(),
                               table.c.num.asc())\
-                  .limit(board.options['IMAGES_PER_PAGE'])\
+                  .limit(max_res)\
                   .offset(offset)
-            threads = [{'posts' : [dict(x.items())]} \
-                for x in session.execute(sql)]
+            threads = []
+            cutoffs = {}
+            for row in session.execute(sql):
+                post = dict(row.items())
+                cutoffs[post['postnum']] = (post.pop('cutoff_time'),
+                                            post.pop('cutoff_num'))
+                threads.append({'posts' : [post]})
+
+            parents = [item['posts'][0]['postnum'] for item in threads
+                       if not item['posts'][0]['parent']]
+            counts = {}
+            replies = {}
+            if parents:
+                in_threads = and_(table.c.board_name == board.name,
+                                  table.c.parent.in_(parents))
+
+                # Reply and image counts of all threads on the page.
+                sql = select([table.c.parent, func.count(),
+                              func.count(table.c.image)], in_threads)\
+                      .group_by(table.c.parent)
+                counts = dict((row[0], (row[1], row[2]))
+                              for row in session.execute(sql))
+
+            if parents and max_replies > 0:
+                # The last max_replies replies of each thread, in the order
+                # shown: from its cutoff on, one index range each.
+                shown = []
+                for parent in parents:
+                    (first_time, first_num) = cutoffs[parent]
+                    in_thread = table.c.parent == parent
+                    if first_time is not None:
+                        in_thread = and_(in_thread,
+                            or_(table.c.timestampofarchival < first_time,
+                                and_(table.c.timestampofarchival
+                                         == first_time,
+                                     table.c.postnum >= first_num)))
+                    shown.append(in_thread)
+                sql = table.select().where(and_(
+                          table.c.board_name == board.name, or_(*shown)))\
+                      .order_by(table.c.timestampofarchival.desc(),
+                                table.c.postnum.asc())
+                for row in session.execute(sql):
+                    replies.setdefault(row['parent'], [])\
+                           .append(dict(row.items()))
+
+            thumb_dir = board.options['THUMB_DIR']
 
             # Loop through 'posts' key in each dictionary in the threads
             # list.
@@ -565,70 +654,39 @@ class StaffInterface(Template):
                 item['standalone'] = 0
 
                 if not thread[0]['parent']:
-                    sql = select([func.count(), func.count(table.c.image)],
-                                  table.c.parent == threadnum,
-                                  table)
-
-                    (postcount, imgcount) = session.execute(sql).fetchone()
-
-                    max_res = board.options['REPLIES_PER_THREAD']
-                    offset = postcount - imgcount if postcount > max_res \
-                                                  else 0
-
-                    sql = table.select().where(table.c.parent == threadnum)\
-                            .order_by(table.c.timestampofarchival.desc(),
-                                      table.c.postnum.asc())\
-                            .limit(max_res)\
-                            .offset(offset)
-                    thread.extend([dict(x.items()) \
-                                       for x in session.execute(sql)])
-
+                    (postcount, imgcount) = counts.get(threadnum, (0, 0))
+                    thread.extend(replies.get(threadnum, []))
                 else:
                     item['standalone'] = 1
 
                 for post in thread:
-                    image_dir \
-                        = os.path.join(board.path, board.options['IMG_DIR'])
-
-                    thumb_dir \
-                        = os.path.join(board.path, board.options['THUMB_DIR'])
-
-                    base_thumb = os.path.basename(post['thumbnail'] or '')
-                    base_image = os.path.basename(post['image'] or '')
-
-                    base_filename = (post['image'] or '')\
-                        .replace(image_dir, '').lstrip('/')
-
-                    backup_dir = os.path.join(board.url,
-                                              board.options['ARCHIVE_DIR'],
-                                              board.options['BACKUP_DIR'])
-
                     if post['image']:
-                        post['image'] = os.path.join(backup_dir, base_image)
+                        post['image'] = board.make_backup_path(post['image'],
+                                                               url=True)
                         shownimages += 1
 
-                    if re.match(board.options['THUMB_DIR'],
-                                post['thumbnail'] or ''):
+                    if (post['thumbnail'] or '').startswith(thumb_dir):
                         post['thumbnail'] \
-                            = os.path.join(backup_dir, base_thumb)
-                
-                item['omit'] = postcount - max_res if postcount > max_res\
-                                                   else 0
+                            = board.make_backup_path(post['thumbnail'],
+                                                     url=True)
+
+                item['omit'] = postcount - max_replies \
+                               if postcount > max_replies else 0
 
                 item['omitimages'] = imgcount - shownimages \
                                      if imgcount > shownimages else 0
 
-                template_kwargs = {'postform' \
-                                      : board.options['ALLOW_TEXTONLY'] or
-                                        board.options['ALLOW_IMAGES'],
-                                  'image_inp' : board.options['ALLOW_IMAGES'],
-                                   'textonly_inp' \
-                                      : board.options['ALLOW_IMAGES'] and
-                                        board.options['ALLOW_TEXTONLY'],
-                                   'nextpage' : nextpage,
-                                   'prevpage' : prevpage,
-                                   'threads' : threads,
-                                   'pages' : pages}
+            template_kwargs = {'postform' \
+                                  : board.options['ALLOW_TEXTONLY'] or
+                                    board.options['ALLOW_IMAGES'],
+                              'image_inp' : board.options['ALLOW_IMAGES'],
+                               'textonly_inp' \
+                                  : board.options['ALLOW_IMAGES'] and
+                                    board.options['ALLOW_TEXTONLY'],
+                               'nextpage' : nextpage,
+                               'prevpage' : prevpage,
+                               'threads' : threads,
+                               'pages' : pages}
 
         Template.__init__(self, 'backup_panel_template', **template_kwargs)
 
@@ -645,29 +703,42 @@ class StaffInterface(Template):
 
         if search.find('IP Address') != -1:
             try:
+                (start, end) = misc.parse_ip_block(text)
                 sql = table.select()\
-                           .where(table.c.ip == misc.dot_to_dec(text))
+                           .where(model.ip_in_range(table.c.ip, start, end))
             except ValueError:
                 raise WakaError('Please enter a valid IP.')
             search_type = 'IP'
         elif search.find('Text String') != -1:
-            sql = table.select().where(table.c.comment.like('%'+text+'%'))
+            sql = fulltext.select_matching(board, fulltext.COMMENT, text)
+            if sql is None:
+                sql = table.select()\
+                           .where(table.c.comment.like('%'+text+'%'))
             search_type = 'text string'
         elif search.find('Author') != -1:
-            sql = table.select().where(or_(table.c.name.like('%'+text+'%'),
-                table.c.trip.like('%'+text+'%')))
+            sql = fulltext.select_matching(board, fulltext.AUTHOR, text)
+            if sql is None:
+                sql = table.select().where(or_(
+                    table.c.name.like('%'+text+'%'),
+                    table.c.trip.like('%'+text+'%')))
             search_type = 'author'
         else:
             sql = table.select().where(table.c.num == text)
             search_type = 'ID'
 
+        cursors = {}
         if search_type != 'ID':
-            page = model.Page(sql, self.page, self.perpage)
+            page = model.Page(sql, self.page, self.perpage,
+                              keyset=[(table.c.num, True)],
+                              cursor=self.cursor)
             rowcount = page.total_entries
             total_pages = page.total_pages
             posts = page.rows
             if not posts:
                 raise WakaError("No posts found for %s %s" % (search_type, text))
+            cursors = dict(next_cursor=page.next_cursor,
+                           prev_cursor=page.prev_cursor,
+                           last_cursor=page.last_cursor)
         else:
             rowcount = total_pages = 1
             row = session.execute(sql).fetchone()
@@ -691,7 +762,18 @@ class StaffInterface(Template):
         Template.__init__(self, 'post_search', num=id,
                           posts=posts, search=search, text=text,
                           inputs=inputs, number_of_pages=total_pages,
-                          rooturl=rooturl, rowcount=rowcount, popup=popup)
+                          rooturl=rooturl, rowcount=rowcount, popup=popup,
+                          **cursors)
+
+    @interface_for(GLOBAL_SEARCH_PANEL)
+    def make_global_search_panel(self, search='', text=''):
+        failed = []
+        results = interboard.global_search(self.user, search, text, failed)
+
+        Template.__init__(self, 'global_post_search', search=search,
+                          text=text, results=results, failed=failed)
+        # The page head goes out while the boards are being searched.
+        self.streaming = True
 
     @interface_for(SQL_PANEL)
     def make_sql_interface_panel(self, sql='', nuke=''):
@@ -724,6 +806,7 @@ class StaffInterface(Template):
                     board = local.environ['waka.board']
                     board.table.drop(bind=model.engine, checkfirst=True)
                     del model._boards[board.name]
+                    fulltext.drop_board(board.name)
                     model.common.delete().where(model.common.c.board \
                                                 == board.name)
                 except Exception as errstr:
@@ -739,6 +822,35 @@ class StaffInterface(Template):
         Template.__init__(self, 'sql_interface_template',
                           results='<br />'.join(results))
 
+    @interface_for(PERFORMANCE_PANEL)
+    def make_admin_performance_panel(self):
+        if self.user.account != staff.ADMIN:
+            raise WakaError(strings.INUSUFFICENTPRIVLEDGES)
+
+        Template.__init__(self, 'performance_panel',
+                          enabled=config.REQUEST_METRICS,
+                          window=config.METRICS_WINDOW,
+                          pid=os.getpid(),
+                          buckets=metrics.BUCKETS,
+                          categories=metrics.CATEGORIES,
+                          tasks=metrics.summaries(),
+                          caches=util.cache_summaries())
+
+    @interface_for(QUERY_PANEL)
+    def make_admin_query_panel(self, clear=''):
+        if self.user.account != staff.ADMIN:
+            raise WakaError(strings.INUSUFFICENTPRIVLEDGES)
+
+        if clear:
+            querylog.clear()
+
+        Template.__init__(self, 'query_panel',
+                          enabled=config.QUERY_STATS,
+                          slow_ms=config.SLOW_QUERY_MS,
+                          pid=os.getpid(),
+                          buckets=querylog.BUCKETS,
+                          queries=querylog.summaries())
+
     @interface_for(PROXY_PANEL)
     def make_admin_proxy_panel(self):
         Template.__init__(self, 'proxy_panel_template')
@@ -851,7 +963,7 @@ def do_login(username=None, password=None, save_login=False,
             crypt_pass = misc.hide_critical_data(password, config.SECRET)
             if crypt_pass == staff_entry.password:
                 remote = local.environ['REMOTE_ADDR']
-                staff_entry.login_host(remote)
+                staff_entry.login_host(remote, save_login)
             else:
                 bad_pass = True
     elif admin:
@@ -5,7 +5,7 @@ import staff
 import interboard
 import misc
 import config
-from util import WakaError
+from util import WakaError, local
 
 # Dictionary of what action keywords mean. It's like a real dictionary!
 # {name: {'name': title, 'content': content}}
@@ -179,16 +179,31 @@ class StaffAction(object):
                 self._log_action()
 
     def _log_action(self):
-        interboard.trim_activity()
-        session = model.Session()
-        table = model.activity
         ip = misc.dot_to_dec(self.user.login_data.addr)
-        for content in self.contents:
-            sql = table.insert().values(username=self.user.username,
-                                        ip=ip,
-                                        action=self.action,
-                                        info=content,
-                                        date=self.date,
-                                        timestamp=self.timestamp,
-                                        admin_id=self.admin_id)
-            session.execute(sql)
+        rows = [dict(username=self.user.username,
+                     ip=ip,
+                     action=self.action,
+                     info=content,
+                     date=self.date,
+                     timestamp=self.timestamp,
+                     admin_id=self.admin_id)
+                for content in self.contents]
+
+        if config.STAFF_LOG_DEFERRED:
+            local.environ.setdefault('waka.activity_log', []).extend(rows)
+        else:
+            write_activity(rows)
+
+def write_activity(rows):
+    '''Add entries to the staff log, in a single statement.'''
+    if rows:
+        session = model.Session()
+        session.execute(model.activity.insert(), rows)
+
+def flush_activity_log():
+    '''Write the staff log entries deferred during this request. Must be
+    called after the request has been committed.'''
+    rows = local.environ.pop('waka.activity_log', [])
+    if rows:
+        write_activity(rows)
+        model.Session().commit()
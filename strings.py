@@ -70,6 +70,7 @@ MPDELETEALL = 'Del&nbsp;all'                                 #
 MPBAN = 'Ban'                                                # Sets whether or not to delete only file, or entire post/thread
 MPTABLE = '<th>Post No.</th><th>Time</th><th>Subject</th>' + \
     '<th>Name</th><th>Comment</th><th>Options</th><th>IP</th>'    # Explains names for Management Panel
+ARCHIVETABLE = '<th>Thread</th><th>Subject</th><th>Date</th><th>Posts</th>'    # Explains names for the archive index
 IMGSPACEUSAGE = '[ Space used: %d KB ]'                      # Prints space used KB by the board under Management Panel
 
 BANTABLE = '<th>Type</th><th>Value</th><th>Comment</th><th>Expires</th><th>Can Browse</th><th>Creator</th><th>Action</th>'    # EDITED Explains names for Ban Panel
@@ -131,6 +132,7 @@ BADDELPASS = 'Error: Incorrect password for deletion.'       # Returns error for
 WRONGPASS = 'Error: Management password incorrect, or login timed out.'    # Returns error for wrong password (when trying to access Manager modes)
 VIRUS = 'Error: Possible virus-infected file.'               # Returns error for malformed files suspected of being virus-infected.
 NOTWRITE = 'Error: Could not write to directory.'            # Returns error when the script cannot write to the directory, the chmod (777) is wrong
+THUMBBUSY = 'Error: The server is busy processing other images. Please try again in a moment.'
 SPAM = 'Spammers are not welcome here.'                      # Returns error when detecting spam
 
 SQLCONF = 'SQL connection failure'                           # Database connection failure
@@ -11,6 +11,7 @@ import misc
 from util import local, FileLock
 import str_format
 import staff_tasks
+import metrics
 
 TEMPLATES_DIR = os.path.join('templates')
 CACHE_DIR = os.path.join(TEMPLATES_DIR, '.cache')
@@ -27,6 +28,10 @@ def function(f):
     return f
 
 class Template(object):
+    # Send the page as it renders instead of all at once, for pages whose
+    # contents take a while to arrive.
+    streaming = False
+
     def __init__(self, name, **vars):
         if not os.path.exists(CACHE_DIR):
             os.makedirs(CACHE_DIR)
@@ -58,10 +63,19 @@ class Template(object):
         self.vars = vars
 
     def __iter__(self):
-        yield self.template.render(**self.vars).encode("utf-8")
+        if self.streaming:
+            # Streamed pages are rendered while the queries feeding them
+            # run, so they only count towards the wall time.
+            for chunk in self.template.generate(**self.vars):
+                yield chunk.encode("utf-8")
+        else:
+            with metrics.timed(metrics.TEMPLATE):
+                contents = self.template.render(**self.vars).encode("utf-8")
+            yield contents
 
     def render_to_file(self, filename):
-        contents = self.template.render(**self.vars).encode("utf-8")
+        with metrics.timed(metrics.TEMPLATE):
+            contents = self.template.render(**self.vars).encode("utf-8")
 
         if config.USE_TEMPFILES:
             tempname = os.path.join(os.path.dirname(filename),
@@ -87,9 +101,17 @@ class Template(object):
     def reverse_format(self, value, tplstring):
         return tplstring % value
 
+    def _archived(self, filename):
+        '''Whether filename is a post's file that went to the archive along
+        with the thread being rendered.'''
+        return self.vars.get('archive') and \
+            (filename.startswith(self.board.options['IMG_DIR']) or
+             filename.startswith(self.board.options['THUMB_DIR']))
+
     @filter
     def expand_url(self, filename, force_http=False):
-        return self.board.expand_url(filename, force_http)
+        return self.board.expand_url(filename, force_http,
+                                     archive=self._archived(filename))
 
     @filter
     def expand_image_url(self, filename):
@@ -123,6 +145,11 @@ class Template(object):
     @filter
     def get_reply_link(self, reply, parent, abbreviated=False,
                        force_http=False):
+        if self.vars.get('archive') and self.vars.get('thread') \
+                in (reply, parent):
+            # No abbreviated pages are kept in the archive.
+            return self.board.get_reply_link(reply, parent,
+                force_http=force_http, archive=True)
         return self.board.get_reply_link(reply, parent, abbreviated,
             force_http)
 
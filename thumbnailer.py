@@ -0,0 +1,214 @@
+'''Bounded thumbnail generation.
+
+All convert runs go through a fixed number of slots shared by every worker
+process on the host, with a bounded number of requests allowed to wait for
+one. In deferred mode the post is committed with a placeholder thumbnail and
+a worker process fills it in afterwards, holding its place in the queue
+until it is done. The worker finds the post by number, so the job survives
+the files being moved around on the board in the meantime.'''
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import shutil
+import tempfile
+from subprocess import Popen
+
+import config, config_defaults
+import strings
+import misc
+import model
+import metrics
+from util import WakaError, local
+
+class ThumbnailerBusy(WakaError):
+    def __init__(self, message=strings.THUMBBUSY):
+        WakaError.__init__(self, message)
+
+class SlotPool(object):
+    '''Counting semaphore shared across processes: a slot is an flock()ed
+    lock file, so slots held by a crashed process are freed by the kernel.'''
+
+    def __init__(self, name, slots, delay=.05):
+        lock_dir = config.THUMBNAIL_LOCK_DIR or tempfile.gettempdir()
+        self.paths = [os.path.join(lock_dir, 'waka-%s.%d.lock' % (name, i))
+                      for i in xrange(max(slots, 1))]
+        self.delay = delay
+        self.fd = None
+
+    def try_acquire(self):
+        for path in self.paths:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR, 0600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                os.close(fd)
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            else:
+                self.fd = fd
+                return True
+        return False
+
+    def acquire(self, timeout):
+        start_time = time.time()
+        while not self.try_acquire():
+            if time.time() - start_time >= timeout:
+                return False
+            time.sleep(self.delay)
+        return True
+
+    def detach(self):
+        '''Give up the held slot without unlocking it. It stays taken until
+        every copy of the returned descriptor is closed, including those
+        inherited by child processes.'''
+        fd, self.fd = self.fd, None
+        return fd
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+def _worker_slots():
+    return SlotPool('thumb', config.THUMBNAIL_CONCURRENCY)
+
+def _queue_slots():
+    return SlotPool('thumbqueue', config.THUMBNAIL_QUEUE_SIZE)
+
+def run_bounded(filename, thumbnail, width, height, quality, convert):
+    '''Run misc.make_thumbnail() in a worker slot, waiting in the bounded
+    queue if all of them are in use.'''
+
+    queue = _queue_slots()
+    if not queue.try_acquire():
+        raise ThumbnailerBusy()
+    try:
+        slot = _worker_slots()
+        with metrics.timed(metrics.LOCK):
+            acquired = slot.acquire(config.THUMBNAIL_QUEUE_TIMEOUT)
+        if not acquired:
+            raise ThumbnailerBusy()
+    finally:
+        queue.release()
+
+    try:
+        with metrics.timed(metrics.SUBPROCESS):
+            return misc.make_thumbnail(filename, thumbnail, width, height,
+                                       quality, convert)
+    finally:
+        slot.release()
+
+def make_thumbnail(board, filename, thumbnail, width, height):
+    '''Thumbnail an upload for board. Returns (width, height, deferred).
+    When deferred, width and height are the requested dimensions and the
+    thumbnail file holds the placeholder, if any, until the job is done.'''
+
+    quality = board.options['THUMBNAIL_QUALITY']
+    convert = board.options['CONVERT_COMMAND']
+
+    # Defer only while the queue has room; otherwise apply backpressure by
+    # thumbnailing synchronously. The queue slot is handed on to the worker
+    # process making the thumbnail (see start_deferred()).
+    queue = _queue_slots()
+    if config.THUMBNAIL_DEFERRED and queue.try_acquire():
+        try:
+            placeholder = config.THUMBNAIL_PLACEHOLDER
+            if placeholder:
+                placeholder = os.path.join(local.environ['DOCUMENT_ROOT'],
+                                           placeholder.lstrip('/'))
+                shutil.copyfile(placeholder, thumbnail)
+                os.chmod(thumbnail, 0644)
+        except:
+            queue.release()
+            raise
+
+        jobs = local.environ.setdefault('waka.thumbnail_jobs', [])
+        jobs.append({'fd': queue.detach(),
+                     'board': board.name,
+                     'thumbnail': thumbnail.replace(board.path, '')\
+                                           .lstrip('/'),
+                     'num': None,
+                     'width': width,
+                     'height': height})
+        return (width, height, True)
+
+    width, height = run_bounded(filename, thumbnail, width, height, quality,
+                                convert)
+    return (width, height, False)
+
+def assign_post(board, thumbnail, num):
+    '''Record the number of the post of a thumbnail deferred during this
+    request, once the post is written.'''
+    for job in local.environ.get('waka.thumbnail_jobs', []):
+        if job['board'] == board.name and job['thumbnail'] == thumbnail:
+            job['num'] = num
+
+def start_deferred():
+    '''Hand the thumbnails deferred during this request to worker processes.
+    Must be called after the posts referencing them have been committed.'''
+
+    jobs = local.environ.pop('waka.thumbnail_jobs', [])
+    for job in jobs:
+        try:
+            if job['num'] is None:
+                # The post was never written.
+                continue
+            # The worker gets the locked queue slot as its standard input,
+            # and no other descriptors; it keeps the slot until it exits,
+            # so the deferred jobs count against the queue size.
+            Popen([sys.executable, sys.argv[0], 'thumbnail', job['board'],
+                   str(job['num']), str(job['width']), str(job['height']),
+                   local.environ['DOCUMENT_ROOT'],
+                   local.environ['SCRIPT_NAME'],
+                   local.environ['SERVER_NAME']],
+                  stdin=job['fd'], close_fds=True)
+        finally:
+            os.close(job['fd'])
+
+def finish_deferred(board, num, width, height):
+    '''Worker side of a deferred thumbnail: generate it, update the post and
+    rebuild the pages showing it.'''
+
+    session = model.Session()
+    table = board.table
+    row = session.execute(table.select().where(table.c.num == num))\
+                 .fetchone()
+    if not row or not row.image or not row.thumbnail:
+        # The post or its file went away before its thumbnail was made.
+        return
+    image, thumbnail = row.image, row.thumbnail
+
+    # Render next to the placeholder and swap it in atomically.
+    full_thumbnail = os.path.join(board.path, thumbnail)
+    root, ext = os.path.splitext(full_thumbnail)
+    tempname = root + '.tmp' + ext
+
+    slot = _worker_slots()
+    slot.acquire(sys.maxint)
+    try:
+        tn_width, tn_height = misc.make_thumbnail(
+            os.path.join(board.path, image), tempname, width, height,
+            board.options['THUMBNAIL_QUALITY'],
+            board.options['CONVERT_COMMAND'])
+    finally:
+        slot.release()
+
+    if tn_width:
+        os.rename(tempname, full_thumbnail)
+        os.chmod(full_thumbnail, 0644)
+        sql = table.update().where(table.c.num == num)\
+                   .values(tn_width=tn_width, tn_height=tn_height)
+    else:
+        if os.path.exists(full_thumbnail):
+            os.unlink(full_thumbnail)
+        sql = table.update().where(table.c.num == num)\
+                   .values(thumbnail='', tn_width=0, tn_height=0)
+    session.execute(sql)
+    session.commit()
+
+    board.build_thread_cache(row.parent or row.num)
+    board.build_cache()
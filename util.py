@@ -5,6 +5,7 @@ import errno
 import imp
 import Cookie
 import threading
+import collections
 import mimetypes
 import functools
 
@@ -27,6 +28,71 @@ class WakaError(Exception):
     def __str__(self):
         return self.message
 
+# Named caches, whose hit rates are shown in the performance panel.
+_caches = []
+
+class LRUCache(object):
+    '''Bounded mapping that drops its least recently used entries, and
+    counts lookup hits and misses. Safe to share between threads.'''
+
+    def __init__(self, size, name=None):
+        self.size = size
+        self.name = name
+        self.hits = self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if name:
+            _caches.append(self)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    def values(self):
+        '''Snapshot of the cached values, least recently used first.'''
+        with self._lock:
+            return self._items.values()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._items)
+
+def cache_summaries():
+    '''Size and lookup counts of the named caches of this process, for
+    templating.'''
+    return [{'name': cache.name,
+             'entries': len(cache),
+             'size': cache.size,
+             'hits': cache.hits,
+             'misses': cache.misses,
+             'hit_rate': cache.hit_rate * 100}
+            for cache in _caches]
+
 def wrap_static(application, *app_paths, **kwds):
     '''Application used in the development server to serve static files
     (i.e. everything except the CGI filename). DO NOT USE IN PRODUCTION'''
@@ -187,6 +253,11 @@ class FileLock(object):
                     raise FileLockException("Timeout occured.")
                 time.sleep(self.delay)
         self.is_locked = True
+
+        # Lock waits of timed requests (see metrics.py).
+        timer = local.environ.get('waka.timer')
+        if timer is not None:
+            timer.add('lock', time.time() - start_time)
  
  
     def release(self):
@@ -2,6 +2,7 @@
 
 import os
 import sys
+import random
 
 import fcgi
 import werkzeug
@@ -9,8 +10,14 @@ import werkzeug
 import config, config_defaults
 import app
 import util
+import filestore
+import thumbnailer
+import staff_tasks
+import search
 import model
 import interboard
+import metrics
+import querylog
 from board import Board, NoBoard
 from util import WakaError, local
 
@@ -19,17 +26,23 @@ def application(environ, start_response):
     '''Main routing application'''
 
     local.environ = environ
-    request = werkzeug.BaseRequest(environ)
+    metrics.begin(environ)
+    request = filestore.UploadRequest(environ)
 
-    task = request.values.get('task', request.values.get('action', ''))
-    boardname = request.values.get('board', '')
+    # Indicate "pop-up window" UI style.
+    environ['waka.fromwindow'] = False
+    environ['waka.rootpath'] = os.path.join('/', config.BOARD_DIR, '')
 
+    # Uploads are ingested while the form is parsed, which may abort early.
+    try:
+        task = request.values.get('task', request.values.get('action', ''))
+        boardname = request.values.get('board', '')
+    except WakaError, e:
+        environ['waka.board'] = NoBoard()
+        return app.fffffff(environ, start_response, e)
 
     environ['waka.task'] = task
     environ['waka.boardname'] = boardname
-    # Indicate "pop-up window" UI style.
-    environ['waka.fromwindow'] = False
-    environ['waka.rootpath'] = os.path.join('/', config.BOARD_DIR, '')
 
     if not task and not boardname:
         environ['waka.board'] = NoBoard()
@@ -53,6 +66,7 @@ def application(environ, start_response):
     try:
         interboard.remove_old_bans()
         interboard.remove_old_backups()
+        interboard.scheduled_maintenance()
         return function(environ, start_response)
     except WakaError, e:
         return app.fffffff(environ, start_response, e)
@@ -61,8 +75,13 @@ def cleanup(*args, **kwargs):
     '''Destroy the thread-local session and environ'''
     session = model.Session()
     session.commit()
+    # Staff log entries may be written after the response.
+    staff_tasks.flush_activity_log()
+    # Deferred thumbnails may only be made once their posts are committed.
+    thumbnailer.start_deferred()
     session.transaction = None  # fix for a circular reference
     model.Session.remove()
+    metrics.finish(local.environ)
     local.environ = {}
 
 application = util.cleanup(application, cleanup)
@@ -73,9 +92,20 @@ def worker_commands(command, args):
     elif command == 'delete_by_ip':
         ip = args.pop(0)
         boards = args.pop(0).split(',')
+        staff_name, staff_ip = args.pop(0), args.pop(0)
+    elif command == 'thumbnail':
+        board_name = args.pop(0)
+        num = int(args.pop(0))
+        width, height = int(args.pop(0)), int(args.pop(0))
+    elif command in ('migrate_storage', 'index_search'):
+        board_name = args.pop(0)
 
-    (local.environ['DOCUMENT_ROOT'], local.environ['SCRIPT_NAME'],
-        local.environ['SERVER_NAME']) = args[:3]
+    # The environment of the request that started the command. Commands run
+    # from cron, such as maintenance, may leave it out; they are then run
+    # from the document root.
+    if len(args) >= 3:
+        (local.environ['DOCUMENT_ROOT'], local.environ['SCRIPT_NAME'],
+            local.environ['SERVER_NAME']) = args[:3]
 
     if command == 'rebuild_cache':
         board = Board(board_name)
@@ -86,7 +116,34 @@ def worker_commands(command, args):
         interboard.global_cache_rebuild()
 
     elif command == 'delete_by_ip':
-        interboard.process_global_delete_by_ip(ip, boards)
+        interboard.process_global_delete_by_ip(ip, boards, staff_name,
+                                              staff_ip)
+
+    elif command == 'thumbnail':
+        board = Board(board_name)
+        local.environ['waka.board'] = board
+        thumbnailer.finish_deferred(board, num, width, height)
+
+    elif command == 'migrate_storage':
+        board = Board(board_name)
+        local.environ['waka.board'] = board
+        moved = filestore.migrate_layout(board)
+        print "Moved %d files of /%s/" % (moved, board_name)
+
+    elif command == 'index_search':
+        board = Board(board_name)
+        local.environ['waka.board'] = board
+        indexed = search.rebuild_index(board)
+        print "Indexed %d posts of /%s/" % (indexed, board_name)
+
+    elif command == 'maintenance':
+        interboard.remove_old_bans()
+        interboard.remove_old_backups()
+        interboard.scheduled_maintenance(force=True)
+
+    elif command == 'migrate_ips':
+        converted = interboard.migrate_ips()
+        print "Converted %d addresses" % converted
 
     cleanup()
 
@@ -103,6 +160,13 @@ def reset_password(username):
 
     cleanup()
 
+def init_worker():
+    '''Runs in each prefork FastCGI worker right after the fork.'''
+    # Database connections must not be shared with the master or the
+    # other workers, and neither should the random number sequence.
+    model.engine.dispose()
+    random.seed()
+
 def development_server():
     app_path = os.path.basename(__file__)
 
@@ -123,14 +187,26 @@ def main():
         print "Content-Type: text/plain\n"
         print "Error initializing database: %s" % e.args[0]
         return
+    metrics.install()
+    querylog.install()
 
     arg = sys.argv[1:] and sys.argv[1] or 'fcgi'
     if arg == 'fcgi':
-        fcgi.WSGIServer(application).run()
+        if config.FCGI_WORKERS:
+            # Connections opened by init_database() are not inherited.
+            model.engine.dispose()
+            fcgi.PreforkWSGIServer(application,
+                                   workers=config.FCGI_WORKERS,
+                                   maxRequests=config.MAX_FCGI_LOOPS,
+                                   maxRSS=config.FCGI_MAX_RSS_KB,
+                                   childInit=init_worker).run()
+        else:
+            fcgi.WSGIServer(application).run()
     elif arg == 'reset_password':
         reset_password(sys.argv[2])
     elif arg in ('rebuild_cache', 'rebuild_global_cache',
-                         'delete_by_ip'):
+                         'delete_by_ip', 'thumbnail', 'migrate_storage',
+                         'migrate_ips', 'maintenance', 'index_search'):
         worker_commands(arg, sys.argv[2:])
     else:
         development_server()